@@ -0,0 +1,136 @@
+"""
+JWT authentication serving the users from an in-process cache.
+
+`rest_framework_jwt` loads the user of the token on every request. Here the signed
+`user_id` and `token_version` claims identify a cached user instead. The other fields
+(e.g. `is_active`) aren't trusted from the claims, they could be outdated for as long
+as a token lives: a cache miss reads the user row and checks them. Every request gets
+its own `User` instance built from the cached fields, so changes made to it don't leak
+into other requests.
+
+Bumping `User.token_version` (done when the password changes, see `User.save`)
+revokes the issued tokens, saving a user evicts it from the cache of the current
+process. The cache isn't shared: other processes only see revocations and
+deactivations once their entry expires, within `JWT_USER_CACHE_TTL` seconds.
+"""
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.utils.translation import ugettext as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+from rest_framework_jwt.utils import jwt_payload_handler as default_payload_handler
+
+from .models import User
+
+
+def jwt_payload_handler(user: User) -> dict:
+    payload = default_payload_handler(user)
+    payload["token_version"] = user.token_version
+    return payload
+
+
+@lru_cache(maxsize=None)
+def _field_names() -> Tuple[str, ...]:
+    return tuple(field.attname for field in User._meta.concrete_fields)
+
+
+class UserCache:
+    """
+    Bounded LRU cache of users by id, an entry is only valid for the token version
+    it was stored with and for `ttl` seconds. The field values are cached, every
+    lookup returns a new instance.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int, token_version: int) -> Optional[User]:
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return None
+            version, db, values, expires_at = entry
+            if version != token_version or expires_at <= time.monotonic():
+                del self._users[user_id]
+                return None
+            self._users.move_to_end(user_id)
+        return User.from_db(db, _field_names(), values)
+
+    def set(self, user: User) -> None:
+        values = tuple(getattr(user, name) for name in _field_names())
+        with self._lock:
+            self._users[user.pk] = (
+                user.token_version,
+                user._state.db,
+                values,
+                time.monotonic() + self.ttl,
+            )
+            self._users.move_to_end(user.pk)
+            while len(self._users) > self.maxsize:
+                self._users.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._users.clear()
+
+
+@lru_cache(maxsize=None)
+def get_user_cache() -> UserCache:
+    return UserCache(
+        maxsize=settings.JWT_USER_CACHE_SIZE, ttl=settings.JWT_USER_CACHE_TTL
+    )
+
+
+def invalidate_user(user_id: int) -> None:
+    """
+    Evicts the user from the cache of the current process, e.g. after deactivation
+    or a password change (the other processes expire it within the TTL).
+    """
+    get_user_cache().invalidate(user_id)
+
+
+def revoke_tokens(user: User) -> None:
+    """
+    Revokes every token issued to the user so far, right away in the current process
+    and within `JWT_USER_CACHE_TTL` seconds in the others.
+    """
+    user.token_version += 1
+    User.objects.filter(pk=user.pk).update(token_version=user.token_version)
+    invalidate_user(user.pk)
+
+
+class CachedJSONWebTokenAuthentication(JSONWebTokenAuthentication):
+    def authenticate_credentials(self, payload):
+        user_id = payload.get("user_id")
+        token_version = payload.get("token_version", 0)
+        if not user_id:
+            raise AuthenticationFailed(_("Invalid payload."))
+
+        user_cache = get_user_cache()
+        user = user_cache.get(user_id, token_version)
+        if user is not None:
+            return user
+
+        try:
+            user = User.objects.get(pk=user_id)
+        except User.DoesNotExist:
+            raise AuthenticationFailed(_("Invalid signature."))
+        if user.token_version != token_version:
+            raise AuthenticationFailed(_("Token has been revoked."))
+        if not user.is_active:
+            raise AuthenticationFailed(_("User account is disabled."))
+
+        user_cache.set(user)
+        return user
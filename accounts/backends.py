@@ -1,27 +1,27 @@
+from django.contrib.auth.backends import ModelBackend
 from .models import User
 
 
-class EmailOrUsernameModelBackend(object):
+class EmailOrUsernameModelBackend(ModelBackend):
     """
     Authentication with either a username or an email address.
+
+    The user is looked up by one query and the password is hashed exactly once,
+    also for unknown users (against timing attacks), so this backend replaces
+    `ModelBackend` rather than following it.
     """
 
-    def authenticate(self, request, username=None, password=None):
-        if "@" in username:
-            kwargs = {"email": username}
-        else:
-            kwargs = {"username": username}
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            # e.g. `obtain_jwt_token` passes the credentials by `USERNAME_FIELD`
+            username = kwargs.get(User.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
 
-        try:
-            user = User.objects.get(**kwargs)
-        except User.DoesNotExist:
+        user = User.objects.get_by_login(username)
+        if user is None:
+            User().set_password(password)
             return None
 
-        if user.check_password(password):
+        if user.check_password(password) and self.user_can_authenticate(user):
             return user
-
-    def get_user(self, pk):
-        try:
-            return User.objects.get(pk=pk)
-        except User.DoesNotExist:
-            return None
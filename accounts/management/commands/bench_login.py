@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
+
+from accounts.models import User
+from dialogs.benchmark import benchmark_database, format_table, measure, summarize
+
+BACKENDS = {
+    "ModelBackend + email/username": [
+        "django.contrib.auth.backends.ModelBackend",
+        "accounts.backends.EmailOrUsernameModelBackend",
+    ],
+    "email/username": ["accounts.backends.EmailOrUsernameModelBackend"],
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures login throughput of `obtain_jwt_token` by email and by username "
+        "with and without `ModelBackend` in front (on a throwaway test database)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            user = User.objects.create_user(
+                email="benchmark@example.com", username="benchmark", password="password"
+            )
+            client = APIClient()
+            url = reverse("get_auth_token")
+
+            rows = []
+            for backends_name, backends in BACKENDS.items():
+                for login in (user.email, user.username):
+
+                    def obtain_token():
+                        response = client.post(
+                            url, {"email": login, "password": "password"}
+                        )
+                        assert response.status_code == 200, response.content
+
+                    with override_settings(AUTHENTICATION_BACKENDS=backends):
+                        samples = measure(obtain_token, repeat=options["repeat"])
+                    stats = summarize(samples)
+                    rows.append(
+                        [
+                            backends_name,
+                            "email" if login == user.email else "username",
+                            round(len(samples) / sum(samples), 1),
+                            stats["p50"],
+                            stats["p95"],
+                        ]
+                    )
+
+        self.stdout.write(
+            format_table(["backends", "login", "logins/s", "p50, ms", "p95, ms"], rows)
+        )
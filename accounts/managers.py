@@ -1,4 +1,6 @@
 from django.contrib.auth.models import BaseUserManager
+from django.db.models import Q
+from django.db.models.functions import Lower
 from django.utils.translation import ugettext_lazy as _
 
 
@@ -35,3 +37,19 @@ class UserManager(BaseUserManager):
         user.is_superuser = True
         user.save(using=self._db)
         return user
+
+    def get_by_login(self, login: str):
+        """
+        Returns the user with the given email (case insensitive) or username or `None`,
+        in one query served by `accounts_user_email_lower_idx` and the username index.
+        An email match wins over another user's username.
+        """
+        users = list(
+            self.annotate(email_lower=Lower("email")).filter(
+                Q(email_lower=login.lower()) | Q(username=login)
+            )[:2]
+        )
+        for user in users:
+            if user.email.lower() == login.lower():
+                return user
+        return users[0] if users else None
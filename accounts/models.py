@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Lower
 from django.contrib.auth.models import AbstractUser
 from django.utils.translation import ugettext_lazy as _
 from .managers import UserManager
@@ -8,6 +9,8 @@ class User(AbstractUser):
     email = models.EmailField(_("email address"), unique=True)
     phone = models.CharField(max_length=15, blank=True)
     password_expire_at = models.DateTimeField(blank=True, null=True)
+    # carried by the issued JWTs, bumping it revokes them (see `accounts.authentication`)
+    token_version = models.PositiveIntegerField(default=0, editable=False)
 
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = [
@@ -15,3 +18,18 @@ class User(AbstractUser):
     ]
 
     objects = UserManager()
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # case insensitive email lookups of `UserManager.get_by_login`
+            models.Index(Lower("email"), name="accounts_user_email_lower_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self._password is not None and not self._state.adding:
+            # the password was changed by `set_password`, revoke the issued tokens
+            self.token_version += 1
+            update_fields = kwargs.get("update_fields")
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "token_version"}
+        super().save(*args, **kwargs)
@@ -10,6 +10,7 @@ from .forms import PasswordResetForm
 from django.views import View
 from django.views.generic.edit import CreateView
 from django.urls import reverse_lazy
+from rest_framework_jwt.views import ObtainJSONWebToken
 
 
 class SignUpView(SuccessMessageMixin, CreateView):
@@ -30,15 +31,8 @@ class PasswordResetView(View):
     def post(self, request, *args, **kwargs):
         form = self.form_class(request.POST)
         if form.is_valid():
-            username = form.cleaned_data["username"]
-            if "@" in username:
-                kwargs = {"email": username}
-            else:
-                kwargs = {"username": username}
-
-            try:
-                user = User.objects.get(**kwargs)
-            except User.DoesNotExist:
+            user = User.objects.get_by_login(form.cleaned_data["username"])
+            if user is None:
                 messages.error(request, "Invalid Username or Email")
                 return redirect("accounts:password_reset")
             print(
@@ -50,3 +44,18 @@ class PasswordResetView(View):
             return redirect("accounts:password_reset_done")
 
         return render(request, self.template_name, {"form": form})
+
+
+class ObtainJSONWebTokenView(ObtainJSONWebToken):
+    """
+    Issues JWTs, throttled per account the login is attempted for and per IP address.
+    """
+
+    throttle_scope = "login"
+
+    def get_throttle_ident(self, request):
+        # any JSON body, not just objects, gets here before the serializer rejects it
+        if not isinstance(request.data, dict):
+            return None
+        login = request.data.get(User.USERNAME_FIELD)
+        return login.lower() if isinstance(login, str) else None
@@ -1,5 +1,6 @@
 from django.contrib import admin
 from .models import Thread, Message
+from .services import delete_thread
 
 
 @admin.register(Thread)
@@ -9,6 +10,13 @@ class ThreadAdmin(admin.ModelAdmin):
     raw_id_fields = ("participants",)
     list_per_page = 25
 
+    def delete_model(self, request, obj):
+        delete_thread(obj)
+
+    def delete_queryset(self, request, queryset):
+        for thread in queryset:
+            delete_thread(thread)
+
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
@@ -0,0 +1,293 @@
+"""
+Async message endpoints for ASGI deployments (see `yalantis_django.urls_asgi`).
+
+Under ASGI Django 3.2 runs every sync view in one shared thread, so a slow request
+holds up all of the others and a waiting one blocks them for good. These views keep
+the event loop free instead: the database work of the DRF views runs in a bounded
+pool of `DIALOGS_ASYNC_DB_WORKERS` threads, and waiting for new messages awaits
+pub/sub events without taking a thread at all.
+
+The views stay async only if every middleware is async-capable, a sync-only one
+(e.g. the debug toolbar) puts the requests back into the shared thread. Streaming
+responses are async iterators (`AsyncStreamingHttpResponse`), Django would iterate
+them on the event loop otherwise.
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import JsonResponse, StreamingHttpResponse
+
+from . import events, metrics, routers
+from .models import ArchivedMessage, Message
+from .pubsub import AsyncSubscription, get_pubsub, user_channel
+from .renderers import format_event
+from .views import MessageExport, MessageViewSet, MessagesReadUntil, MessagesSince
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.DIALOGS_ASYNC_DB_WORKERS,
+                thread_name_prefix="dialogs-db",
+            )
+        return _executor
+
+
+def _call(func, args, kwargs):
+    # counted for the request (see `dialogs.metrics`)
+    metrics.instrument_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # Django closes the connections of its own thread only
+        close_old_connections()
+
+
+async def run_in_pool(func, *args, **kwargs):
+    """
+    Runs the (blocking) `func` in the database thread pool and returns its result.
+    """
+    loop = asyncio.get_running_loop()
+    # in the context of the request, e.g. its replica routing (see `dialogs.routers`)
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(context.run, _call, func, args, kwargs)
+    )
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    """
+    Streaming response of an async iterator of bytes, sent by the ASGI handler of
+    `yalantis_django.asgi` (Django 3.2 only iterates streaming content synchronously).
+    """
+
+    def __init__(self, async_content, *args, **kwargs):
+        super().__init__((), *args, **kwargs)
+        self.async_content = async_content
+
+
+def _render(view_func, request, *args, **kwargs):
+    response = view_func(request, *args, **kwargs)
+    # rendered in the pool too, Django would render it in the shared thread
+    if hasattr(response, "render") and not response.is_rendered:
+        response.render()
+    return response
+
+
+def as_async_view(view_func):
+    """
+    Returns an async view serving requests by the sync `view_func` (returned by
+    `as_view`) in the database thread pool.
+    """
+
+    # copies `cls`, `actions` and `csrf_exempt` of the DRF view as well
+    @functools.wraps(view_func)
+    async def view(request, *args, **kwargs):
+        return await run_in_pool(_render, view_func, request, *args, **kwargs)
+
+    return view
+
+
+async def _wait_for_message(subscription, thread_pk, deadline):
+    """
+    Waits for a new message of the thread (or of any thread when `None`) until the
+    `time.monotonic()` deadline. Returns whether a message was created.
+    """
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        event = await subscription.get(timeout=remaining)
+        if event is None:
+            return False
+        if event["type"] == events.MESSAGE_CREATED and (
+            thread_pk is None or event["thread"] == thread_pk
+        ):
+            return True
+
+
+_message_list = as_async_view(MessageViewSet.as_view({"get": "list", "post": "create"}))
+
+
+@functools.wraps(_message_list)
+async def message_list(request, *args, **kwargs):
+    """
+    Lists and creates messages like `MessageViewSet`. A listing of the messages
+    `after` the given one with a `timeout` (seconds) waits for new messages if there
+    are none yet, responding as soon as one is created or when the time is up.
+    """
+    timeout = request.GET.get("timeout")
+    if request.method != "GET" or timeout is None or "after" not in request.GET:
+        return await _message_list(request, *args, **kwargs)
+    try:
+        timeout = min(float(timeout), settings.DIALOGS_LONG_POLL_TIMEOUT)
+    except ValueError:
+        timeout = -1
+    if not timeout >= 0:
+        return JsonResponse(["[ERROR] Invalid timeout"], safe=False, status=400)
+
+    deadline = time.monotonic() + timeout
+    response = await _message_list(request, *args, **kwargs)
+    if response.status_code != 200 or response.data["results"] or not timeout:
+        return response
+
+    # the user is known once authenticated by the view, subscribing before listing
+    # again so that no message is missed in between
+    pubsub = get_pubsub()
+    # the events announce messages the replicas may not have yet
+    routers.use_primary()
+    subscription = AsyncSubscription([user_channel(request.user.pk)])
+    pubsub.subscribe(subscription)
+    try:
+        response = await _message_list(request, *args, **kwargs)
+        while not response.data["results"] and await _wait_for_message(
+            subscription, kwargs["thread_pk"], deadline
+        ):
+            response = await _message_list(request, *args, **kwargs)
+    finally:
+        pubsub.unsubscribe(subscription)
+    return response
+
+
+messages_read_until = as_async_view(MessagesReadUntil.as_view())
+
+
+class AsyncMessageExport(MessageExport):
+    """
+    `MessageExport` reading and formatting every chunk in the database pool, the
+    event loop and the pool threads are free while the chunks are sent.
+    """
+
+    def get_streaming_response(self, content, **kwargs):
+        return AsyncStreamingHttpResponse(content, **kwargs)
+
+    async def get_content(self, thread):
+        header = True
+        # the archived messages of a thread precede the hot ones
+        for model in (ArchivedMessage, Message):
+            after = 0
+            while after is not None:
+                content, after = await run_in_pool(
+                    self.format_chunk, model, thread, after, header
+                )
+                header = False
+                if content:
+                    yield content
+
+    def format_chunk(self, model, thread, after, header):
+        """
+        Returns the formatted chunk following the `after` message and the message
+        to continue after, `None` when it was the last chunk.
+        """
+        rows = self.get_chunk(model, thread, after)
+        content = "".join(self.format(rows, header)).encode()
+        return content, rows[-1][0] if len(rows) == self.chunk_size else None
+
+
+message_export = as_async_view(AsyncMessageExport.as_view())
+
+
+class AsyncMessagesSince(MessagesSince):
+    """
+    `MessagesSince` leaving the waiting to the event loop: long-polls are waited
+    for by `messages_since`, the SSE stream is an async iterator reading the
+    messages in the database pool.
+    """
+
+    def get_streaming_response(self, content, **kwargs):
+        return AsyncStreamingHttpResponse(content, **kwargs)
+
+    def poll_messages(self, thread, since, limit, timeout):
+        return self.get_messages(thread, since, limit)
+
+    async def stream_messages(self, thread, since, limit, timeout):
+        deadline = time.monotonic() + timeout
+        thread_pk = thread.pk if thread is not None else None
+        # subscribing before querying, so no message is missed in between
+        pubsub = get_pubsub()
+        subscription = AsyncSubscription([user_channel(self.request.user.pk)])
+        pubsub.subscribe(subscription)
+        try:
+            while True:
+                content, since, count = await run_in_pool(
+                    self.format_messages, thread, since, limit
+                )
+                if content:
+                    yield content
+                if count == limit:
+                    continue  # more messages are waiting
+
+                while not await _wait_for_message(
+                    subscription,
+                    thread_pk,
+                    min(deadline, time.monotonic() + settings.DIALOGS_SSE_HEARTBEAT),
+                ):
+                    if time.monotonic() >= deadline:
+                        return
+                    # keeps proxies from dropping an idle connection
+                    yield b": keep-alive\n\n"
+        finally:
+            pubsub.unsubscribe(subscription)
+
+    def format_messages(self, thread, since, limit):
+        """
+        Returns the events of the messages after `since`, the id of the last one
+        (`since` when there are none) and their number.
+        """
+        messages = self.get_messages(thread, since, limit)
+        content = "".join(
+            format_event(data, event="message", id=data["id"])
+            for data in self.serialize(messages)
+        )
+        last_id = messages[-1].pk if messages else since
+        return content.encode(), last_id, len(messages)
+
+
+_messages_since = as_async_view(AsyncMessagesSince.as_view())
+
+
+@functools.wraps(_messages_since)
+async def messages_since(request, *args, **kwargs):
+    """
+    Returns messages like `MessagesSince`. A long-poll without new messages yet
+    waits for their events, responding as soon as one is created or when the time
+    is up.
+    """
+    started_at = time.monotonic()
+    response = await _messages_since(request, *args, **kwargs)
+    if response.streaming or response.status_code != 200 or response.data["results"]:
+        return response
+    # validated by the view
+    timeout = request.GET.get("timeout")
+    timeout = settings.DIALOGS_LONG_POLL_TIMEOUT if timeout is None else float(timeout)
+    deadline = started_at + min(timeout, settings.DIALOGS_LONG_POLL_TIMEOUT)
+    if deadline <= time.monotonic():
+        return response
+
+    thread_pk = request.GET.get("thread")
+    thread_pk = int(thread_pk) if thread_pk is not None else None
+    # the user is known once authenticated by the view, subscribing before listing
+    # again so that no message is missed in between
+    pubsub = get_pubsub()
+    subscription = AsyncSubscription([user_channel(request.user.pk)])
+    pubsub.subscribe(subscription)
+    try:
+        response = await _messages_since(request, *args, **kwargs)
+        while not response.data["results"] and await _wait_for_message(
+            subscription, thread_pk, deadline
+        ):
+            response = await _messages_since(request, *args, **kwargs)
+    finally:
+        pubsub.unsubscribe(subscription)
+    return response
@@ -0,0 +1,121 @@
+"""
+Helpers shared by the `bench_*` management commands.
+
+Benchmarks run against a throwaway test database, so they never touch real data.
+"""
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+from django.conf import settings
+from django.db import connection, reset_queries
+from django.test.utils import (
+    CaptureQueriesContext,
+    override_settings,
+    setup_databases,
+    setup_test_environment,
+    teardown_databases,
+    teardown_test_environment,
+)
+
+
+@contextmanager
+def benchmark_database(verbosity: int = 0):
+    """
+    Creates (and finally destroys) test databases and switches Django into the test
+    environment with throttling disabled, so `APIClient` can be used against the
+    created databases.
+    """
+    setup_test_environment(debug=False)
+    old_config = setup_databases(verbosity=verbosity, interactive=False)
+    # benchmarks measure the endpoints, not the throttles
+    rest_framework = {**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": {}}
+    try:
+        with override_settings(REST_FRAMEWORK=rest_framework):
+            yield
+    finally:
+        teardown_databases(old_config, verbosity=verbosity)
+        teardown_test_environment()
+
+
+def measure(func: Callable, repeat: int = 20, warmup: int = 2) -> List[float]:
+    """
+    Calls `func` `warmup` + `repeat` times and returns durations of the last `repeat`
+    calls in seconds.
+    """
+    for _ in range(warmup):
+        func()
+
+    samples = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started_at)
+    return samples
+
+
+def measure_concurrently(
+    func: Callable[[int], None], calls: int, concurrency: int
+) -> Dict[str, object]:
+    """
+    Calls `func(i)` for every `i` of `range(calls)` from `concurrency` threads.
+    Returns the duration (seconds) and the number of queries of every call and the
+    wall time of the whole run.
+    """
+
+    def call(i):
+        # requests reset the query log, the capture must start empty
+        reset_queries()
+        with CaptureQueriesContext(connection) as context:
+            started_at = time.perf_counter()
+            func(i)
+            duration = time.perf_counter() - started_at
+        return duration, len(context)
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, range(calls)))
+    return {
+        "samples": [duration for duration, _ in results],
+        "queries": [queries for _, queries in results],
+        "elapsed": time.perf_counter() - started_at,
+    }
+
+
+def percentile(samples: List[float], percent: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """
+    Latency statistics of `samples` (in seconds) in milliseconds.
+    """
+    return {
+        "min": round(min(samples) * 1000, 3),
+        "mean": round(statistics.mean(samples) * 1000, 3),
+        "p50": round(percentile(samples, 50) * 1000, 3),
+        "p95": round(percentile(samples, 95) * 1000, 3),
+        "p99": round(percentile(samples, 99) * 1000, 3),
+        "max": round(max(samples) * 1000, 3),
+    }
+
+
+def format_table(headers: List[str], rows: List[list]) -> str:
+    rows = [[str(value) for value in row] for row in rows]
+    widths = [
+        max(len(header), *(len(row[i]) for row in rows)) if rows else len(header)
+        for i, header in enumerate(headers)
+    ]
+    lines = [
+        "  ".join(header.ljust(width) for header, width in zip(headers, widths)),
+        "  ".join("-" * width for width in widths),
+    ]
+    lines += [
+        "  ".join(value.ljust(width) for value, width in zip(row, widths))
+        for row in rows
+    ]
+    return "\n".join(lines)
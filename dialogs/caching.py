@@ -0,0 +1,178 @@
+"""
+Cache of the dialogs reads: thread summaries, per-user thread id pages, per-user
+unread counts and message pages.
+
+Entries live in the Django cache chosen by the `DIALOGS_CACHE_ALIAS` setting (`None`
+disables caching). Every entry key embeds the current version of the thread or user
+it depends on, invalidating bumps that version, so stale entries are never looked up
+again and just expire. Invalidation is driven by the model signals (see
+`dialogs.signals`) and by the services writing with `update()`/`bulk_create()`.
+"""
+import hashlib
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Iterable
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from . import routers
+
+THREAD = "thread"
+USER = "user"
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def get_cache():
+    alias = settings.DIALOGS_CACHE_ALIAS
+    return caches[alias] if alias else None
+
+
+def get_stats() -> Dict[str, Dict[str, int]]:
+    """
+    Returns hits and misses of the current process by entry name.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    names = sorted({name for name, _ in stats})
+    return {
+        name: {
+            "hits": stats.get((name, True), 0),
+            "misses": stats.get((name, False), 0),
+        }
+        for name in names
+    }
+
+
+def reset_stats() -> None:
+    with _stats_lock:
+        _stats.clear()
+
+
+def _count(name: str, hits: int = 0, misses: int = 0) -> None:
+    with _stats_lock:
+        _stats[name, True] += hits
+        _stats[name, False] += misses
+
+
+def _version_key(scope: str, pk: int) -> str:
+    return f"dialogs:{scope}:{pk}:version"
+
+
+def _versions(cache, scope: str, pks: Iterable[int]) -> Dict[int, int]:
+    keys = {_version_key(scope, pk): pk for pk in pks}
+    versions = {keys[key]: version for key, version in cache.get_many(keys).items()}
+    for key, pk in keys.items():
+        if pk not in versions:
+            # a unique start, entries of an evicted version can't be found again
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[pk] = cache.get(key)
+    return versions
+
+
+def _bump(scope: str, pks: Iterable[int]) -> None:
+    cache = get_cache()
+    if cache is None:
+        return
+    for pk in pks:
+        try:
+            cache.incr(_version_key(scope, pk))
+        except ValueError:
+            pass  # nothing was cached under the missing version
+
+
+def _invalidate(scope: str, pks: Iterable[int]) -> None:
+    pks = list(pks)
+    _bump(scope, pks)
+    # once more after the commit: a concurrent request may have cached data it read
+    # before the changes were committed
+    transaction.on_commit(lambda: _bump(scope, pks))
+
+
+def invalidate_threads(thread_pks: Iterable[int]) -> None:
+    _invalidate(THREAD, thread_pks)
+
+
+def invalidate_users(user_pks: Iterable[int]) -> None:
+    _invalidate(USER, user_pks)
+
+
+def _timeout() -> int:
+    # a replica may not have the changes of the last invalidation yet, what is read
+    # from it is only kept for as long as the replicas may lag behind
+    if routers.reads_from_replicas():
+        return min(settings.DIALOGS_CACHE_TIMEOUT, settings.DIALOGS_REPLICA_LAG)
+    return settings.DIALOGS_CACHE_TIMEOUT
+
+
+def _entry_key(name: str, scope: str, pk: int, version: int, suffix: str) -> str:
+    if suffix:
+        suffix = hashlib.md5(suffix.encode()).hexdigest()
+    return f"dialogs:{name}:{scope}:{pk}:{version}:{suffix}"
+
+
+def get_or_load(
+    name: str, scope: str, pk: int, loader: Callable, suffix: str = ""
+) -> object:
+    """
+    Returns the `name` entry of the thread or user `pk`, loading it by `loader()` on a
+    miss. Entries of different `suffix` (e.g. a query string) are cached separately.
+    """
+    cache = get_cache()
+    if cache is None:
+        return loader()
+
+    version = _versions(cache, scope, [pk])[pk]
+    key = _entry_key(name, scope, pk, version, suffix)
+    value = cache.get(key)
+    if value is not None:
+        _count(name, hits=1)
+        return value
+
+    _count(name, misses=1)
+    value = loader()
+    cache.set(key, value, timeout=_timeout())
+    return value
+
+
+def get_or_load_many(
+    name: str, scope: str, pks: Iterable[int], loader: Callable[[list], dict]
+) -> Dict[int, object]:
+    """
+    Returns `{pk: entry}` of the `name` entries of threads or users, loading the missing
+    ones by one `loader(missing_pks)` call.
+    """
+    pks = list(pks)
+    cache = get_cache()
+    if cache is None:
+        return loader(pks)
+
+    versions = _versions(cache, scope, pks)
+    keys = {_entry_key(name, scope, pk, versions[pk], ""): pk for pk in pks}
+    values = {keys[key]: value for key, value in cache.get_many(keys).items()}
+    missing = [pk for pk in pks if pk not in values]
+    _count(name, hits=len(values), misses=len(missing))
+    if missing:
+        loaded = loader(missing)
+        cache.set_many(
+            {
+                _entry_key(name, scope, pk, versions[pk], ""): loaded[pk]
+                for pk in loaded
+            },
+            timeout=_timeout(),
+        )
+        values.update(loaded)
+    return values
+
+
+def clear() -> None:
+    """
+    Drops every entry of the dialogs cache (e.g. between tests).
+    """
+    cache = get_cache()
+    if cache is not None:
+        cache.clear()
@@ -0,0 +1,208 @@
+"""
+Synthetic dialogs data for load tests and benchmarks.
+
+Rows are inserted in batches in one transaction (messages by a prepared statement),
+the users share one password hash computed once, and the same seed always generates
+the same data.
+"""
+import itertools
+import random
+from datetime import timedelta
+from typing import Dict, List
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from accounts.models import User
+from .models import Message, ParticipantSummary, Thread, ThreadSummary
+from .search import get_search_backend
+
+WORDS = (
+    "hello hi hey thanks ok sure yes no maybe today tomorrow tonight meeting call "
+    "lunch dinner coffee project deadline report review deploy release bug fix test "
+    "build server client database cache query index page thread message read send "
+    "please could would should will can see look check update later soon now great "
+    "good fine cool nice sorry busy free weekend monday friday morning evening"
+).split()
+
+
+def _cum_weights(count: int, skew: float) -> List[float]:
+    # Zipf-like: the n-th item is n ** skew times less likely than the first one
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+
+def _new_pks(model, after_pk: int) -> List[int]:
+    # ids of the rows inserted after `after_pk`, the transaction keeps them ours
+    return list(
+        model.objects.filter(pk__gt=after_pk)
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+
+
+def _insert_messages(rows: List[tuple]) -> None:
+    """
+    Inserts `(text, thread_id, sender_id, created_at, updated_at)` rows by one
+    prepared statement. `bulk_create` compiles every value of every row in Python,
+    which takes minutes for millions of messages.
+    """
+    quote_name = connection.ops.quote_name
+    columns = ", ".join(
+        quote_name(Message._meta.get_field(name).column)
+        for name in ("text", "thread", "sender", "created_at", "updated_at")
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {quote_name(Message._meta.db_table)} ({columns}) "
+            "VALUES (%s, %s, %s, %s, %s)",
+            rows,
+        )
+
+
+def _max_pk(model) -> int:
+    return model.objects.aggregate(pk=Max("pk"))["pk"] or 0
+
+
+@transaction.atomic
+def generate_dataset(
+    users: int,
+    threads: int,
+    messages_per_thread: int,
+    seed: int = 0,
+    skew: float = 1.0,
+    read_ratio: float = 0.9,
+    days: int = 30,
+    password: str = "password",
+    prefix: str = "user",
+    batch_size: int = 10000,
+) -> Dict[str, list]:
+    """
+    Generates `users` users (`{prefix}{i}`, all with `password`), `threads` two-party
+    threads and `threads * messages_per_thread` messages sent over the last `days`.
+
+    Activity is skewed by `skew`: a few users take part in most of the threads and
+    a few threads get most of the messages. `read_ratio` of the participants have
+    read their threads to the end, the others stopped somewhere in the middle.
+    Returns the ids of the created users and threads.
+    """
+    if users < 2:
+        raise ValueError("At least 2 users are needed")
+    if threads > users * (users - 1) // 2:
+        raise ValueError(f"{users} users can't have {threads} two-party threads")
+    rng = random.Random(seed)
+
+    # users, one hash for all of them
+    password_hash = make_password(password)
+    max_user_pk = _max_pk(User)
+    User.objects.bulk_create(
+        [
+            User(
+                username=f"{prefix}{i}",
+                email=f"{prefix}{i}@example.com",
+                password=password_hash,
+            )
+            for i in range(users)
+        ],
+        batch_size=batch_size,
+    )
+    user_ids = _new_pks(User, max_user_pk)
+
+    # two-party threads, popular users take part in more of them
+    user_weights = _cum_weights(users, skew)
+    pairs = set()
+    while len(pairs) < threads:
+        first, second = rng.choices(user_ids, cum_weights=user_weights, k=2)
+        if first == second:
+            # the most popular users may have talked to everybody already
+            second = rng.choice(user_ids)
+        if first != second:
+            pairs.add((min(first, second), max(first, second)))
+    pairs = sorted(pairs)
+    rng.shuffle(pairs)
+
+    max_thread_pk = _max_pk(Thread)
+    Thread.objects.bulk_create(
+        [Thread(participants_key=Thread.make_participants_key(pair)) for pair in pairs],
+        batch_size=batch_size,
+    )
+    thread_ids = _new_pks(Thread, max_thread_pk)
+    Thread.participants.through.objects.bulk_create(
+        [
+            Thread.participants.through(thread_id=thread_id, user_id=user_id)
+            for thread_id, pair in zip(thread_ids, pairs)
+            for user_id in pair
+        ],
+        batch_size=batch_size,
+    )
+
+    # messages, a few threads get most of them, sent evenly over the last `days`
+    thread_order = rng.choices(
+        range(threads),
+        cum_weights=_cum_weights(threads, skew),
+        k=threads * messages_per_thread,
+    )
+    started_at = timezone.now() - timedelta(days=days)
+    step = timedelta(days=days) / max(1, len(thread_order))
+    Thread.objects.filter(pk__in=thread_ids).update(
+        created_at=started_at, updated_at=started_at
+    )
+    adapt_datetime = connection.ops.adapt_datetimefield_value
+    max_message_pk = _max_pk(Message)
+    senders = []
+    for start in range(0, len(thread_order), batch_size):
+        rows = []
+        for position in range(start, min(start + batch_size, len(thread_order))):
+            index = thread_order[position]
+            senders.append(pairs[index][rng.randrange(2)])
+            sent_at = adapt_datetime(started_at + step * (position + 1))
+            rows.append(
+                (
+                    " ".join(rng.choices(WORDS, k=rng.randint(1, 12))),
+                    thread_ids[index],
+                    senders[-1],
+                    sent_at,
+                    sent_at,
+                )
+            )
+        _insert_messages(rows)
+    message_ids = _new_pks(Message, max_message_pk)
+
+    # summaries, from the generated data rather than by `rebuild_thread_summaries`
+    thread_positions = [[] for _ in range(threads)]
+    for position, index in enumerate(thread_order):
+        thread_positions[index].append(position)
+    thread_summaries, participant_summaries = [], []
+    for thread_id, pair, positions in zip(thread_ids, pairs, thread_positions):
+        last_message_at = started_at + step * (positions[-1] + 1) if positions else None
+        thread_summaries.append(
+            ThreadSummary(
+                thread_id=thread_id,
+                last_message_id=message_ids[positions[-1]] if positions else None,
+                last_message_at=last_message_at,
+                last_activity=last_message_at or started_at,
+                message_count=len(positions),
+            )
+        )
+        for user_id in pair:
+            # the participant read the thread up to the `read` first messages
+            read = len(positions)
+            if positions and rng.random() >= read_ratio:
+                read = rng.randrange(len(positions))
+            participant_summaries.append(
+                ParticipantSummary(
+                    thread_id=thread_id,
+                    user_id=user_id,
+                    last_read_message_id=(
+                        message_ids[positions[read - 1]] if read else 0
+                    ),
+                    unread_count=sum(
+                        senders[position] != user_id for position in positions[read:]
+                    ),
+                )
+            )
+    ThreadSummary.objects.bulk_create(thread_summaries, batch_size=batch_size)
+    ParticipantSummary.objects.bulk_create(participant_summaries, batch_size=batch_size)
+    get_search_backend().rebuild()
+    return {"users": user_ids, "threads": thread_ids}
@@ -0,0 +1,105 @@
+"""
+Events about thread changes pushed to the participants through `pubsub`.
+
+Events are published once the surrounding transaction commits, so subscribers never
+learn about changes which were rolled back or aren't visible to them yet.
+"""
+from typing import List
+
+from django.db import transaction
+
+from .models import Message, ParticipantSummary
+from .pubsub import get_pubsub, user_channel
+
+MESSAGE_CREATED = "message.created"
+MESSAGE_UPDATED = "message.updated"
+MESSAGE_DELETED = "message.deleted"
+MESSAGES_READ = "messages.read"
+
+
+def _participant_ids(thread_pk: int) -> List[int]:
+    return list(
+        ParticipantSummary.objects.filter(thread_id=thread_pk).values_list(
+            "user_id", flat=True
+        )
+    )
+
+
+def _publish_to_participants(thread_pk: int, event: dict, user_ids=None) -> None:
+    if user_ids is None:
+        user_ids = _participant_ids(thread_pk)
+
+    def publish():
+        pubsub = get_pubsub()
+        for user_id in user_ids:
+            pubsub.publish(user_channel(user_id), event)
+
+    transaction.on_commit(publish)
+
+
+def _message_payload(message: Message) -> dict:
+    return {
+        "id": message.pk,
+        "text": message.text,
+        "sender": message.sender_id,
+        "thread": message.thread_id,
+    }
+
+
+def messages_created(thread_pk: int, messages: List[Message]) -> None:
+    user_ids = _participant_ids(thread_pk)
+    for message in messages:
+        _publish_to_participants(
+            thread_pk,
+            {
+                "type": MESSAGE_CREATED,
+                "thread": thread_pk,
+                "message": _message_payload(message),
+            },
+            user_ids=user_ids,
+        )
+
+
+def message_updated(message: Message) -> None:
+    _publish_to_participants(
+        message.thread_id,
+        {
+            "type": MESSAGE_UPDATED,
+            "thread": message.thread_id,
+            "message": _message_payload(message),
+        },
+    )
+
+
+def message_deleted(thread_pk: int, message_pk: int) -> None:
+    _publish_to_participants(
+        thread_pk,
+        {"type": MESSAGE_DELETED, "thread": thread_pk, "message": {"id": message_pk}},
+    )
+
+
+def messages_read(thread_pk: int, user_id: int) -> None:
+    messages_read_in_threads([thread_pk], user_id)
+
+
+def messages_read_in_threads(thread_pks: List[int], user_id: int) -> None:
+    """
+    Notifies the participants of the threads the user has moved the read watermark in.
+    """
+    watermarks = {thread_pk: {} for thread_pk in thread_pks}
+    for thread_id, participant_id, watermark in ParticipantSummary.objects.filter(
+        thread_id__in=thread_pks
+    ).values_list("thread_id", "user_id", "last_read_message_id"):
+        watermarks[thread_id][participant_id] = watermark
+
+    for thread_pk, thread_watermarks in watermarks.items():
+        _publish_to_participants(
+            thread_pk,
+            {
+                "type": MESSAGES_READ,
+                "thread": thread_pk,
+                "user": user_id,
+                "last_read_message_id": thread_watermarks.get(user_id, 0),
+            },
+            user_ids=list(thread_watermarks),
+        )
@@ -0,0 +1,43 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from dialogs.services import archive_messages
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves messages older than the given age, read by every participant, "
+        "to the archive table in chunks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.DIALOGS_ARCHIVE_AFTER_DAYS,
+            help="Age of the archived messages, days (default: %(default)s).",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Messages moved per transaction (default: %(default)s).",
+        )
+        parser.add_argument(
+            "--max-chunks",
+            type=int,
+            help="Stop after this many chunks (default: archive everything).",
+        )
+
+    def handle(self, *args, **options):
+        if options["days"] < 0 or options["chunk_size"] < 1:
+            raise CommandError("--days must not be negative, --chunk-size positive")
+
+        count = archive_messages(
+            created_before=timezone.now() - timedelta(days=options["days"]),
+            chunk_size=options["chunk_size"],
+            max_chunks=options["max_chunks"],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Archived {count} messages"))
@@ -0,0 +1,147 @@
+import time
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.utils import timezone
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
+
+from accounts.models import User
+from dialogs import caching
+from dialogs.benchmark import benchmark_database, format_table, measure, summarize
+from dialogs.models import ArchivedMessage, Message, ParticipantSummary, Thread
+from dialogs.services import archive_messages, rebuild_thread_summaries
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the hot message table size and message page latency before and "
+        "after archiving old messages (on a throwaway test database)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=50)
+        parser.add_argument(
+            "--old", type=int, default=2000, help="Old messages per thread."
+        )
+        parser.add_argument(
+            "--recent", type=int, default=50, help="Recent messages per thread."
+        )
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--repeat", type=int, default=50)
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            user, thread = self.create_dataset(
+                options["threads"], options["old"], options["recent"]
+            )
+            client = APIClient()
+            client.force_authenticate(user=user)
+            url = reverse("dialogs:message_list", args=[thread.pk])
+            # the 31st message of the thread, the oldest page precedes it
+            cursor = Message.objects.filter(thread=thread).order_by("pk")[30].pk
+            pages = (
+                ("latest", url + "?limit=30"),
+                # the oldest page, entirely archived after the archival
+                ("oldest", url + f"?limit=30&before={cursor}"),
+            )
+
+            rows = [self.measure_pages(client, pages, "before", options["repeat"])]
+            started_at = time.perf_counter()
+            archived = archive_messages(
+                created_before=timezone.now() - timedelta(days=1),
+                chunk_size=options["chunk_size"],
+            )
+            archive_time = time.perf_counter() - started_at
+            rows.append(self.measure_pages(client, pages, "after", options["repeat"]))
+
+        self.stdout.write(
+            format_table(
+                ["state", "hot messages", "archived"]
+                + [f"{name} p50, ms" for name, _ in pages]
+                + [f"{name} p95, ms" for name, _ in pages],
+                rows,
+            )
+        )
+        self.stdout.write("")
+        self.stdout.write(
+            f"Archived {archived} messages in {archive_time:.3f} s "
+            f"({round(archived / archive_time)} messages/s)"
+        )
+
+    def measure_pages(self, client, pages, state, repeat):
+        stats = []
+        for _, url in pages:
+
+            def request():
+                caching.clear()
+                response = client.get(url)
+                assert response.status_code == 200, response.content
+                assert len(response.data["results"]) == 30
+
+            stats.append(summarize(measure(request, repeat=repeat)))
+        return (
+            [state, Message.objects.count(), ArchivedMessage.objects.count()]
+            + [page_stats["p50"] for page_stats in stats]
+            + [page_stats["p95"] for page_stats in stats]
+        )
+
+    def create_dataset(self, thread_count, old_count, recent_count):
+        """
+        Creates a user with `thread_count` threads of `old_count` read messages sent
+        a year ago followed by `recent_count` messages sent now.
+        """
+        password = make_password(None)
+        user = User.objects.create(
+            username="benchmark", email="benchmark@example.com", password=password
+        )
+        User.objects.bulk_create(
+            [
+                User(
+                    username=f"interlocutor{i}",
+                    email=f"interlocutor{i}@example.com",
+                    password=password,
+                )
+                for i in range(thread_count)
+            ]
+        )
+        interlocutor_ids = list(
+            User.objects.exclude(pk=user.pk).order_by("pk").values_list("pk", flat=True)
+        )
+
+        Thread.objects.bulk_create([Thread() for _ in range(thread_count)])
+        thread_ids = list(Thread.objects.order_by("pk").values_list("pk", flat=True))
+        Thread.participants.through.objects.bulk_create(
+            [
+                Thread.participants.through(thread_id=thread_id, user_id=user_id)
+                for thread_id, interlocutor_id in zip(thread_ids, interlocutor_ids)
+                for user_id in (user.pk, interlocutor_id)
+            ],
+            batch_size=1000,
+        )
+        for count in (old_count, recent_count):
+            Message.objects.bulk_create(
+                [
+                    Message(
+                        text=f"message {i}",
+                        thread_id=thread_id,
+                        sender_id=interlocutor_id,
+                    )
+                    for i in range(count)
+                    for thread_id, interlocutor_id in zip(thread_ids, interlocutor_ids)
+                ],
+                batch_size=1000,
+            )
+            if count == old_count:
+                Message.objects.update(created_at=timezone.now() - timedelta(days=365))
+
+        # every message but the recent ones is read
+        rebuild_thread_summaries()
+        last_old_pk = Message.objects.filter(
+            created_at__lt=timezone.now() - timedelta(days=1)
+        ).aggregate(pk=Max("pk"))["pk"]
+        ParticipantSummary.objects.update(last_read_message_id=last_old_pk)
+        rebuild_thread_summaries()
+        return user, Thread.objects.get(pk=thread_ids[0])
@@ -0,0 +1,245 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
+from rest_framework_jwt.settings import api_settings
+
+from accounts.models import User
+from dialogs.benchmark import benchmark_database, format_table, summarize
+from dialogs.dataset import generate_dataset
+from dialogs.models import ParticipantSummary, ThreadSummary
+from yalantis_django.asgi import AsyncURLConfHandler
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares how many concurrent connections WSGI and ASGI serve: opens "
+        "--connections long-polls waiting for new messages and measures the latency "
+        "of message list requests made meanwhile (on a throwaway test database). "
+        "WSGI is served by a pool of --workers threads as by a threaded server, ASGI "
+        "by the async views in an event loop with as many database threads."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--connections", type=int, nargs="+", default=[10, 50, 200, 1000]
+        )
+        parser.add_argument("--workers", type=int, default=8)
+        parser.add_argument(
+            "--timeout", type=float, default=2.0, help="Long-poll timeout, seconds."
+        )
+        parser.add_argument(
+            "--probes", type=int, default=20, help="Message list requests per run."
+        )
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--threads", type=int, default=1000)
+        parser.add_argument("--messages", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        # the debug toolbar is sync only, it would serve the async views in one thread
+        middleware = [
+            name
+            for name in settings.MIDDLEWARE
+            if not name.startswith("debug_toolbar.")
+        ]
+        rows = []
+        with benchmark_database(), override_settings(
+            MIDDLEWARE=middleware, DIALOGS_ASYNC_DB_WORKERS=options["workers"]
+        ):
+            generate_dataset(
+                users=options["users"],
+                threads=options["threads"],
+                messages_per_thread=options["messages"],
+                seed=options["seed"],
+            )
+            participants = self.get_participants(max(options["connections"]))
+            for connections in options["connections"]:
+                for server, run in (("WSGI", self.run_wsgi), ("ASGI", self.run_asgi)):
+                    polls, probes, errors = run(
+                        participants, connections, options["timeout"], options
+                    )
+                    probes = summarize(probes)
+                    rows.append(
+                        [
+                            server,
+                            connections,
+                            probes["p50"],
+                            probes["p95"],
+                            probes["max"],
+                            round(max(polls), 2),
+                            errors,
+                        ]
+                    )
+
+        self.stdout.write(
+            format_table(
+                ["server", "connections", "list p50, ms", "list p95, ms"]
+                + ["list max, ms", "all polls done in, s", "errors"],
+                rows,
+            )
+        )
+
+    def get_participants(self, count):
+        """
+        Returns `(token, thread_id, last_message_id)` of `count` participants (fewer
+        if there aren't as many), cycled through by the runs.
+        """
+        payload_handler = api_settings.JWT_PAYLOAD_HANDLER
+        encode_handler = api_settings.JWT_ENCODE_HANDLER
+        users = {user.pk: user for user in User.objects.all()}
+        last_message_ids = dict(
+            ThreadSummary.objects.values_list("thread_id", "last_message_id")
+        )
+        return [
+            (
+                encode_handler(payload_handler(users[user_id])),
+                thread_id,
+                last_message_ids.get(thread_id) or 0,
+            )
+            for thread_id, user_id in ParticipantSummary.objects.order_by(
+                "pk"
+            ).values_list("thread_id", "user_id")[:count]
+        ]
+
+    @staticmethod
+    def requests(participants, connections, probes):
+        """
+        Returns the `(token, thread_id, last_message_id)` of the long-polls and of
+        the message lists of a run.
+        """
+        return (
+            [participants[i % len(participants)] for i in range(connections)],
+            [participants[i % len(participants)] for i in range(probes)],
+        )
+
+    @staticmethod
+    def results(started_at, polls, probes):
+        """
+        Returns the durations (seconds, from `started_at`) of the long-polls, the
+        latencies of the message lists and the number of failed requests, from
+        `(finished_at, status)` of the long-polls and `(sent_at, (finished_at,
+        status))` of the message lists.
+        """
+        return (
+            [finished_at - started_at for finished_at, _ in polls],
+            [finished_at - sent_at for sent_at, (finished_at, _) in probes],
+            sum(
+                status_code != 200
+                for _, status_code in polls + [result for _, result in probes]
+            ),
+        )
+
+    def run_wsgi(self, participants, connections, timeout, options):
+        polls, probes = self.requests(participants, connections, options["probes"])
+        clients = threading.local()
+
+        def call(path, data, token):
+            if not hasattr(clients, "client"):
+                clients.client = APIClient()
+            response = clients.client.get(path, data, HTTP_AUTHORIZATION=f"JWT {token}")
+            return time.perf_counter(), response.status_code
+
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            poll_futures = [
+                executor.submit(
+                    call,
+                    reverse("dialogs:messages_since"),
+                    {"thread": thread_id, "since": last_id, "timeout": timeout},
+                    token,
+                )
+                for token, thread_id, last_id in polls
+            ]
+            probe_futures = [
+                (
+                    time.perf_counter(),
+                    executor.submit(
+                        call,
+                        reverse("dialogs:message_list", args=[thread_id]),
+                        {"limit": 30},
+                        token,
+                    ),
+                )
+                for token, thread_id, _ in probes
+            ]
+        return self.results(
+            started_at,
+            [future.result() for future in poll_futures],
+            [(sent_at, future.result()) for sent_at, future in probe_futures],
+        )
+
+    def run_asgi(self, participants, connections, timeout, options):
+        polls, probes = self.requests(participants, connections, options["probes"])
+        return asyncio.run(self.run_asgi_requests(polls, probes, timeout))
+
+    async def run_asgi_requests(self, polls, probes, timeout):
+        handler = AsyncURLConfHandler()
+
+        async def call(path, data, token):
+            status_code = await self.asgi_get(handler, path, data, token)
+            return time.perf_counter(), status_code
+
+        started_at = time.perf_counter()
+        poll_tasks = [
+            asyncio.ensure_future(
+                call(
+                    reverse("dialogs:message_list", args=[thread_id]),
+                    {"after": last_id, "timeout": timeout},
+                    token,
+                )
+            )
+            for token, thread_id, last_id in polls
+        ]
+        probe_tasks = [
+            (
+                time.perf_counter(),
+                asyncio.ensure_future(
+                    call(
+                        reverse("dialogs:message_list", args=[thread_id]),
+                        {"limit": 30},
+                        token,
+                    )
+                ),
+            )
+            for token, thread_id, _ in probes
+        ]
+        await asyncio.gather(*poll_tasks, *(task for _, task in probe_tasks))
+        return self.results(
+            started_at,
+            [task.result() for task in poll_tasks],
+            [(sent_at, task.result()) for sent_at, task in probe_tasks],
+        )
+
+    @staticmethod
+    async def asgi_get(handler, path, data, token):
+        """
+        Serves a GET request by the ASGI `handler`, returns the response status.
+        """
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": path,
+            "query_string": urlencode(data).encode(),
+            "headers": [
+                (b"host", b"testserver"),
+                (b"authorization", f"JWT {token}".encode()),
+            ],
+        }
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            sent.append(message)
+
+        await handler(scope, receive, send)
+        return sent[0]["status"]
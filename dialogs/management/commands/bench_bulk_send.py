@@ -0,0 +1,84 @@
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
+
+from accounts.models import User
+from dialogs.benchmark import benchmark_database, format_table
+from dialogs.services import get_or_create_thread
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares messages/second sent one by one through the message list endpoint "
+        "and in batches through the bulk endpoint (on a throwaway test database)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument("--batch", type=int, default=100, help="Batch size.")
+        parser.add_argument(
+            "--threads", type=int, default=1, help="Threads the messages are sent to."
+        )
+
+    def handle(self, *args, **options):
+        count, batch_size = options["messages"], options["batch"]
+
+        with benchmark_database():
+            sender, threads = self.create_dataset(options["threads"])
+            client = APIClient()
+            client.force_authenticate(user=sender)
+            items = [
+                {"thread": threads[i % len(threads)].pk, "text": f"message {i}"}
+                for i in range(count)
+            ]
+
+            started_at = time.perf_counter()
+            for item in items:
+                response = client.post(
+                    reverse("dialogs:message_list", args=[item["thread"]]),
+                    {"text": item["text"]},
+                )
+                assert response.status_code == 201, response.content
+            single_time = time.perf_counter() - started_at
+
+            url = reverse("dialogs:message_bulk_create")
+            started_at = time.perf_counter()
+            for start in range(0, count, batch_size):
+                end = start + batch_size
+                response = client.post(
+                    url, {"messages": items[start:end]}, format="json"
+                )
+                assert response.status_code == 201, response.content
+            batch_time = time.perf_counter() - started_at
+
+        rows = [
+            ["single", 1, count, round(single_time, 3), round(count / single_time)],
+            [
+                "batch",
+                batch_size,
+                count,
+                round(batch_time, 3),
+                round(count / batch_time),
+            ],
+        ]
+        self.stdout.write(
+            format_table(["mode", "batch", "messages", "time, s", "messages/s"], rows)
+        )
+
+    def create_dataset(self, thread_count):
+        password = make_password(None)
+        users = [
+            User.objects.create(
+                username=f"user{i}", email=f"user{i}@example.com", password=password
+            )
+            for i in range(thread_count + 1)
+        ]
+        sender = users[0]
+        threads = [
+            get_or_create_thread([sender, interlocutor])[0]
+            for interlocutor in users[1:]
+        ]
+        return sender, threads
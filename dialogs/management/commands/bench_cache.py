@@ -0,0 +1,119 @@
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
+
+from accounts.models import User
+from dialogs import caching
+from dialogs.benchmark import benchmark_database, format_table, measure, summarize
+from dialogs.models import Message, Thread
+from dialogs.services import rebuild_thread_summaries
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares latency of cold (empty cache) and warm inbox and message list "
+        "requests (on a throwaway test database)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=100)
+        parser.add_argument(
+            "--messages", type=int, default=20, help="Messages per thread."
+        )
+        parser.add_argument("--repeat", type=int, default=50)
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            user, thread = self.create_dataset(options["threads"], options["messages"])
+            client = APIClient()
+            client.force_authenticate(user=user)
+
+            rows = []
+            for name, url in (
+                ("inbox", reverse("dialogs:thread_list") + "?limit=30"),
+                (
+                    "messages",
+                    reverse("dialogs:message_list", args=[thread.pk]) + "?limit=30",
+                ),
+            ):
+                for state in ("cold", "warm"):
+
+                    def request():
+                        if state == "cold":
+                            caching.clear()
+                        response = client.get(url)
+                        assert response.status_code == 200, response.content
+
+                    # requests reset the query log, the capture must start empty
+                    reset_queries()
+                    with CaptureQueriesContext(connection) as context:
+                        request()
+                    queries = len(context)
+                    stats = summarize(measure(request, repeat=options["repeat"]))
+                    rows.append([name, state, queries] + list(stats.values()))
+
+        self.stdout.write(
+            format_table(["endpoint", "cache", "queries"] + list(stats), rows)
+        )
+        self.stdout.write("")
+        self.stdout.write(
+            format_table(
+                ["entry", "hits", "misses"],
+                [
+                    [name, counters["hits"], counters["misses"]]
+                    for name, counters in caching.get_stats().items()
+                ],
+            )
+        )
+
+    def create_dataset(self, thread_count, message_count):
+        """
+        Creates a user with `thread_count` threads of `message_count` messages each.
+        """
+        password = make_password(None)
+        user = User.objects.create(
+            username="benchmark", email="benchmark@example.com", password=password
+        )
+        interlocutors = User.objects.bulk_create(
+            [
+                User(
+                    username=f"interlocutor{i}",
+                    email=f"interlocutor{i}@example.com",
+                    password=password,
+                )
+                for i in range(thread_count)
+            ]
+        )
+        interlocutor_ids = list(
+            User.objects.exclude(pk=user.pk)
+            .order_by("pk")
+            .values_list("pk", flat=True)[: len(interlocutors)]
+        )
+
+        Thread.objects.bulk_create(
+            [Thread() for _ in range(thread_count)], batch_size=1000
+        )
+        thread_ids = list(Thread.objects.order_by("pk").values_list("pk", flat=True))
+        Thread.participants.through.objects.bulk_create(
+            [
+                Thread.participants.through(thread_id=thread_id, user_id=user_id)
+                for thread_id, interlocutor_id in zip(thread_ids, interlocutor_ids)
+                for user_id in (user.pk, interlocutor_id)
+            ],
+            batch_size=1000,
+        )
+        Message.objects.bulk_create(
+            [
+                Message(
+                    text=f"message {i}", thread_id=thread_id, sender_id=interlocutor_id
+                )
+                for thread_id, interlocutor_id in zip(thread_ids, interlocutor_ids)
+                for i in range(message_count)
+            ],
+            batch_size=1000,
+        )
+        rebuild_thread_summaries()
+        return user, Thread.objects.get(pk=thread_ids[0])
@@ -0,0 +1,258 @@
+import json
+import logging
+import random
+import statistics
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
+from rest_framework_jwt.settings import api_settings
+
+from accounts.models import User
+from dialogs.benchmark import (
+    benchmark_database,
+    format_table,
+    measure_concurrently,
+    summarize,
+)
+from dialogs.dataset import generate_dataset
+from dialogs.models import ParticipantSummary, ThreadSummary
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-tests the dialogs API in process with a pool of concurrent clients "
+        "over a generated dataset (on a throwaway test database) and reports "
+        "latency, throughput and queries per request of every endpoint."
+    )
+
+    # every endpoint has a `request_<name>` method building its requests
+    endpoints = ("thread_list", "message_list", "message_create", "read_until", "login")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--threads", type=int, default=5000)
+        parser.add_argument(
+            "--messages", type=int, default=20, help="Messages per thread, on average."
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--requests", type=int, default=500, help="Requests per endpoint."
+        )
+        parser.add_argument(
+            "--login-requests",
+            type=int,
+            default=50,
+            help="Requests of the login endpoint, each one hashes a password.",
+        )
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument(
+            "--endpoint",
+            action="append",
+            dest="endpoint_names",
+            choices=self.endpoints,
+            help="Endpoint to load, can be passed several times (default: all).",
+        )
+        parser.add_argument("--output", help="JSON file the results are written to.")
+        parser.add_argument(
+            "--baseline", help="JSON results of an earlier run to compare with."
+        )
+
+    def handle(self, *args, **options):
+        results = {
+            "options": {
+                name: options[name]
+                for name in (
+                    "users",
+                    "threads",
+                    "messages",
+                    "seed",
+                    "requests",
+                    "login_requests",
+                    "concurrency",
+                )
+            },
+            "endpoints": {},
+        }
+        with benchmark_database():
+            generate_dataset(
+                users=options["users"],
+                threads=options["threads"],
+                messages_per_thread=options["messages"],
+                seed=options["seed"],
+            )
+            participants = self.get_participants(options["seed"])
+            clients = threading.local()
+
+            for name in options["endpoint_names"] or self.endpoints:
+                calls = options["login_requests" if name == "login" else "requests"]
+                build_request = getattr(self, f"request_{name}")
+                workload = self.get_workload(name, participants)
+                errors = []
+
+                def request(i):
+                    if not hasattr(clients, "client"):
+                        clients.client = APIClient()
+                    method, url, data, token = build_request(
+                        workload[i % len(workload)]
+                    )
+                    extra = {"HTTP_AUTHORIZATION": f"JWT {token}"} if token else {}
+                    try:
+                        response = getattr(clients.client, method)(url, data, **extra)
+                    except Exception as e:
+                        # failures (e.g. database errors) are counted as errors
+                        errors.append(type(e).__name__)
+                        return
+                    if response.status_code >= 400:
+                        errors.append(str(response.status_code))
+
+                with self.quiet_request_log():
+                    run = measure_concurrently(request, calls, options["concurrency"])
+                results["endpoints"][name] = {
+                    "requests": calls,
+                    "errors": dict(Counter(errors)),
+                    "requests_per_second": round(calls / run["elapsed"], 1),
+                    "latency_ms": summarize(run["samples"]),
+                    "queries": {
+                        "mean": round(statistics.mean(run["queries"]), 2),
+                        "max": max(run["queries"]),
+                    },
+                }
+
+        endpoints = results["endpoints"]
+        self.stdout.write(
+            format_table(
+                ["endpoint", "requests", "errors", "req/s", "p50, ms", "p95, ms"]
+                + ["p99, ms", "queries", "max queries"],
+                [
+                    [
+                        name,
+                        result["requests"],
+                        sum(result["errors"].values()),
+                        result["requests_per_second"],
+                        result["latency_ms"]["p50"],
+                        result["latency_ms"]["p95"],
+                        result["latency_ms"]["p99"],
+                        result["queries"]["mean"],
+                        result["queries"]["max"],
+                    ]
+                    for name, result in endpoints.items()
+                ],
+            )
+        )
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                self.compare(json.load(f)["endpoints"], endpoints)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+                f.write("\n")
+
+    @staticmethod
+    @contextmanager
+    def quiet_request_log():
+        # failed requests are counted, logging every traceback would flood the output
+        logger = logging.getLogger("django.request")
+        level = logger.level
+        logger.setLevel(logging.CRITICAL)
+        try:
+            yield
+        finally:
+            logger.setLevel(level)
+
+    def compare(self, baseline, endpoints):
+        """
+        Prints the changes against the `baseline` results, more queries per request
+        are flagged as regressions.
+        """
+        rows = []
+        for name, result in endpoints.items():
+            before = baseline.get(name)
+            if before is None:
+                continue
+
+            p95, p95_before = result["latency_ms"]["p95"], before["latency_ms"]["p95"]
+            queries, queries_before = result["queries"]["max"], before["queries"]["max"]
+            rows.append(
+                [
+                    name,
+                    f"{p95_before} -> {p95}",
+                    f"{(p95 - p95_before) / p95_before * 100:+.1f}%",
+                    f"{queries_before} -> {queries}",
+                    "REGRESSION" if queries > queries_before else "",
+                ]
+            )
+        self.stdout.write("")
+        self.stdout.write(
+            format_table(["endpoint", "p95, ms", "change", "max queries", ""], rows)
+        )
+
+    def get_participants(self, seed):
+        """
+        Returns `(user, token, thread_id, last_message_id)` of every participant of
+        every thread in a random (seeded) order, `last_message_id` is `None` when the
+        thread has no messages.
+        """
+        payload_handler = api_settings.JWT_PAYLOAD_HANDLER
+        encode_handler = api_settings.JWT_ENCODE_HANDLER
+        users = {user.pk: user for user in User.objects.all()}
+        tokens = {}
+        last_message_ids = dict(
+            ThreadSummary.objects.values_list("thread_id", "last_message_id")
+        )
+        participants = []
+        for thread_id, user_id in ParticipantSummary.objects.order_by("pk").values_list(
+            "thread_id", "user_id"
+        ):
+            if user_id not in tokens:
+                tokens[user_id] = encode_handler(payload_handler(users[user_id]))
+            participants.append(
+                (
+                    users[user_id],
+                    tokens[user_id],
+                    thread_id,
+                    last_message_ids.get(thread_id),
+                )
+            )
+        random.Random(seed).shuffle(participants)
+        return participants
+
+    def get_workload(self, name, participants):
+        """
+        Returns the participants making the requests of the `name` endpoint.
+        """
+        if name == "read_until":
+            # only the threads with messages have a message to read until
+            return [
+                participant
+                for participant in participants
+                if participant[3] is not None
+            ]
+        return participants
+
+    def request_thread_list(self, participant):
+        _, token, _, _ = participant
+        return "get", reverse("dialogs:thread_list"), {"limit": 30}, token
+
+    def request_message_list(self, participant):
+        _, token, thread_id, _ = participant
+        url = reverse("dialogs:message_list", args=[thread_id])
+        return "get", url, {"limit": 30}, token
+
+    def request_message_create(self, participant):
+        _, token, thread_id, _ = participant
+        url = reverse("dialogs:message_list", args=[thread_id])
+        return "post", url, {"text": "load test message"}, token
+
+    def request_read_until(self, participant):
+        _, token, thread_id, last_message_id = participant
+        url = reverse("dialogs:messages_read_until", args=[thread_id])
+        return "post", url, {"message_id": last_message_id}, token
+
+    def request_login(self, participant):
+        user, _, _, _ = participant
+        data = {"email": user.email, "password": "password"}
+        return "post", reverse("get_auth_token"), data, None
@@ -0,0 +1,123 @@
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
+
+from accounts.models import User
+from dialogs.benchmark import benchmark_database, format_table, measure, summarize
+from dialogs.models import Message, Thread
+from dialogs.pagination import ThreadPagination
+from dialogs.services import rebuild_thread_summaries
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares latency of the first and a deep page of messages and threads "
+        "under page number and keyset pagination (on a throwaway test database)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--page", type=int, default=1000, help="Deep page number.")
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        page = options["page"]
+        page_size = settings.REST_FRAMEWORK["PAGE_SIZE"]
+        size = page * page_size
+
+        with benchmark_database():
+            user, thread = self.create_dataset(size)
+            client = APIClient()
+            client.force_authenticate(user=user)
+
+            message_list_url = reverse("dialogs:message_list", args=[thread.pk])
+            message_ids = list(
+                Message.objects.filter(thread=thread)
+                .order_by("pk")
+                .values_list("pk", flat=True)
+            )
+            thread_list_url = reverse("dialogs:thread_list")
+            # the item preceding the deep page
+            preceding_thread = (
+                Thread.objects.filter(participants=user)
+                .with_inbox_data(user)
+                .order_by("-last_activity", "-pk")[size - page_size - 1]
+            )
+            thread_cursor = ThreadPagination().encode_cursor(preceding_thread)
+
+            cases = [
+                ("messages", "page number", "1", message_list_url, {"page": 1}),
+                ("messages", "page number", page, message_list_url, {"page": page}),
+                ("messages", "keyset", "1", message_list_url, {"limit": page_size}),
+                (
+                    "messages",
+                    "keyset",
+                    page,
+                    message_list_url,
+                    {"limit": page_size, "after": message_ids[size - page_size - 1]},
+                ),
+                ("threads", "page number", "1", thread_list_url, {"page": 1}),
+                ("threads", "page number", page, thread_list_url, {"page": page}),
+                ("threads", "keyset", "1", thread_list_url, {"limit": page_size}),
+                (
+                    "threads",
+                    "keyset",
+                    page,
+                    thread_list_url,
+                    {"limit": page_size, "after": thread_cursor},
+                ),
+            ]
+
+            rows = []
+            for resource, paginator, page_number, url, params in cases:
+                response = client.get(url, params)
+                assert response.status_code == 200, response.content
+                assert len(response.json()["results"]) == page_size
+
+                stats = summarize(
+                    measure(lambda: client.get(url, params), repeat=options["repeat"])
+                )
+                rows.append(
+                    [resource, paginator, page_number, stats["p50"], stats["p95"]]
+                )
+
+        self.stdout.write(
+            format_table(["resource", "paginator", "page", "p50, ms", "p95, ms"], rows)
+        )
+
+    def create_dataset(self, size):
+        """
+        Creates a user with `size` threads, one of which contains `size` messages.
+        """
+        password = make_password(None)
+        user = User.objects.create(
+            username="benchmark", email="benchmark@example.com", password=password
+        )
+        interlocutor = User.objects.create(
+            username="interlocutor",
+            email="interlocutor@example.com",
+            password=password,
+        )
+
+        Thread.objects.bulk_create([Thread() for _ in range(size)], batch_size=1000)
+        thread_ids = list(Thread.objects.order_by("pk").values_list("pk", flat=True))
+        Thread.participants.through.objects.bulk_create(
+            [
+                Thread.participants.through(thread_id=thread_id, user_id=user_id)
+                for thread_id in thread_ids
+                for user_id in (user.pk, interlocutor.pk)
+            ],
+            batch_size=1000,
+        )
+
+        thread = Thread.objects.get(pk=thread_ids[0])
+        Message.objects.bulk_create(
+            [
+                Message(text=f"message {i}", thread=thread, sender=interlocutor)
+                for i in range(size)
+            ],
+            batch_size=1000,
+        )
+        rebuild_thread_summaries()
+        return user, thread
@@ -0,0 +1,119 @@
+import itertools
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
+
+from accounts.models import User
+from dialogs.benchmark import benchmark_database, format_table, measure, summarize
+from dialogs.models import Message, Thread
+from dialogs.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares search latency of the FTS5 index and of scanning the messages "
+        "over a generated corpus (on a throwaway test database)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=1000000)
+        parser.add_argument("--threads", type=int, default=100)
+        parser.add_argument("--words", type=int, default=10000, help="Vocabulary size.")
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument(
+            "--scan-repeat",
+            type=int,
+            default=3,
+            help="Repeats of the (slow) searches without the index.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        words = [f"word{i}" for i in range(options["words"])]
+        queries = (
+            ("common word", words[0]),
+            ("rare word", words[-1]),
+            ("two words", f"{words[1]} {words[2]}"),
+        )
+
+        with benchmark_database():
+            user = self.create_dataset(
+                options["messages"], options["threads"], words, options["seed"]
+            )
+            started_at = time.perf_counter()
+            get_search_backend().rebuild()
+            index_time = time.perf_counter() - started_at
+
+            client = APIClient()
+            client.force_authenticate(user=user)
+            url = reverse("dialogs:message_search")
+            rows = []
+            for backend, repeat in (
+                ("dialogs.search.SQLiteFTS5SearchBackend", options["repeat"]),
+                ("dialogs.search.DatabaseSearchBackend", options["scan_repeat"]),
+            ):
+                with override_settings(DIALOGS_SEARCH_BACKEND=backend):
+                    for name, query in queries:
+
+                        def request():
+                            response = client.get(url, {"q": query, "limit": 20})
+                            assert response.status_code == 200, response.content
+
+                        stats = summarize(measure(request, repeat=repeat, warmup=1))
+                        rows.append(
+                            [backend.rsplit(".", 1)[-1], name] + list(stats.values())
+                        )
+
+        self.stdout.write(
+            f"Indexed {options['messages']} messages in {index_time:.3f} s"
+        )
+        self.stdout.write("")
+        self.stdout.write(format_table(["backend", "query"] + list(stats), rows))
+
+    def create_dataset(self, message_count, thread_count, words, seed):
+        """
+        Creates a user with `thread_count` threads sharing `message_count` messages of
+        words picked with a Zipf-like skew, the first words being the most common.
+        """
+        rng = random.Random(seed)
+        password = make_password(None)
+        user = User.objects.create(
+            username="benchmark", email="benchmark@example.com", password=password
+        )
+        interlocutor = User.objects.create(
+            username="interlocutor",
+            email="interlocutor@example.com",
+            password=password,
+        )
+        Thread.objects.bulk_create([Thread() for _ in range(thread_count)])
+        thread_ids = list(Thread.objects.order_by("pk").values_list("pk", flat=True))
+        Thread.participants.through.objects.bulk_create(
+            [
+                Thread.participants.through(thread_id=thread_id, user_id=user_id)
+                for thread_id in thread_ids
+                for user_id in (user.pk, interlocutor.pk)
+            ]
+        )
+
+        cum_weights = list(
+            itertools.accumulate(1 / rank for rank in range(1, len(words) + 1))
+        )
+        batch_size = 10000
+        for start in range(0, message_count, batch_size):
+            count = min(batch_size, message_count - start)
+            Message.objects.bulk_create(
+                [
+                    Message(
+                        text=" ".join(rng.choices(words, cum_weights=cum_weights, k=8)),
+                        thread_id=thread_ids[(start + i) % thread_count],
+                        sender_id=(user.pk, interlocutor.pk)[i % 2],
+                    )
+                    for i in range(count)
+                ]
+            )
+        return user
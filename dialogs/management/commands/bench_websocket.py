@@ -0,0 +1,140 @@
+import asyncio
+import json
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from rest_framework_jwt.settings import api_settings
+
+from accounts.models import User
+from dialogs.benchmark import benchmark_database, format_table, summarize
+from dialogs.pubsub import get_pubsub, user_channel
+from yalantis_django.asgi import application
+
+jwt_payload_handler = api_settings.JWT_PAYLOAD_HANDLER
+jwt_encode_handler = api_settings.JWT_ENCODE_HANDLER
+
+
+class SimulatedSocket:
+    """
+    In-memory WebSocket client driving the ASGI application directly.
+    """
+
+    def __init__(self, token):
+        self.scope = {
+            "type": "websocket",
+            "path": "/api/v1/dialogs/ws/",
+            "query_string": f"token={token}".encode(),
+            "headers": [],
+        }
+        self.incoming = asyncio.Queue()
+        self.accepted = asyncio.Event()
+        self.latencies = []
+        self.on_event = None
+
+    async def receive(self):
+        return await self.incoming.get()
+
+    async def send(self, message):
+        if message["type"] == "websocket.accept":
+            self.accepted.set()
+        elif message["type"] == "websocket.send":
+            event = json.loads(message["text"])
+            self.latencies.append(time.perf_counter() - event["sent_at"])
+            self.on_event()
+        elif message["type"] == "websocket.close":
+            raise RuntimeError(f"Connection refused: {message}")
+
+    def run(self):
+        self.incoming.put_nowait({"type": "websocket.connect"})
+        return asyncio.ensure_future(application(self.scope, self.receive, self.send))
+
+    def disconnect(self):
+        self.incoming.put_nowait({"type": "websocket.disconnect", "code": 1000})
+
+
+class Command(BaseCommand):
+    help = (
+        "Connects simulated WebSocket clients to the ASGI application and measures "
+        "event delivery latency (on a throwaway test database)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sockets", type=int, default=2000)
+        parser.add_argument(
+            "--rounds", type=int, default=20, help="Events published to every socket."
+        )
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            users = self.create_users(options["sockets"])
+            tokens = [jwt_encode_handler(jwt_payload_handler(user)) for user in users]
+            rows = asyncio.run(self.run(users, tokens, options["rounds"]))
+
+        self.stdout.write(format_table(["metric", "value"], rows))
+
+    async def run(self, users, tokens, rounds):
+        sockets = [SimulatedSocket(token) for token in tokens]
+        started_at = time.perf_counter()
+        tasks = [socket.run() for socket in sockets]
+        await asyncio.gather(*(socket.accepted.wait() for socket in sockets))
+        connect_time = time.perf_counter() - started_at
+
+        loop = asyncio.get_running_loop()
+        pending = 0
+        delivered = asyncio.Event()
+
+        def on_event():
+            nonlocal pending
+            pending -= 1
+            if not pending:
+                delivered.set()
+
+        for socket in sockets:
+            socket.on_event = on_event
+
+        def publish():
+            # published from a worker thread, like a WSGI view would do
+            pubsub = get_pubsub()
+            for user in users:
+                pubsub.publish(
+                    user_channel(user.pk),
+                    {"type": "benchmark", "sent_at": time.perf_counter()},
+                )
+
+        started_at = time.perf_counter()
+        for _ in range(rounds):
+            pending = len(sockets)
+            delivered.clear()
+            await loop.run_in_executor(None, publish)
+            await delivered.wait()
+        delivery_time = time.perf_counter() - started_at
+
+        for socket in sockets:
+            socket.disconnect()
+        await asyncio.gather(*tasks)
+
+        latencies = summarize(
+            [latency for socket in sockets for latency in socket.latencies]
+        )
+        return [
+            ["sockets", len(sockets)],
+            ["connect time, s", round(connect_time, 3)],
+            ["events delivered", len(sockets) * rounds],
+            ["events/s", round(len(sockets) * rounds / delivery_time)],
+        ] + [[f"latency {name}, ms", value] for name, value in latencies.items()]
+
+    def create_users(self, count):
+        password = make_password(None)
+        User.objects.bulk_create(
+            [
+                User(
+                    username=f"user{i}",
+                    email=f"user{i}@example.com",
+                    password=password,
+                )
+                for i in range(count)
+            ],
+            batch_size=1000,
+        )
+        return list(User.objects.order_by("pk"))
@@ -0,0 +1,64 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from dialogs.dataset import generate_dataset
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates users, two-party threads and messages with skewed activity "
+        "for load tests, the same seed always generates the same data."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--threads", type=int, default=10000)
+        parser.add_argument(
+            "--messages", type=int, default=100, help="Messages per thread, on average."
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--skew",
+            type=float,
+            default=1.0,
+            help="Zipf exponent of the user and thread activity (0: uniform).",
+        )
+        parser.add_argument(
+            "--read-ratio",
+            type=float,
+            default=0.9,
+            help="Share of the participants who read their threads to the end.",
+        )
+        parser.add_argument(
+            "--days", type=int, default=30, help="Period the messages are sent over."
+        )
+        parser.add_argument("--password", default="password")
+        parser.add_argument(
+            "--prefix", default="user", help="Prefix of the usernames and emails."
+        )
+
+    def handle(self, *args, **options):
+        started_at = time.perf_counter()
+        try:
+            dataset = generate_dataset(
+                users=options["users"],
+                threads=options["threads"],
+                messages_per_thread=options["messages"],
+                seed=options["seed"],
+                skew=options["skew"],
+                read_ratio=options["read_ratio"],
+                days=options["days"],
+                password=options["password"],
+                prefix=options["prefix"],
+            )
+        except ValueError as e:
+            raise CommandError(e)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Generated {len(dataset['users'])} users, "
+                f"{len(dataset['threads'])} threads and "
+                f"{options['threads'] * options['messages']} messages "
+                f"in {time.perf_counter() - started_at:.1f} s"
+            )
+        )
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from dialogs.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the full-text search index of the messages from scratch."
+
+    def handle(self, *args, **options):
+        count = get_search_backend().rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} messages"))
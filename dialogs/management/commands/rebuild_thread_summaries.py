@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from dialogs.services import check_thread_summaries, rebuild_thread_summaries
+
+
+class Command(BaseCommand):
+    help = "Rebuilds thread summaries from messages or checks them against messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Only report summaries which don't match messages.",
+        )
+        parser.add_argument(
+            "--thread",
+            type=int,
+            action="append",
+            dest="threads",
+            help="Thread id to process, can be passed several times (default: all).",
+        )
+
+    def handle(self, *args, **options):
+        if options["check"]:
+            errors = check_thread_summaries(thread_pks=options["threads"])
+            for error in errors:
+                self.stderr.write(error)
+            if errors:
+                raise CommandError(f"{len(errors)} summaries don't match messages")
+            self.stdout.write(self.style.SUCCESS("Thread summaries are consistent"))
+            return
+
+        count = rebuild_thread_summaries(thread_pks=options["threads"])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt summaries of {count} threads"))
@@ -1,9 +1,74 @@
 from django.db import models
+from django.db.models import Exists, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 
 
 class MessageManager(models.Manager):
-    def read(self):
-        return super().get_queryset().filter(is_read=True)
+    def _read_watermark(self, user):
+        from .models import ParticipantSummary
 
-    def unread(self):
-        return super().get_queryset().filter(is_read=False)
+        return Coalesce(
+            Subquery(
+                ParticipantSummary.objects.filter(
+                    thread=OuterRef("thread"), user=user
+                ).values("last_read_message_id")[:1]
+            ),
+            0,
+        )
+
+    def read_by(self, user):
+        """
+        Interlocutor's messages read by `user`.
+        """
+        return (
+            super()
+            .get_queryset()
+            .filter(pk__lte=self._read_watermark(user))
+            .exclude(sender=user)
+        )
+
+    def unread_by(self, user):
+        """
+        Interlocutor's messages unread by `user`.
+        """
+        return (
+            super()
+            .get_queryset()
+            .filter(pk__gt=self._read_watermark(user))
+            .exclude(sender=user)
+        )
+
+
+class ThreadQuerySet(models.QuerySet):
+    def with_inbox_data(self, user):
+        """
+        Annotates every thread with its last message (id, text, created_at), last activity
+        and the number of interlocutor's messages unread by `user`, read from the thread
+        summaries.
+        """
+        from .models import ParticipantSummary
+
+        unread_count = ParticipantSummary.objects.filter(
+            thread=OuterRef("pk"), user=user
+        ).values("unread_count")[:1]
+        return self.annotate(
+            last_message_id=F("summary__last_message_id"),
+            last_message_text=F("summary__last_message__text"),
+            last_message_at=F("summary__last_message_at"),
+            last_activity=F("summary__last_activity"),
+            num_unread=Coalesce(Subquery(unread_count), 0),
+        ).prefetch_related("participants")
+
+    def with_membership(self, user):
+        """
+        Annotates every thread with `is_participant` of `user`.
+        """
+        from .models import Thread
+
+        return self.annotate(
+            is_participant=Exists(
+                Thread.participants.through.objects.filter(
+                    thread=OuterRef("pk"), user=user.pk
+                )
+            )
+        )
@@ -0,0 +1,282 @@
+"""
+Request instrumentation: wall time, database queries and time, serializer time and
+response size of every request, labelled by URL name and method.
+
+`MetricsMiddleware` adds the timings of a request to its `Server-Timing` header and
+aggregates all of the values into in-memory histograms of the current process, which
+`render_metrics` formats for Prometheus. Instrumentation is enabled by the
+`DIALOGS_METRICS_ENABLED` setting, the middleware removes itself otherwise.
+
+Queries are counted by the connections of whichever thread runs them: the request
+thread, the thread Django runs sync views in under ASGI or the database pool of
+`dialogs.asyncviews`, all of which see the metrics of their request by its context.
+"""
+import asyncio
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+from typing import Iterable, Tuple
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# name: (help, buckets)
+METRICS = {
+    "http_request_duration_seconds": ("Wall time of the requests.", DURATION_BUCKETS),
+    "http_request_db_queries": ("Database queries per request.", QUERY_BUCKETS),
+    "http_request_db_duration_seconds": (
+        "Database time of the requests.",
+        DURATION_BUCKETS,
+    ),
+    "http_request_serializer_duration_seconds": (
+        "Time the requests spent serializing objects.",
+        DURATION_BUCKETS,
+    ),
+    "http_response_size_bytes": ("Size of the response bodies.", SIZE_BUCKETS),
+}
+
+_histograms = {}
+_lock = threading.Lock()
+_current = ContextVar("request_metrics", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # the last count is of the values above all of the buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self) -> Iterable[Tuple[str, int]]:
+        """
+        Yields the cumulative counts by upper bound (`le`) as Prometheus does.
+        """
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield f"{bound:g}", total
+        yield "+Inf", total + self.counts[-1]
+
+
+class RequestMetrics:
+    """
+    Values of the request being processed, collected along the way.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializing = False
+
+    def __call__(self, execute, sql, params, many, context):
+        # database execute wrapper, times every query
+        started_at = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - started_at
+
+
+def _record_query(execute, sql, params, many, context):
+    # database execute wrapper of every connection, counts for the current request
+    request_metrics = _current.get()
+    if request_metrics is None:
+        return execute(sql, params, many, context)
+    return request_metrics(execute, sql, params, many, context)
+
+
+def _instrument(connection) -> None:
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def instrument_connections() -> None:
+    """
+    Makes the connections of the current thread count the queries of the requests,
+    the ones opened later are instrumented as they connect.
+    """
+    for connection in connections.all():
+        _instrument(connection)
+
+
+def _connection_created(sender, connection, **kwargs):
+    _instrument(connection)
+
+
+def observe(name: str, labels: Tuple[Tuple[str, str], ...], value: float) -> None:
+    with _lock:
+        histogram = _histograms.get((name, labels))
+        if histogram is None:
+            histogram = _histograms[name, labels] = Histogram(METRICS[name][1])
+        histogram.observe(value)
+
+
+def reset_metrics() -> None:
+    with _lock:
+        _histograms.clear()
+
+
+def render_metrics() -> str:
+    """
+    Formats the histograms in the Prometheus text exposition format.
+    """
+    with _lock:
+        histograms = {
+            key: (list(histogram.samples()), histogram.sum)
+            for key, histogram in _histograms.items()
+        }
+
+    lines = []
+    for name, (help_text, _) in METRICS.items():
+        series = sorted(
+            (labels, values)
+            for (key, labels), values in histograms.items()
+            if key == name
+        )
+        if not series:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, (samples, total) in series:
+            label_text = ",".join(f'{label}="{value}"' for label, value in labels)
+            for bound, count in samples:
+                lines.append(f'{name}_bucket{{{label_text},le="{bound}"}} {count}')
+            lines.append(f"{name}_sum{{{label_text}}} {total:.6f}")
+            lines.append(f"{name}_count{{{label_text}}} {samples[-1][1]}")
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+class TimedSerializerMixin:
+    """
+    Adds the time spent in `to_representation` to the serializer time of the
+    current request, nested serializers are not counted twice.
+    """
+
+    def to_representation(self, instance):
+        request_metrics = _current.get()
+        if request_metrics is None or request_metrics.serializing:
+            return super().to_representation(instance)
+
+        request_metrics.serializing = True
+        started_at = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            request_metrics.serializer_time += time.perf_counter() - started_at
+            request_metrics.serializing = False
+
+
+class MetricsMiddleware:
+    """
+    Records the metrics of every request and sends its timings in the
+    `Server-Timing` header. Bodies of streaming responses are measured as they are
+    sent, their other values cover the view only. Works in both sync and async mode,
+    so it doesn't take async views out of the event loop.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.DIALOGS_METRICS_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        connection_created.connect(_connection_created)
+        if asyncio.iscoroutinefunction(get_response):
+            # tells Django this middleware is a coroutine function
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        request_metrics = RequestMetrics()
+        token = _current.set(request_metrics)
+        started_at = time.perf_counter()
+        try:
+            instrument_connections()
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        duration = time.perf_counter() - started_at
+        return self.record(request, response, request_metrics, duration)
+
+    async def __acall__(self, request):
+        request_metrics = RequestMetrics()
+        token = _current.set(request_metrics)
+        started_at = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        duration = time.perf_counter() - started_at
+        return self.record(request, response, request_metrics, duration)
+
+    def record(self, request, response, request_metrics, duration):
+        match = request.resolver_match
+        # unmatched paths would make a series each
+        labels = (
+            ("view", match.view_name if match else "unmatched"),
+            ("method", request.method),
+        )
+        observe("http_request_duration_seconds", labels, duration)
+        observe("http_request_db_queries", labels, request_metrics.queries)
+        observe("http_request_db_duration_seconds", labels, request_metrics.db_time)
+        observe(
+            "http_request_serializer_duration_seconds",
+            labels,
+            request_metrics.serializer_time,
+        )
+        if getattr(response, "async_content", None) is not None:
+            # see `dialogs.asyncviews.AsyncStreamingHttpResponse`
+            response.async_content = self.measure_async_stream(
+                response.async_content, labels
+            )
+        elif response.streaming:
+            response.streaming_content = self.measure_stream(
+                response.streaming_content, labels
+            )
+        else:
+            observe("http_response_size_bytes", labels, len(response.content))
+
+        response["Server-Timing"] = ", ".join(
+            [
+                f"total;dur={duration * 1000:.1f}",
+                f'db;dur={request_metrics.db_time * 1000:.1f};desc="'
+                f'{request_metrics.queries} queries"',
+                f"serializer;dur={request_metrics.serializer_time * 1000:.1f}",
+            ]
+        )
+        return response
+
+    @staticmethod
+    def measure_stream(content, labels) -> Iterable[bytes]:
+        size = 0
+        try:
+            for chunk in content:
+                size += len(chunk)
+                yield chunk
+        finally:
+            observe("http_response_size_bytes", labels, size)
+
+    @staticmethod
+    async def measure_async_stream(content, labels):
+        size = 0
+        try:
+            async for chunk in content:
+                size += len(chunk)
+                yield chunk
+        finally:
+            observe("http_response_size_bytes", labels, size)
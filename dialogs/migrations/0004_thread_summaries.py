@@ -0,0 +1,111 @@
+# Generated by Django 3.2.3 on 2026-10-18 20:27
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_summaries(apps, schema_editor):
+    Thread = apps.get_model("dialogs", "Thread")
+    Message = apps.get_model("dialogs", "Message")
+    ThreadSummary = apps.get_model("dialogs", "ThreadSummary")
+    ParticipantSummary = apps.get_model("dialogs", "ParticipantSummary")
+
+    for thread in Thread.objects.prefetch_related("participants"):
+        messages = Message.objects.filter(thread=thread)
+        last_message = messages.order_by("-pk").first()
+        ThreadSummary.objects.create(
+            thread=thread,
+            last_message=last_message,
+            last_message_at=last_message.created_at if last_message else None,
+            message_count=messages.count(),
+        )
+        ParticipantSummary.objects.bulk_create(
+            [
+                ParticipantSummary(
+                    thread=thread,
+                    user=user,
+                    unread_count=messages.filter(is_read=False)
+                    .exclude(sender=user)
+                    .count(),
+                )
+                for user in thread.participants.all()
+            ]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("dialogs", "0003_alter_message_thread"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ThreadSummary",
+            fields=[
+                (
+                    "thread",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="summary",
+                        serialize=False,
+                        to="dialogs.thread",
+                    ),
+                ),
+                ("last_message_at", models.DateTimeField(blank=True, null=True)),
+                ("message_count", models.PositiveIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "last_message",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to="dialogs.message",
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="ParticipantSummary",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("unread_count", models.PositiveIntegerField(default=0)),
+                (
+                    "thread",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="participant_summaries",
+                        to="dialogs.thread",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="participantsummary",
+            constraint=models.UniqueConstraint(
+                fields=("thread", "user"), name="unique_participant_summary"
+            ),
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.2.3 on 2026-10-18 20:28
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.utils.timezone
+
+
+def fill_last_activity(apps, schema_editor):
+    Thread = apps.get_model("dialogs", "Thread")
+    ThreadSummary = apps.get_model("dialogs", "ThreadSummary")
+
+    created_at = Thread.objects.filter(pk=OuterRef("thread")).values("created_at")[:1]
+    ThreadSummary.objects.update(
+        last_activity=Coalesce("last_message_at", Subquery(created_at))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dialogs", "0004_thread_summaries"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="threadsummary",
+            name="last_activity",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now
+            ),
+        ),
+        migrations.RunPython(fill_last_activity, migrations.RunPython.noop),
+    ]
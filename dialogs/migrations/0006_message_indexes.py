@@ -0,0 +1,45 @@
+# Generated by Django 3.2.3 on 2026-10-18 20:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dialogs", "0005_threadsummary_last_activity"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["thread", "id"], name="dialogs_msg_thread_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                condition=models.Q(("is_read", False)),
+                fields=["thread", "id"],
+                name="dialogs_msg_unread_idx",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="thread",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="thread_messages",
+                to="dialogs.thread",
+            ),
+        ),
+        # threads of a user (and threads shared by two users) are looked up by
+        # `user_id` first, the auto-created M2M table only has `(thread_id, user_id)`
+        migrations.RunSQL(
+            "CREATE INDEX dialogs_participants_user_idx "
+            "ON dialogs_thread_participants (user_id, thread_id)",
+            "DROP INDEX dialogs_participants_user_idx",
+        ),
+    ]
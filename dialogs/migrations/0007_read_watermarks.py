@@ -0,0 +1,74 @@
+# Generated by Django 3.2.3 on 2026-10-18 20:32
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def flags_to_watermarks(apps, schema_editor):
+    """
+    Moves the watermark of every participant to their latest read interlocutor's
+    message and recounts unread messages after it.
+    """
+    Message = apps.get_model("dialogs", "Message")
+    ParticipantSummary = apps.get_model("dialogs", "ParticipantSummary")
+
+    last_read_message = (
+        Message.objects.filter(thread=OuterRef("thread"), is_read=True)
+        .exclude(sender=OuterRef("user"))
+        .order_by()
+        .values("thread")
+        .annotate(last_read=Max("pk"))
+        .values("last_read")
+    )
+    ParticipantSummary.objects.update(
+        last_read_message_id=Coalesce(Subquery(last_read_message), 0)
+    )
+
+    unread_messages = (
+        Message.objects.filter(
+            thread=OuterRef("thread"), pk__gt=OuterRef("last_read_message_id")
+        )
+        .exclude(sender=OuterRef("user"))
+        .order_by()
+        .values("thread")
+        .annotate(count=Count("pk"))
+        .values("count")
+    )
+    ParticipantSummary.objects.update(
+        unread_count=Coalesce(Subquery(unread_messages), 0)
+    )
+
+
+def watermarks_to_flags(apps, schema_editor):
+    Message = apps.get_model("dialogs", "Message")
+    ParticipantSummary = apps.get_model("dialogs", "ParticipantSummary")
+
+    for summary in ParticipantSummary.objects.filter(last_read_message_id__gt=0):
+        Message.objects.filter(
+            thread_id=summary.thread_id, pk__lte=summary.last_read_message_id
+        ).exclude(sender_id=summary.user_id).update(is_read=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dialogs", "0006_message_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="participantsummary",
+            name="last_read_message_id",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(flags_to_watermarks, watermarks_to_flags),
+        migrations.RemoveIndex(
+            model_name="message",
+            name="dialogs_msg_unread_idx",
+        ),
+        migrations.RemoveField(
+            model_name="message",
+            name="is_read",
+        ),
+    ]
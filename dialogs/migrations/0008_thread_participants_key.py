@@ -0,0 +1,39 @@
+# Generated by Django 3.2.3 on 2026-10-18 20:33
+
+from django.db import migrations, models
+
+
+def fill_participants_keys(apps, schema_editor):
+    """
+    Keys two-party threads, the oldest thread of duplicated ones keeps the key.
+    """
+    Thread = apps.get_model("dialogs", "Thread")
+
+    keyed = set()
+    for thread in Thread.objects.order_by("pk").prefetch_related("participants"):
+        user_ids = sorted(user.pk for user in thread.participants.all())
+        key = ":".join(str(user_id) for user_id in user_ids)
+        if len(user_ids) != 2 or key in keyed:
+            continue
+
+        keyed.add(key)
+        thread.participants_key = key
+        thread.save(update_fields=["participants_key"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dialogs", "0007_read_watermarks"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="thread",
+            name="participants_key",
+            field=models.CharField(
+                blank=True, editable=False, max_length=255, null=True, unique=True
+            ),
+        ),
+        migrations.RunPython(fill_participants_keys, migrations.RunPython.noop),
+    ]
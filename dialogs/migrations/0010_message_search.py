@@ -0,0 +1,57 @@
+# Generated by Django 3.2.3 on 2026-10-18 21:03
+
+import dialogs.models
+from django.db import migrations, models
+
+
+def create_search_table(apps, schema_editor):
+    """
+    Creates the FTS5 table of `SQLiteFTS5SearchBackend` and indexes the messages.
+    """
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE dialogs_message_fts USING fts5("
+        "text, thread_id UNINDEXED, sender_id UNINDEXED, "
+        "tokenize = 'unicode61 remove_diacritics 2')"
+    )
+    for table in ("dialogs_archivedmessage", "dialogs_message"):
+        schema_editor.execute(
+            "INSERT INTO dialogs_message_fts (rowid, text, thread_id, sender_id) "
+            f"SELECT id, text, thread_id, sender_id FROM {table}"
+        )
+
+
+def drop_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS dialogs_message_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dialogs", "0009_archived_messages"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MessageSearchEntry",
+            fields=[
+                (
+                    "id",
+                    models.BigIntegerField(
+                        db_column="rowid", primary_key=True, serialize=False
+                    ),
+                ),
+                ("text", dialogs.models.SearchTextField()),
+                ("thread_id", models.BigIntegerField()),
+                ("sender_id", models.BigIntegerField()),
+            ],
+            options={
+                "db_table": "dialogs_message_fts",
+                "managed": False,
+            },
+        ),
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
@@ -1,27 +1,160 @@
 from django.db import models
+from django.db.models import Lookup
+from django.utils import timezone
 from accounts.models import User
-from .managers import MessageManager
+from .managers import MessageManager, ThreadQuerySet
+
+
+class SearchTextField(models.TextField):
+    """
+    Text column of a full-text index, filtered by the `match` lookup.
+    """
+
+
+@SearchTextField.register_lookup
+class Match(Lookup):
+    lookup_name = "match"
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} MATCH {rhs}", lhs_params + rhs_params
 
 
 class Thread(models.Model):
     participants = models.ManyToManyField(User)
+    # canonical key of the participant set, unique among the threads still shared
+    # by all of their participants (see `make_participants_key`)
+    participants_key = models.CharField(
+        max_length=255, unique=True, null=True, blank=True, editable=False
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    objects = ThreadQuerySet.as_manager()
 
     def __str__(self):
         return f"Thread #{self.id}"
 
+    @staticmethod
+    def make_participants_key(user_ids) -> str:
+        return ":".join(str(user_id) for user_id in sorted(set(user_ids)))
+
 
 class Message(models.Model):
     text = models.TextField()
     sender = models.ForeignKey(User, on_delete=models.DO_NOTHING)
     thread = models.ForeignKey(
-        Thread, on_delete=models.CASCADE, related_name="thread_messages"
+        Thread,
+        on_delete=models.CASCADE,
+        related_name="thread_messages",
+        db_index=False,  # covered by `dialogs_msg_thread_id_idx`
     )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    is_read = models.BooleanField(default=False)
     objects = MessageManager()
 
+    class Meta:
+        indexes = [
+            # messages of a thread ordered by id: history pages, the last message
+            # and messages after a read watermark
+            models.Index(fields=["thread", "id"], name="dialogs_msg_thread_id_idx"),
+        ]
+
     def __str__(self):
         return f"Message from {self.sender} to {self.thread}"
+
+
+class ArchivedMessage(models.Model):
+    """
+    Message moved out of `Message` by `services.archive_messages`, keeping its id.
+
+    Only a prefix of every thread is archived, so the archived messages of a thread
+    always precede its hot ones and the history continues here where `Message` ends.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    text = models.TextField()
+    sender = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name="+")
+    thread = models.ForeignKey(
+        Thread,
+        on_delete=models.CASCADE,
+        related_name="archived_messages",
+        db_index=False,  # covered by `dialogs_archmsg_thread_id_idx`
+    )
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["thread", "id"], name="dialogs_archmsg_thread_id_idx"),
+        ]
+
+    def __str__(self):
+        return f"Archived message from {self.sender} to {self.thread}"
+
+
+class MessageSearchEntry(models.Model):
+    """
+    Row of the SQLite FTS5 table indexing the text of hot and archived messages,
+    maintained by `search.SQLiteFTS5SearchBackend` (the table is created by the
+    migration on SQLite only).
+    """
+
+    id = models.BigIntegerField(primary_key=True, db_column="rowid")
+    text = SearchTextField()
+    thread_id = models.BigIntegerField()
+    sender_id = models.BigIntegerField()
+
+    class Meta:
+        managed = False
+        db_table = "dialogs_message_fts"
+
+    def __str__(self):
+        return f"Search entry of message #{self.id}"
+
+
+class ThreadSummary(models.Model):
+    """
+    Denormalized per-thread data the inbox is served from, kept up to date by `services`.
+    """
+
+    thread = models.OneToOneField(
+        Thread, on_delete=models.CASCADE, primary_key=True, related_name="summary"
+    )
+    last_message = models.ForeignKey(
+        Message, on_delete=models.SET_NULL, null=True, blank=True, related_name="+"
+    )
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_activity = models.DateTimeField(default=timezone.now, db_index=True)
+    message_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Summary of {self.thread}"
+
+
+class ParticipantSummary(models.Model):
+    """
+    Per-participant state of a thread, kept up to date by `services`.
+
+    Every interlocutor's message with an id up to `last_read_message_id`
+    is read by the participant.
+    """
+
+    thread = models.ForeignKey(
+        Thread, on_delete=models.CASCADE, related_name="participant_summaries"
+    )
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    last_read_message_id = models.BigIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["thread", "user"], name="unique_participant_summary"
+            )
+        ]
+
+    def __str__(self):
+        return f"Summary of {self.user} in {self.thread}"
@@ -0,0 +1,267 @@
+from collections import OrderedDict
+from datetime import datetime
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class ChainedQuerySets:
+    """
+    Ordered querysets listed one after another, sliceable (and countable) for
+    `django.core.paginator.Paginator`.
+    """
+
+    def __init__(self, *querysets):
+        self.querysets = querysets
+        self._counts = None
+
+    def count(self):
+        if self._counts is None:
+            self._counts = [queryset.count() for queryset in self.querysets]
+        return sum(self._counts)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError("ChainedQuerySets can only be sliced")
+
+        self.count()
+        start, stop = index.start or 0, index.stop
+        items = []
+        for queryset, count in zip(self.querysets, self._counts):
+            if stop is not None and stop <= 0:
+                break
+            if start < count:
+                items += queryset[start:stop]
+            start = max(0, start - count)
+            stop = None if stop is None else stop - count
+        return items
+
+
+class KeysetPagination(PageNumberPagination):
+    """
+    Page number pagination which switches to keyset (cursor) pagination as soon as
+    one of `before`, `after` or `limit` query parameters is passed.
+
+    In keyset mode a page is located by the position of its neighbour item, so neither
+    `COUNT(*)` nor `OFFSET` is executed and deep pages cost as much as the first one.
+    `after` returns the items following the given position in the list order,
+    `before` returns the items preceding it.
+    """
+
+    before_query_param = "before"
+    after_query_param = "after"
+    limit_query_param = "limit"
+    max_limit = 100
+    invalid_cursor_message = "Invalid cursor"
+
+    # ((field, descending, parser), ...) the list is ordered by, unique as a whole
+    cursor_fields = (("id", False, int),)
+    # whether the first keyset page is the end of the list (e.g. the latest messages)
+    start_from_end = False
+
+    def is_keyset_request(self, request):
+        return any(
+            param in request.query_params
+            for param in (
+                self.before_query_param,
+                self.after_query_param,
+                self.limit_query_param,
+            )
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.is_keyset_request(request)
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view=view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        after = self.decode_cursor(request.query_params.get(self.after_query_param))
+
+        if after is not None or (before is None and not self.start_from_end):
+            # walk forward from the position (or from the start of the list)
+            items = self.fetch(queryset, after)
+            self.has_next = len(items) > self.limit
+            self.page = items[: self.limit]
+            self.has_previous = after is not None
+        else:
+            # walk backward from the position (or from the end of the list)
+            items = self.fetch(queryset, before, reverse=True)
+            self.has_previous = len(items) > self.limit
+            self.page = items[: self.limit][::-1]
+            self.has_next = before is not None
+        return self.page
+
+    def fetch(self, queryset, position, reverse=False):
+        """
+        Returns up to `limit + 1` items following `position` in the list order
+        (or preceding it, if `reverse` is set), from the start (end) of the list
+        if `position` is `None`.
+        """
+        if position is not None:
+            queryset = queryset.filter(self._following(position, reverse=reverse))
+        return list(
+            queryset.order_by(*self._ordering(reverse=reverse))[: self.limit + 1]
+        )
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("results", data),
+                ]
+            )
+        )
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+        if not self.has_next or not self.page:
+            return None
+
+        url = self._get_keyset_url()
+        url = remove_query_param(url, self.before_query_param)
+        return replace_query_param(
+            url, self.after_query_param, self.encode_cursor(self.page[-1])
+        )
+
+    def get_previous_link(self):
+        if not self.keyset:
+            return super().get_previous_link()
+        if not self.has_previous or not self.page:
+            return None
+
+        url = self._get_keyset_url()
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(
+            url, self.before_query_param, self.encode_cursor(self.page[0])
+        )
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(limit, self.max_limit))
+
+    def encode_cursor(self, obj):
+        return ",".join(
+            self._encode_value(getattr(obj, field))
+            for field, _, _ in self.cursor_fields
+        )
+
+    def decode_cursor(self, cursor):
+        if cursor is None:
+            return None
+
+        values = cursor.split(",")
+        if len(values) != len(self.cursor_fields):
+            raise NotFound(self.invalid_cursor_message)
+        try:
+            position = tuple(
+                parser(value)
+                for value, (_, _, parser) in zip(values, self.cursor_fields)
+            )
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if None in position:
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    @staticmethod
+    def _encode_value(value):
+        if isinstance(value, datetime):
+            return value.isoformat().replace("+00:00", "Z")
+        return str(value)
+
+    def _get_keyset_url(self):
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.limit_query_param, self.limit)
+
+    def _ordering(self, reverse=False):
+        return [
+            f"-{field}" if descending != reverse else field
+            for field, descending, _ in self.cursor_fields
+        ]
+
+    def _following(self, position, reverse=False):
+        """
+        Builds a filter of the items following `position` in the list order
+        (or preceding it, if `reverse` is set).
+        """
+        condition = Q()
+        equal = {}
+        for (field, descending, _), value in zip(self.cursor_fields, position):
+            lookup = "lt" if descending != reverse else "gt"
+            condition |= Q(**equal, **{f"{field}__{lookup}": value})
+            equal[field] = value
+        return condition
+
+
+class MessagePagination(KeysetPagination):
+    """
+    Messages of a thread in chronological order. Keyset pages are located
+    by `(thread_id, id)`, the first one holds the latest messages.
+    """
+
+    cursor_fields = (("id", False, int),)
+    start_from_end = True
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # archived messages of the thread (see `services.archive_messages`)
+        get_archive_queryset = getattr(view, "get_archive_queryset", None)
+        self.archive_queryset = get_archive_queryset() if get_archive_queryset else None
+        if self.archive_queryset is not None and not self.is_keyset_request(request):
+            queryset = ChainedQuerySets(self.archive_queryset.order_by("pk"), queryset)
+        return super().paginate_queryset(queryset, request, view=view)
+
+    def fetch(self, queryset, position, reverse=False):
+        if self.archive_queryset is None:
+            return super().fetch(queryset, position, reverse=reverse)
+
+        # archived messages precede the hot ones, walking backward from the latest
+        # messages the archive is only read once the hot messages run out
+        stores = [queryset, self.archive_queryset]
+        if not reverse:
+            stores.reverse()
+        items = []
+        for store in stores:
+            items += super().fetch(store, position, reverse=reverse)
+            if len(items) > self.limit:
+                break
+        return items[: self.limit + 1]
+
+
+class ThreadPagination(KeysetPagination):
+    """
+    Keyset pages of threads ordered by `(last_activity, id)`, the most active first.
+    Requires threads annotated with `last_activity`.
+    """
+
+    cursor_fields = (("last_activity", True, parse_datetime), ("id", True, int))
+
+
+class SearchPagination(KeysetPagination):
+    """
+    Keyset pages of search results ordered by `(rank, id)`, the best matches first.
+    Always in keyset mode, counting the matches would cost as much as the search.
+    Requires results annotated with `rank`.
+    """
+
+    cursor_fields = (("rank", False, float), ("id", False, int))
+
+    def is_keyset_request(self, request):
+        return True
@@ -1,11 +1,42 @@
+import hmac
+
+from django.conf import settings
 from rest_framework import permissions
 
 
 class IsThreadParticipant(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
-        return request.user in obj.participants.all()
+        # memberships already checked during the request, by thread id
+        memberships = getattr(request, "_thread_memberships", None)
+        if memberships is None:
+            memberships = request._thread_memberships = {}
+        if obj.pk not in memberships:
+            if hasattr(obj, "is_participant"):
+                # annotated by `ThreadQuerySet.with_membership`
+                memberships[obj.pk] = obj.is_participant
+            else:
+                memberships[obj.pk] = obj.participants.filter(
+                    pk=request.user.pk
+                ).exists()
+        return memberships[obj.pk]
 
 
 class MessagePermission(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
         return request.user == obj.sender
+
+
+class IsMetricsScraper(permissions.BasePermission):
+    """
+    Staff users, or scrapers sending the `DIALOGS_METRICS_TOKEN` setting as a bearer
+    token (`Authorization: Bearer <token>`).
+    """
+
+    def has_permission(self, request, view):
+        if request.user and request.user.is_staff:
+            return True
+        token = settings.DIALOGS_METRICS_TOKEN
+        if not token:
+            return False
+        header = request.META.get("HTTP_AUTHORIZATION", "")
+        return hmac.compare_digest(header.encode(), f"Bearer {token}".encode())
@@ -0,0 +1,127 @@
+"""
+Publish/subscribe backends fanning dialogs events out to connected clients.
+
+The backend is chosen by the `DIALOGS_PUBSUB_BACKEND` setting. `InProcessPubSub` only
+reaches subscribers living in the publishing process, a multi-process deployment
+needs a backend built on a shared broker.
+"""
+import asyncio
+import queue
+import threading
+from collections import defaultdict
+from functools import lru_cache
+from typing import Iterable, Optional
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class Subscription:
+    """
+    Receiver of the events published to the channels it is subscribed to.
+    """
+
+    def __init__(self, channels: Iterable[str]):
+        self.channels = frozenset(channels)
+
+    def deliver(self, event: dict) -> None:
+        """
+        Called by the backend from any thread, must not block.
+        """
+        raise NotImplementedError
+
+
+class AsyncSubscription(Subscription):
+    """
+    Subscription consumed by a coroutine running in the event loop it was created in.
+    """
+
+    def __init__(self, channels: Iterable[str]):
+        super().__init__(channels)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    def deliver(self, event: dict) -> None:
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[dict]:
+        """
+        Waits for the next event, returns `None` on timeout.
+        """
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class SyncSubscription(Subscription):
+    """
+    Subscription consumed by a (blocking) thread.
+    """
+
+    def __init__(self, channels: Iterable[str]):
+        super().__init__(channels)
+        self.queue = queue.SimpleQueue()
+
+    def deliver(self, event: dict) -> None:
+        self.queue.put(event)
+
+    def get(self, timeout: Optional[float] = None) -> Optional[dict]:
+        """
+        Waits for the next event, returns `None` on timeout.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class BasePubSub:
+    def publish(self, channel: str, event: dict) -> None:
+        raise NotImplementedError
+
+    def subscribe(self, subscription: Subscription) -> None:
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        raise NotImplementedError
+
+
+class InProcessPubSub(BasePubSub):
+    """
+    Delivers events to the subscribers of the current process.
+    """
+
+    def __init__(self):
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def publish(self, channel: str, event: dict) -> None:
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.deliver(event)
+
+    def subscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions[channel].add(subscription)
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            for channel in subscription.channels:
+                subscriptions = self._subscriptions.get(channel)
+                if subscriptions is None:
+                    continue
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[channel]
+
+
+@lru_cache(maxsize=None)
+def get_pubsub() -> BasePubSub:
+    return import_string(settings.DIALOGS_PUBSUB_BACKEND)()
+
+
+def user_channel(user_id: int) -> str:
+    return f"user:{user_id}"
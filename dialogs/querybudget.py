@@ -0,0 +1,148 @@
+"""
+SQL query budgets of the dialogs views.
+
+A view declares the most queries a request may run by its `query_budget`: a number,
+or a dict by handler (the viewset action or the lowercase HTTP method). The budgets
+hold regardless of the amount of data and have no slack, which is checked by the
+tests at two data sizes: a budget is the most queries the view runs with nothing
+cached, the user of the token included. `QueryBudgetMiddleware` checks them in
+production too when `DIALOGS_QUERY_BUDGET_MODE` is set.
+"""
+import logging
+import re
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+_string_re = re.compile(r"'(?:[^']|'')*'")
+_number_re = re.compile(r"\b\d+(?:\.\d+)?\b")
+_list_re = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_space_re = re.compile(r"\s+")
+_transaction_re = re.compile(
+    r"\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE SAVEPOINT)\b", re.IGNORECASE
+)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def get_query_budget(view_func, method: str) -> Optional[int]:
+    """
+    Returns the query budget of a request of `method` to `view_func` (as returned
+    by `as_view`), `None` when the view has none.
+    """
+    budget = getattr(getattr(view_func, "cls", None), "query_budget", None)
+    if isinstance(budget, dict):
+        handler = method.lower()
+        # viewsets map the methods to actions
+        handler = (getattr(view_func, "actions", None) or {}).get(handler, handler)
+        return budget.get(handler)
+    return budget
+
+
+def fingerprint(sql: str) -> str:
+    """
+    Returns `sql` with the literals replaced by `?`, so queries differing only by
+    their parameters (e.g. N+1 ones) share a fingerprint.
+    """
+    sql = _string_re.sub("?", sql)
+    sql = _number_re.sub("?", sql)
+    sql = _list_re.sub("(...)", sql)
+    return _space_re.sub(" ", sql).strip()
+
+
+def group_queries(queries: List[Dict[str, str]]) -> List[Dict[str, object]]:
+    """
+    Groups captured queries by fingerprint, the most repeated first.
+    """
+    groups = defaultdict(lambda: {"count": 0, "time": 0.0})
+    for query in queries:
+        group = groups[fingerprint(query["sql"])]
+        group["count"] += 1
+        group["time"] += float(query.get("time") or 0)
+    return [
+        {"fingerprint": sql, "count": group["count"], "time": round(group["time"], 3)}
+        for sql, group in sorted(groups.items(), key=lambda item: -item[1]["count"])
+    ]
+
+
+def format_report(
+    name: str, budget: int, queries: List[Dict[str, str]], limit: int = 10
+) -> str:
+    lines = [f"{name} ran {len(queries)} queries, the budget is {budget}:"]
+    for group in group_queries(queries)[:limit]:
+        lines.append(f"  {group['count']}x ({group['time']}s) {group['fingerprint']}")
+    return "\n".join(lines)
+
+
+@contextmanager
+def capture_queries():
+    """
+    Captures the queries run on every database connection of the current thread,
+    yields the list they are added to. Connections aren't opened for it, those opened
+    meanwhile (e.g. to a replica, see `dialogs.routers`) are captured too.
+    Transaction control statements aren't queries of the view: whether an atomic
+    block starts a transaction or a savepoint depends on the caller (e.g. the tests).
+    """
+    queries = []
+
+    def record(execute, sql, params, many, context):
+        if _transaction_re.match(sql):
+            return execute(sql, params, many, context)
+        started_at = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started_at
+            queries.append({"sql": sql, "time": f"{duration:.3f}"})
+
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(record))
+        yield queries
+
+
+class QueryBudgetMiddleware:
+    """
+    Logs (`DIALOGS_QUERY_BUDGET_MODE = "log"`) or raises `QueryBudgetExceeded`
+    (`"raise"`) when a request runs more queries than the budget of its view, with
+    the queries grouped by fingerprint. Does nothing when the mode is `None`.
+    Queries run while a streaming response is consumed are not counted.
+    """
+
+    modes = ("log", "raise")
+
+    def __init__(self, get_response):
+        self.mode = settings.DIALOGS_QUERY_BUDGET_MODE
+        if self.mode is None:
+            raise MiddlewareNotUsed()
+        if self.mode not in self.modes:
+            raise ImproperlyConfigured(
+                f"DIALOGS_QUERY_BUDGET_MODE must be one of {self.modes} or None"
+            )
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with capture_queries() as queries:
+            response = self.get_response(request)
+
+        budget = getattr(request, "query_budget", None)
+        if budget is not None and len(queries) > budget:
+            match = request.resolver_match
+            name = match.view_name if match else request.path
+            report = format_report(f"{request.method} {name}", budget, queries)
+            if self.mode == "raise":
+                raise QueryBudgetExceeded(report)
+            logger.warning(report)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = get_query_budget(view_func, request.method)
@@ -0,0 +1,114 @@
+import csv
+import json
+from typing import Iterable, Optional
+
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.renderers import BaseRenderer
+
+
+def format_event(data, event: Optional[str] = None, id=None) -> str:
+    """
+    Formats a Server-Sent Event carrying `data` as JSON.
+    """
+    lines = []
+    if id is not None:
+        lines.append(f"id: {id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def format_ndjson(rows: Iterable[dict]) -> Iterable[str]:
+    """
+    Formats every row as a line of JSON.
+    """
+    encoder = DjangoJSONEncoder()
+    for row in rows:
+        yield encoder.encode(row) + "\n"
+
+
+class _Echo:
+    # file-like object handing written lines back to the caller
+    def write(self, value):
+        return value
+
+
+def format_csv(
+    header: Optional[Iterable[str]], rows: Iterable[Iterable]
+) -> Iterable[str]:
+    """
+    Formats the header (unless `None`) and every row as a line of CSV.
+    """
+    encoder = DjangoJSONEncoder()
+    writer = csv.writer(_Echo())
+    if header is not None:
+        yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(
+            [
+                # dates and the like are written as in JSON
+                value
+                if value is None or isinstance(value, (str, int, float))
+                else encoder.default(value)
+                for value in row
+            ]
+        )
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Makes views negotiate `text/event-stream`. The streams themselves are produced
+    by the views, responses rendered here (errors) become a single `error` event.
+    """
+
+    media_type = "text/event-stream"
+    format = "sse"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return format_event(data, event="error").encode(self.charset)
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Makes views negotiate newline delimited JSON, the streams are produced by the
+    views, responses rendered here (errors) become a single line.
+    """
+
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return "".join(format_ndjson([data])).encode(self.charset)
+
+
+class CSVRenderer(BaseRenderer):
+    """
+    Makes views negotiate CSV, the streams are produced by the views, responses
+    rendered here (errors) become a single `detail` column.
+    """
+
+    media_type = "text/csv"
+    format = "csv"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        detail = data.get("detail", data) if isinstance(data, dict) else data
+        return "".join(format_csv(["detail"], [[str(detail)]])).encode(self.charset)
+
+
+class PrometheusRenderer(BaseRenderer):
+    """
+    Renders the text of `dialogs.metrics.render_metrics`, errors become a comment.
+    """
+
+    media_type = "text/plain"
+    format = "prometheus"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict):
+            data = f"# {data.get('detail', data)}\n"
+        return data.encode(self.charset)
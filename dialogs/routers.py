@@ -0,0 +1,156 @@
+"""
+Routing of the dialogs reads to read replicas.
+
+Reads of the dialogs models made by safe requests (thread and message lists, unread
+counts) go to one of the `DIALOGS_READ_REPLICAS` aliases of `DATABASES`, everything
+else goes to the primary (`default`):
+
+- writes, reads inside transactions and anything outside of a request;
+- the whole of unsafe requests (e.g. creating a message, reading messages until one),
+  so they check and return what they've just written;
+- the rest of a request after it wrote, and every request of a user for
+  `DIALOGS_REPLICA_LAG` seconds after the user wrote, so users see their own writes
+  however far the replicas lag behind;
+- requests calling `use_primary`, e.g. the ones woken up by the events of new
+  messages the replicas may not have yet.
+
+The marks of the users who wrote live in the default cache, a shared backend keeps
+them across the processes of a deployment. Routing is enabled by
+`ReplicaRoutingMiddleware`, which removes itself when there are no replicas.
+"""
+import asyncio
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, connections
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+# apps whose reads may be served by the replicas
+REPLICATED_APPS = ("dialogs",)
+
+_routing = ContextVar("replica_routing", default=None)
+
+
+class RequestRouting:
+    """
+    Routing state of the request being processed.
+    """
+
+    def __init__(self, request, pinned: bool):
+        self.request = request
+        # pinned to the primary for the rest of the request
+        self.pinned = pinned
+        # the sticky mark of the user is looked up once, when the user is known
+        self.checked = pinned
+        self.wrote = False
+
+
+def _primary_key(user_id: int) -> str:
+    return f"dialogs:primary:{user_id}"
+
+
+def _user_id(request):
+    # authenticated by DRF before the views read anything
+    user = getattr(request, "user", None)
+    return user.pk if user is not None and user.is_authenticated else None
+
+
+def _is_pinned(routing: RequestRouting) -> bool:
+    if not routing.checked:
+        routing.checked = True
+        user_id = _user_id(routing.request)
+        routing.pinned = user_id is not None and bool(cache.get(_primary_key(user_id)))
+    return routing.pinned
+
+
+def reads_from_replicas() -> bool:
+    """
+    Returns whether the dialogs reads made now are served by a replica.
+    """
+    routing = _routing.get()
+    return (
+        routing is not None
+        and bool(settings.DIALOGS_READ_REPLICAS)
+        and not _is_pinned(routing)
+        and not connections[DEFAULT_DB_ALIAS].in_atomic_block
+    )
+
+
+def use_primary() -> None:
+    """
+    Sends the remaining reads of the current request to the primary.
+    """
+    routing = _routing.get()
+    if routing is not None:
+        routing.pinned = routing.checked = True
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in REPLICATED_APPS and reads_from_replicas():
+            return random.choice(settings.DIALOGS_READ_REPLICAS)
+        return None
+
+    def db_for_write(self, model, **hints):
+        routing = _routing.get()
+        if routing is not None and not routing.wrote:
+            routing.wrote = True
+            use_primary()
+            user_id = _user_id(routing.request)
+            if user_id is not None:
+                cache.set(
+                    _primary_key(user_id), True, timeout=settings.DIALOGS_REPLICA_LAG
+                )
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicated from the primary along with the data
+        if db in settings.DIALOGS_READ_REPLICAS:
+            return False
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Sets up the replica routing of every request (see the module docstring).
+    Works in both sync and async mode, so it doesn't take async views out of the
+    event loop.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.DIALOGS_READ_REPLICAS:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # tells Django this middleware is a coroutine function
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        token = _routing.set(self.get_routing(request))
+        try:
+            return self.get_response(request)
+        finally:
+            _routing.reset(token)
+
+    async def __acall__(self, request):
+        token = _routing.set(self.get_routing(request))
+        try:
+            return await self.get_response(request)
+        finally:
+            _routing.reset(token)
+
+    @staticmethod
+    def get_routing(request) -> RequestRouting:
+        return RequestRouting(request, pinned=request.method not in SAFE_METHODS)
@@ -0,0 +1,168 @@
+"""
+Full-text search backends of the messages.
+
+The backend is chosen by the `DIALOGS_SEARCH_BACKEND` setting and kept up to date by
+`services` whenever messages are created, edited or deleted, and when threads
+are deleted along with their messages. Archived messages keep their index
+entries, so the archived history stays searchable.
+"""
+import re
+from typing import Iterable, List
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, FloatField, Value
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+from django.utils.module_loading import import_string
+
+from accounts.models import User
+from .models import ArchivedMessage, Message, MessageSearchEntry, Thread
+
+# the backends delimit the matches by characters of the private use area, the text
+# is HTML escaped before they are replaced by the tags (see `render_highlighted`)
+HIGHLIGHT_START = "\ue000"
+HIGHLIGHT_END = "\ue001"
+
+_term_re = re.compile(r"\w+")
+
+
+def parse_terms(query: str) -> List[str]:
+    """
+    Words of a search query, punctuation (and so any FTS5 syntax) is dropped.
+    """
+    return _term_re.findall(query)
+
+
+def render_highlighted(highlighted: str) -> str:
+    """
+    HTML of a `highlighted` text, the matches are wrapped in `<mark>` tags.
+    """
+    return (
+        escape(highlighted)
+        .replace(HIGHLIGHT_START, "<mark>")
+        .replace(HIGHLIGHT_END, "</mark>")
+    )
+
+
+def _user_thread_ids(user: User):
+    return Thread.participants.through.objects.filter(user=user).values("thread_id")
+
+
+class BaseSearchBackend:
+    def search(self, user: User, terms: List[str]):
+        """
+        Returns a queryset of the messages of `user`'s threads containing all of the
+        `terms`, annotated with `rank` (lower is better) and `highlighted` text:
+        the plain text, its matches between `HIGHLIGHT_START` and `HIGHLIGHT_END`.
+        """
+        raise NotImplementedError
+
+    def index(self, messages: Iterable[Message]) -> None:
+        """
+        Adds new messages to the index, edited ones are removed first.
+        """
+
+    def remove(self, message_pks: Iterable[int]) -> None:
+        """
+        Drops deleted messages from the index.
+        """
+
+    def remove_threads(self, thread_pks: Iterable[int]) -> None:
+        """
+        Drops the hot and archived messages of threads about to be deleted.
+        """
+
+    def rebuild(self) -> int:
+        """
+        Indexes all of the messages from scratch, returns the number of them.
+        """
+        return 0
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """
+    Search without an index, each query scans the messages of the user's threads.
+    Works on any database, neither ranks nor highlights the results.
+    """
+
+    def search(self, user: User, terms: List[str]):
+        messages = Message.objects.filter(thread__in=_user_thread_ids(user))
+        for term in terms:
+            messages = messages.filter(text__icontains=term)
+        return messages.annotate(
+            rank=Value(0.0, output_field=FloatField()), highlighted=F("text")
+        )
+
+
+class SQLiteFTS5SearchBackend(BaseSearchBackend):
+    """
+    Search in the FTS5 table `dialogs_message_fts` (see `MessageSearchEntry`),
+    ranked by bm25.
+    """
+
+    table = MessageSearchEntry._meta.db_table
+    batch_size = 1000
+
+    def search(self, user: User, terms: List[str]):
+        # every term is quoted, so the query can't contain FTS5 syntax
+        query = " ".join(f'"{term}"' for term in terms)
+        return (
+            MessageSearchEntry.objects.filter(
+                text__match=query, thread_id__in=_user_thread_ids(user)
+            )
+            .annotate(
+                rank=RawSQL(f'"{self.table}"."rank"', (), output_field=FloatField()),
+                highlighted=RawSQL(
+                    f'highlight("{self.table}", 0, %s, %s)',
+                    (HIGHLIGHT_START, HIGHLIGHT_END),
+                ),
+            )
+            .only("id", "thread_id", "sender_id")
+        )
+
+    def index(self, messages: Iterable[Message]) -> None:
+        MessageSearchEntry.objects.bulk_create(
+            [self._entry(message) for message in messages],
+            batch_size=self.batch_size,
+        )
+
+    def remove(self, message_pks: Iterable[int]) -> None:
+        MessageSearchEntry.objects.filter(pk__in=list(message_pks)).delete()
+
+    def remove_threads(self, thread_pks: Iterable[int]) -> None:
+        thread_pks = list(thread_pks)
+        # by rowid, the thread id of the entries isn't indexed
+        for model in (ArchivedMessage, Message):
+            MessageSearchEntry.objects.filter(
+                pk__in=model.objects.filter(thread_id__in=thread_pks).values("pk")
+            ).delete()
+
+    @transaction.atomic
+    def rebuild(self) -> int:
+        MessageSearchEntry.objects.all().delete()
+        columns = "rowid, text, thread_id, sender_id"
+        with connection.cursor() as cursor:
+            for model in (ArchivedMessage, Message):
+                cursor.execute(
+                    f'INSERT INTO "{self.table}" ({columns}) '
+                    f'SELECT id, text, thread_id, sender_id FROM "{model._meta.db_table}"'
+                )
+            # merges the b-trees of the index written in many small transactions
+            cursor.execute(
+                f'INSERT INTO "{self.table}" ("{self.table}") VALUES (%s)', ["optimize"]
+            )
+        return MessageSearchEntry.objects.count()
+
+    @staticmethod
+    def _entry(message: Message) -> MessageSearchEntry:
+        return MessageSearchEntry(
+            id=message.pk,
+            text=message.text,
+            thread_id=message.thread_id,
+            sender_id=message.sender_id,
+        )
+
+
+def get_search_backend() -> BaseSearchBackend:
+    return import_string(settings.DIALOGS_SEARCH_BACKEND)()
@@ -1,18 +1,23 @@
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from accounts.models import User
+from .metrics import TimedSerializerMixin
 from .models import Thread, Message
+from .search import render_highlighted
+from .services import get_or_create_thread, get_read_watermarks
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ("id", "username", "email")
 
 
-class ThreadSerializer(serializers.ModelSerializer):
+class ThreadSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     num_unread_messages = serializers.SerializerMethodField()
     last_message = serializers.SerializerMethodField()
+    last_message_id = serializers.SerializerMethodField()
+    last_message_at = serializers.SerializerMethodField()
 
     class Meta:
         model = Thread
@@ -21,6 +26,8 @@ class ThreadSerializer(serializers.ModelSerializer):
             "participants",
             "num_unread_messages",
             "last_message",
+            "last_message_id",
+            "last_message_at",
             "created_at",
             "updated_at",
         )
@@ -29,24 +36,38 @@ class ThreadSerializer(serializers.ModelSerializer):
         super().__init__(*args, **kwargs)
         self.request = self.context.get("request", None)
 
+    def _annotate(self, obj):
+        """
+        Threads coming from `ThreadQuerySet.with_inbox_data` are already annotated,
+        others (e.g. a freshly created thread) are annotated here on demand.
+        """
+        if not hasattr(obj, "num_unread"):
+            annotated = Thread.objects.with_inbox_data(self.request.user).get(pk=obj.pk)
+            obj.last_message_id = annotated.last_message_id
+            obj.last_message_text = annotated.last_message_text
+            obj.last_message_at = annotated.last_message_at
+            obj.num_unread = annotated.num_unread
+        return obj
+
     def get_last_message(self, obj):
-        try:
-            return Message.objects.filter(thread=obj.pk).last().text
-        except AttributeError:
-            return "No messages yet"
+        text = self._annotate(obj).last_message_text
+        return "No messages yet" if text is None else text
+
+    def get_last_message_id(self, obj):
+        return self._annotate(obj).last_message_id
+
+    def get_last_message_at(self, obj):
+        last_message_at = self._annotate(obj).last_message_at
+        if last_message_at is None:
+            return None
+        return serializers.DateTimeField().to_representation(last_message_at)
 
     def get_num_unread_messages(self, obj):
-        return Message.objects.filter(thread=obj.pk, is_read=False).count()
+        return self._annotate(obj).num_unread
 
     def create(self, validated_data):
-        thread = (
-            Thread.objects.filter(participants=validated_data.get("participants")[0])
-            .filter(participants=validated_data.get("participants")[1])
-            .first()
-        )
         # Create a new thread if it doesn't exist between passed users
-        if not thread:
-            thread = super().create(validated_data=validated_data)
+        thread, _ = get_or_create_thread(validated_data.get("participants"))
         return thread
 
     def validate(self, data):
@@ -72,7 +93,9 @@ class ThreadSerializer(serializers.ModelSerializer):
         return data
 
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    is_read = serializers.SerializerMethodField()
+
     class Meta:
         model = Message
         fields = (
@@ -82,3 +105,49 @@ class MessageSerializer(serializers.ModelSerializer):
             "thread",
             "is_read",
         )
+
+    def get_is_read(self, obj):
+        """
+        A message is read when every interlocutor's read watermark reached it.
+        """
+        watermarks = self.context.get("read_watermarks", {}).get(obj.thread_id)
+        if watermarks is None:
+            watermarks = get_read_watermarks([obj.thread_id])[obj.thread_id]
+
+        interlocutors = [
+            watermark
+            for user_id, watermark in watermarks.items()
+            if user_id != obj.sender_id
+        ]
+        return bool(interlocutors) and obj.pk <= min(interlocutors)
+
+
+class BulkMessageSerializer(serializers.ModelSerializer):
+    """
+    Item of a bulk send, the thread membership is checked once per thread by the view.
+    """
+
+    thread = serializers.IntegerField(min_value=1)
+
+    class Meta:
+        model = Message
+        fields = (
+            "thread",
+            "text",
+        )
+
+
+class MessageSearchResultSerializer(TimedSerializerMixin, serializers.Serializer):
+    """
+    Message found by `search`, its HTML escaped text with the matched words
+    highlighted.
+    """
+
+    id = serializers.IntegerField()
+    thread = serializers.IntegerField(source="thread_id")
+    sender = serializers.IntegerField(source="sender_id")
+    highlighted = serializers.SerializerMethodField()
+    rank = serializers.FloatField()
+
+    def get_highlighted(self, obj):
+        return render_highlighted(obj.highlighted)
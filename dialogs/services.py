@@ -1,20 +1,564 @@
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.db import IntegrityError, router, transaction
+from django.db.models import (
+    BigIntegerField,
+    Case,
+    Count,
+    F,
+    OuterRef,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.utils import timezone
 from accounts.models import User
 from rest_framework.exceptions import ValidationError
-from .models import Message
+from . import caching, events
+from .search import get_search_backend
+from .models import (
+    ArchivedMessage,
+    Message,
+    Thread,
+    ThreadSummary,
+    ParticipantSummary,
+)
+
+
+def _unread_count_subquery(
+    user_field: str = "user", watermark_field: str = "last_read_message_id"
+):
+    """
+    Number of messages in `OuterRef("thread")` not sent by `OuterRef(user_field)`
+    with ids greater than `OuterRef(watermark_field)`.
+    """
+    return Coalesce(
+        Subquery(
+            Message.objects.filter(
+                thread=OuterRef("thread"), pk__gt=OuterRef(watermark_field)
+            )
+            .exclude(sender=OuterRef(user_field))
+            .order_by()
+            .values("thread")
+            .annotate(count=Count("pk"))
+            .values("count")
+        ),
+        0,
+    )
+
+
+def _last_message_id_subquery():
+    return Coalesce(
+        Subquery(
+            ThreadSummary.objects.filter(thread=OuterRef("thread")).values(
+                "last_message_id"
+            )[:1]
+        ),
+        0,
+    )
+
+
+def _move_read_watermark(user: User, thread_pk: int, watermark, **fields) -> None:
+    """
+    Moves the read watermark of `user` in the thread forward to `watermark`
+    (never backward), creating the participant summary if it doesn't exist yet.
+    """
+    participant_summaries = ParticipantSummary.objects.filter(
+        thread_id=thread_pk, user=user
+    )
+    updated = participant_summaries.update(
+        last_read_message_id=Greatest(F("last_read_message_id"), watermark), **fields
+    )
+    if not updated:
+        # the thread predates the summaries, build them from scratch
+        rebuild_thread_summaries(thread_pks=[thread_pk])
+        participant_summaries.update(
+            last_read_message_id=Greatest(F("last_read_message_id"), watermark),
+            **fields,
+        )
 
 
+@transaction.atomic
 def read_all_interlocutor_messages(user: User, thread_pk: int) -> None:
-    Message.objects.unread().filter(thread__pk=thread_pk).exclude(sender=user).update(
-        is_read=True
+    _move_read_watermark(
+        user, thread_pk, watermark=_last_message_id_subquery(), unread_count=0
     )
+    # `is_read` of the thread messages and the unread counts of the user change
+    caching.invalidate_threads([thread_pk])
+    caching.invalidate_users([user.pk])
+    events.messages_read(thread_pk=thread_pk, user_id=user.pk)
 
 
+@transaction.atomic
 def read_interlocutor_messages_until(
     user: User, thread_pk: int, message_pk: int
 ) -> None:
-    if message_pk < 1:
+    read_interlocutor_messages_until_many(user, {thread_pk: message_pk})
+
+
+@transaction.atomic
+def read_interlocutor_messages_until_many(
+    user: User, message_pks: Dict[int, int]
+) -> Dict[int, int]:
+    """
+    Reads the interlocutor's messages until `message_pk` in every thread of
+    `{thread_pk: message_pk}` with two UPDATEs, whatever the number of threads.
+    Returns the new unread counts of `user` by thread.
+    """
+    if not all(
+        type(message_pk) is int and message_pk >= 1
+        for message_pk in message_pks.values()
+    ):
         raise ValidationError("[ERROR] Invalid message_pk")
+    if not message_pks:
+        return {}
+
+    participant_summaries = ParticipantSummary.objects.filter(
+        thread_id__in=list(message_pks), user=user
+    )
+    requested = Case(
+        *[
+            When(thread_id=thread_pk, then=Value(message_pk))
+            for thread_pk, message_pk in message_pks.items()
+        ],
+        output_field=BigIntegerField(),
+    )
+    # messages which don't exist yet can't be read
+    watermark = Least(requested, _last_message_id_subquery())
+    updated = participant_summaries.update(
+        last_read_message_id=Greatest(F("last_read_message_id"), watermark)
+    )
+    if updated < len(message_pks):
+        # some threads predate the summaries, build them from scratch
+        rebuild_thread_summaries(thread_pks=list(message_pks))
+        participant_summaries.update(
+            last_read_message_id=Greatest(F("last_read_message_id"), watermark)
+        )
+    participant_summaries.update(unread_count=_unread_count_subquery())
+
+    caching.invalidate_threads(list(message_pks))
+    caching.invalidate_users([user.pk])
+    events.messages_read_in_threads(thread_pks=list(message_pks), user_id=user.pk)
+    return dict(participant_summaries.values_list("thread_id", "unread_count"))
+
+
+def get_unread_counts(user: User) -> Dict[int, int]:
+    """
+    Returns `{thread_id: unread_count}` of the threads of `user` with unread messages,
+    read from the precomputed counters.
+    """
+    return dict(
+        ParticipantSummary.objects.filter(user=user, unread_count__gt=0)
+        .order_by("thread_id")
+        .values_list("thread_id", "unread_count")
+    )
+
+
+def get_unread_total(user: User) -> int:
+    """
+    Returns the number of messages unread by `user` across all of the user's threads.
+    """
+    return ParticipantSummary.objects.filter(user=user).aggregate(
+        total=Coalesce(Sum("unread_count"), 0)
+    )["total"]
+
+
+def get_read_watermarks(thread_pks: Iterable[int]) -> dict:
+    """
+    Returns read watermarks of the participants of the given threads
+    as `{thread_id: {user_id: message_id}}`.
+    """
+    watermarks = {thread_pk: {} for thread_pk in thread_pks}
+    for thread_id, user_id, watermark in ParticipantSummary.objects.filter(
+        thread_id__in=list(watermarks)
+    ).values_list("thread_id", "user_id", "last_read_message_id"):
+        watermarks[thread_id][user_id] = watermark
+    return watermarks
+
+
+def ensure_thread_summary(thread: Thread) -> None:
+    """
+    Creates missing summary rows of the thread and of every participant of it.
+    """
+    ThreadSummary.objects.get_or_create(
+        thread=thread, defaults={"last_activity": thread.created_at}
+    )
+    ParticipantSummary.objects.bulk_create(
+        [
+            ParticipantSummary(thread=thread, user_id=user_id)
+            for user_id in thread.participants.values_list("pk", flat=True)
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def get_or_create_thread(participants: List[User]) -> Tuple[Thread, bool]:
+    """
+    Returns the thread shared by exactly `participants`, creating it if it doesn't exist.
+    Safe against concurrent calls: the unique `participants_key` lets only one of
+    them create the thread, the others return it.
+    """
+    key = Thread.make_participants_key(user.pk for user in participants)
+    thread = Thread.objects.filter(participants_key=key).first()
+    if thread:
+        return thread, False
+
+    try:
+        with transaction.atomic():
+            thread = Thread.objects.create(participants_key=key)
+            thread.participants.set(participants)
+            ensure_thread_summary(thread)
+    except IntegrityError:
+        return Thread.objects.get(participants_key=key), False
+    return thread, True
+
+
+@transaction.atomic
+def leave_thread(thread: Thread, user: User) -> None:
+    """
+    Removes `user` from the participants. The thread is not shared by its original
+    participant set anymore, so it loses its key.
+    """
+    thread.participants.remove(user)
+    ParticipantSummary.objects.filter(thread=thread, user=user).delete()
+    Thread.objects.filter(pk=thread.pk).update(participants_key=None)
+
+
+@transaction.atomic
+def delete_thread(thread: Thread) -> None:
+    """
+    Deletes the thread along with its messages and their search entries.
+    """
+    # before the messages are gone
+    get_search_backend().remove_threads([thread.pk])
+    # the cascade would load every message and send a delete signal per message, the
+    # caches of the thread and its participants are invalidated once by `signals`
+    hot = Message.objects.filter(thread=thread)
+    hot._raw_delete(router.db_for_write(Message))
+    thread.delete()
+
+
+def _record_messages_created(thread_pk: int, messages: List[Message]) -> None:
+    """
+    Updates the thread summary after `messages` (ordered by id) of one sender were
+    created in the thread and notifies the participants.
+    """
+    last_message = messages[-1]
+    updated = ThreadSummary.objects.filter(thread_id=thread_pk).update(
+        last_message=last_message,
+        last_message_at=last_message.created_at,
+        last_activity=last_message.created_at,
+        message_count=F("message_count") + len(messages),
+        updated_at=timezone.now(),
+    )
+    if updated:
+        ParticipantSummary.objects.filter(thread_id=thread_pk).exclude(
+            user_id=last_message.sender_id
+        ).update(unread_count=F("unread_count") + len(messages))
+    else:
+        # the thread predates the summaries, build them from scratch
+        rebuild_thread_summaries(thread_pks=[thread_pk])
+    get_search_backend().index(messages)
+    events.messages_created(thread_pk, messages)
+
+
+def record_message_created(message: Message) -> None:
+    """
+    Updates the thread summary after `message` was created and notifies the
+    participants. Must be called in the transaction that created the message.
+    """
+    _record_messages_created(message.thread_id, [message])
+
+
+@transaction.atomic
+def create_messages(sender: User, items: List[Tuple[int, str]]) -> List[Message]:
+    """
+    Creates messages of `sender` from `(thread_pk, text)` pairs with bulk INSERTs and
+    updates the summaries once per thread. As with a single message, the sender
+    reads the interlocutor's messages of every thread first.
+    Thread membership must be checked by the caller.
+    """
+    thread_pks = list(dict.fromkeys(thread_pk for thread_pk, _ in items))
+    for thread_pk in thread_pks:
+        read_all_interlocutor_messages(user=sender, thread_pk=thread_pk)
+
+    messages = Message.objects.bulk_create(
+        [
+            Message(sender=sender, thread_id=thread_pk, text=text)
+            for thread_pk, text in items
+        ]
+    )
+    if messages and messages[0].pk is None:
+        # the backend doesn't return ids of bulk inserted rows (SQLite). The write
+        # lock held by the transaction guarantees the newest messages of the sender
+        # are the inserted ones.
+        pks = (
+            Message.objects.filter(sender=sender)
+            .order_by("-pk")
+            .values_list("pk", flat=True)[: len(messages)]
+        )
+        for message, pk in zip(messages, reversed(list(pks))):
+            message.pk = pk
+
+    # bulk inserts send no signals
+    caching.invalidate_threads(thread_pks)
+    caching.invalidate_users(
+        set(
+            ParticipantSummary.objects.filter(thread_id__in=thread_pks).values_list(
+                "user_id", flat=True
+            )
+        )
+    )
+
+    messages_by_thread = {thread_pk: [] for thread_pk in thread_pks}
+    for message in messages:
+        messages_by_thread[message.thread_id].append(message)
+    for thread_pk, thread_messages in messages_by_thread.items():
+        _record_messages_created(thread_pk, thread_messages)
+    return messages
+
+
+def record_message_updated(message: Message) -> None:
+    """
+    Marks the thread summary as changed and reindexes `message` after it was edited,
+    then notifies the participants.
+    """
+    ThreadSummary.objects.filter(thread_id=message.thread_id).update(
+        updated_at=timezone.now()
+    )
+    search = get_search_backend()
+    search.remove([message.pk])
+    search.index([message])
+    events.message_updated(message)
+
+
+def record_message_deleted(thread_pk: int, message_pk: int) -> None:
+    """
+    Recomputes the thread summary after the message was deleted and notifies the
+    participants. Must be called in the transaction that deleted the message.
+    """
+    rebuild_thread_summaries(thread_pks=[thread_pk])
+    get_search_backend().remove([message_pk])
+    events.message_deleted(thread_pk=thread_pk, message_pk=message_pk)
+
+
+def _archivable_messages(created_before: datetime):
+    """
+    Messages which can be archived: a prefix of every thread, sent before
+    `created_before`, read by all of the participants and not the last one.
+    """
+    # ids grow with time, the first recent message bounds every thread
+    first_recent = (
+        Message.objects.filter(created_at__gte=created_before)
+        .order_by("pk")
+        .values_list("pk", flat=True)
+        .first()
+    )
+    messages = Message.objects.all()
+    if first_recent is not None:
+        messages = messages.filter(pk__lt=first_recent)
+
+    # unread messages stay, the unread counters never look into the archive
+    lowest_watermark = (
+        ParticipantSummary.objects.filter(thread=OuterRef("thread"))
+        .order_by("last_read_message_id")
+        .values("last_read_message_id")[:1]
+    )
+    last_message = ThreadSummary.objects.filter(thread=OuterRef("thread")).values(
+        "last_message_id"
+    )
+    return messages.annotate(
+        lowest_watermark=Subquery(lowest_watermark),
+        last_message_id=Subquery(last_message),
+    ).filter(pk__lte=F("lowest_watermark"), pk__lt=F("last_message_id"))
+
+
+def archive_messages(
+    created_before: datetime, chunk_size: int = 1000, max_chunks: Optional[int] = None
+) -> int:
+    """
+    Moves the archivable messages sent before `created_before` from `Message` to
+    `ArchivedMessage`, `chunk_size` messages per transaction, so the tables are never
+    locked for long. Returns the number of archived messages.
+    """
+    archived = chunks = 0
+    last_pk = 0
+    while max_chunks is None or chunks < max_chunks:
+        with transaction.atomic():
+            messages = list(
+                _archivable_messages(created_before)
+                .filter(pk__gt=last_pk)
+                .order_by("pk")[:chunk_size]
+            )
+            if not messages:
+                break
+
+            ArchivedMessage.objects.bulk_create(
+                [
+                    ArchivedMessage(
+                        id=message.pk,
+                        text=message.text,
+                        sender_id=message.sender_id,
+                        thread_id=message.thread_id,
+                        created_at=message.created_at,
+                        updated_at=message.updated_at,
+                    )
+                    for message in messages
+                ]
+            )
+            # the messages live on in the archive: neither delete signals nor the
+            # collector are wanted here, the summaries don't change
+            hot = Message.objects.filter(pk__in=[message.pk for message in messages])
+            hot._raw_delete(router.db_for_write(Message))
+            caching.invalidate_threads({message.thread_id for message in messages})
+
+        archived += len(messages)
+        chunks += 1
+        last_pk = messages[-1].pk
+    return archived
+
+
+def _expected_thread_summaries(thread_pks: Optional[Iterable[int]] = None):
+    threads = Thread.objects.all()
+    if thread_pks is not None:
+        threads = threads.filter(pk__in=list(thread_pks))
+
+    last_message = Message.objects.filter(thread=OuterRef("pk")).order_by("-pk")
+    return threads.order_by("pk").annotate(
+        expected_last_message_id=Subquery(last_message.values("pk")[:1]),
+        expected_last_message_at=Subquery(last_message.values("created_at")[:1]),
+        # archived messages are still a part of the thread
+        expected_message_count=Count("thread_messages", distinct=True)
+        + Coalesce(
+            Subquery(
+                ArchivedMessage.objects.filter(thread=OuterRef("pk"))
+                .order_by()
+                .values("thread")
+                .annotate(count=Count("pk"))
+                .values("count")
+            ),
+            0,
+        ),
+    )
+
+
+def _expected_participant_summaries(thread_pks: Optional[Iterable[int]] = None):
+    participants = Thread.participants.through.objects.all()
+    if thread_pks is not None:
+        participants = participants.filter(thread_id__in=list(thread_pks))
+
+    # read watermarks are the source of truth, they are kept as they are
+    watermark = ParticipantSummary.objects.filter(
+        thread=OuterRef("thread"), user=OuterRef("user")
+    ).values("last_read_message_id")[:1]
+    return (
+        participants.annotate(watermark=Coalesce(Subquery(watermark), 0))
+        .annotate(
+            expected_unread_count=_unread_count_subquery(
+                user_field="user", watermark_field="watermark"
+            )
+        )
+        .values_list("thread_id", "user_id", "watermark", "expected_unread_count")
+    )
+
+
+@transaction.atomic
+def rebuild_thread_summaries(thread_pks: Optional[Iterable[int]] = None) -> int:
+    """
+    (Re)builds summaries of the given threads (or all of them) from `Message`.
+    Returns the number of rebuilt threads.
+    """
+    if thread_pks is not None:
+        thread_pks = list(thread_pks)
+
+    threads = list(_expected_thread_summaries(thread_pks))
+    ThreadSummary.objects.filter(thread__in=threads).delete()
+    ThreadSummary.objects.bulk_create(
+        [
+            ThreadSummary(
+                thread=thread,
+                last_message_id=thread.expected_last_message_id,
+                last_message_at=thread.expected_last_message_at,
+                last_activity=thread.expected_last_message_at or thread.created_at,
+                message_count=thread.expected_message_count,
+            )
+            for thread in threads
+        ]
+    )
+
+    expected_participant_summaries = [
+        ParticipantSummary(
+            thread_id=thread_id,
+            user_id=user_id,
+            last_read_message_id=watermark,
+            unread_count=count,
+        )
+        for thread_id, user_id, watermark, count in _expected_participant_summaries(
+            thread_pks
+        )
+    ]
+    participant_summaries = ParticipantSummary.objects.all()
+    if thread_pks is not None:
+        participant_summaries = participant_summaries.filter(thread_id__in=thread_pks)
+    participant_summaries.delete()
+    ParticipantSummary.objects.bulk_create(expected_participant_summaries)
+    return len(threads)
+
+
+def check_thread_summaries(thread_pks: Optional[Iterable[int]] = None) -> list:
+    """
+    Compares the stored summaries with `Message` and returns a list of mismatches.
+    """
+    if thread_pks is not None:
+        thread_pks = list(thread_pks)
+
+    summaries = ThreadSummary.objects.all()
+    participant_summaries = ParticipantSummary.objects.all()
+    if thread_pks is not None:
+        summaries = summaries.filter(thread_id__in=thread_pks)
+        participant_summaries = participant_summaries.filter(thread_id__in=thread_pks)
+
+    errors = []
+    summaries = {summary.pk: summary for summary in summaries}
+    for thread in _expected_thread_summaries(thread_pks):
+        summary = summaries.get(thread.pk)
+        if summary is None:
+            errors.append(f"{thread}: summary is missing")
+            continue
+
+        expected = (
+            thread.expected_last_message_id,
+            thread.expected_last_message_at,
+            thread.expected_last_message_at or thread.created_at,
+            thread.expected_message_count,
+        )
+        actual = (
+            summary.last_message_id,
+            summary.last_message_at,
+            summary.last_activity,
+            summary.message_count,
+        )
+        if expected != actual:
+            errors.append(f"{thread}: expected {expected}, got {actual}")
 
-    Message.objects.unread().filter(thread__pk=thread_pk, pk__lte=message_pk).exclude(
-        sender=user
-    ).update(is_read=True)
+    counters = {
+        (thread_id, user_id): count
+        for thread_id, user_id, count in participant_summaries.values_list(
+            "thread_id", "user_id", "unread_count"
+        )
+    }
+    for thread_id, user_id, _, expected in _expected_participant_summaries(thread_pks):
+        actual = counters.pop((thread_id, user_id), None)
+        if actual != expected:
+            errors.append(
+                f"Thread #{thread_id}, user #{user_id}: "
+                f"expected {expected} unread messages, got {actual}"
+            )
+    for thread_id, user_id in counters:
+        errors.append(
+            f"Thread #{thread_id}, user #{user_id}: user is not a participant"
+        )
+    return errors
@@ -0,0 +1,59 @@
+"""
+Invalidation of the cached dialogs reads (see `dialogs.caching`) on model changes.
+"""
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import caching
+from .models import Message, ParticipantSummary, Thread
+
+
+def _participant_ids(thread_pk: int) -> list:
+    return list(
+        ParticipantSummary.objects.filter(thread_id=thread_pk).values_list(
+            "user_id", flat=True
+        )
+    )
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    caching.invalidate_threads([instance.thread_id])
+    if created:
+        # the inboxes of the participants are reordered
+        caching.invalidate_users(_participant_ids(instance.thread_id))
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    caching.invalidate_threads([instance.thread_id])
+    caching.invalidate_users(_participant_ids(instance.thread_id))
+
+
+@receiver(post_save, sender=Thread)
+def thread_saved(sender, instance, **kwargs):
+    caching.invalidate_threads([instance.pk])
+
+
+@receiver(pre_delete, sender=Thread)
+def thread_deleted(sender, instance, **kwargs):
+    caching.invalidate_threads([instance.pk])
+    caching.invalidate_users(instance.participants.values_list("pk", flat=True))
+
+
+@receiver(m2m_changed, sender=Thread.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear":
+        # the cleared participants aren't known after the fact
+        if reverse:
+            pk_set = set(instance.thread_set.values_list("pk", flat=True))
+        else:
+            pk_set = set(instance.participants.values_list("pk", flat=True))
+    elif action not in ("post_add", "post_remove"):
+        return
+
+    thread_pks, user_pks = (
+        ([instance.pk], pk_set) if not reverse else (pk_set, [instance.pk])
+    )
+    caching.invalidate_threads(thread_pks)
+    caching.invalidate_users(user_pks)
@@ -1,32 +1,111 @@
+import asyncio
+import csv
+import json
+import os
+import runpy
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from importlib import import_module
+from types import SimpleNamespace
+from io import StringIO
+from unittest import skipUnless
+from unittest.mock import patch
+
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.contrib.auth.hashers import get_hasher
+from django.db import connection, connections
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import resolve
+from django.utils import timezone
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.reverse import reverse
-from rest_framework.test import APITestCase
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
+from rest_framework_jwt.settings import api_settings
 
 from accounts.models import User
-from dialogs.models import Thread, Message
+from accounts.authentication import get_user_cache, revoke_tokens
+from dialogs import asyncviews, caching
+from dialogs.dataset import generate_dataset
+from dialogs.metrics import reset_metrics
+from dialogs.pagination import MessagePagination
+from dialogs.permissions import IsThreadParticipant
+from dialogs.querybudget import (
+    QueryBudgetExceeded,
+    capture_queries,
+    fingerprint,
+    format_report,
+    get_query_budget,
+)
+from dialogs.throttling import UserTokenBucketThrottle
+from dialogs.urls import urlpatterns
+from dialogs.views import (
+    MessageExport,
+    MessagesSince,
+    MessageViewSet,
+    ThreadListCreate,
+)
+from dialogs.models import (
+    ArchivedMessage,
+    MessageSearchEntry,
+    Thread,
+    Message,
+    ThreadSummary,
+    ParticipantSummary,
+)
+from dialogs.services import (
+    archive_messages,
+    check_thread_summaries,
+    ensure_thread_summary,
+    get_or_create_thread,
+    leave_thread,
+    read_all_interlocutor_messages,
+    read_interlocutor_messages_until,
+    rebuild_thread_summaries,
+    record_message_created,
+)
+from yalantis_django.asgi import AsyncURLConfHandler, application
+
+jwt_payload_handler = api_settings.JWT_PAYLOAD_HANDLER
+jwt_encode_handler = api_settings.JWT_ENCODE_HANDLER
 
 
 class ThreadTestCase(APITestCase):
     def setUp(self) -> None:
+        cache.clear()  # throttle buckets
+        caching.clear()
+        get_user_cache().clear()
         users = []
         for i in range(1, 4):
             user = self.create_user(
                 username=f"test{i}",
                 email=f"test{i}@gmail.com",
                 first_name=f"first_name{i}",
-                last_name=f"last_name{i}"
+                last_name=f"last_name{i}",
             )
             users.append(user)
 
         self.user1, self.user2, self.user3 = users
-        self.thread = Thread.objects.create()
-        self.thread.participants.set(users[:2])  # thread with `participants = [1, 2]`
+        # thread with `participants = [1, 2]`
+        self.thread, _ = get_or_create_thread(users[:2])
 
         self.message = Message.objects.create(
             text="test message",
             thread=self.thread,
             sender=self.thread.participants.first(),
         )
+        rebuild_thread_summaries()
 
         self.login_url = reverse("get_auth_token")
         self.thread_list_url = reverse("dialogs:thread_list")
@@ -344,13 +423,25 @@ class ThreadTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
         # ensure the interlocutor's messages are still unread
-        unread_messages = (
-            Message.objects.unread()
-            .filter(thread__pk=1, pk__lte=data["message_id"])
-            .exclude(sender=self.user2)
+        unread_messages = Message.objects.unread_by(self.user2).filter(
+            thread__pk=1, pk__lte=data["message_id"]
         )
-        for message in unread_messages:
-            self.assertEqual(message.is_read, False)
+        self.assertEqual(list(unread_messages), [self.message])
+
+        # Fail due to missing or invalid message_id
+        for invalid in ({}, {"message_id": "last"}, {"message_id": 0}):
+            response = self.client.post(
+                self.messages_read_until_url,
+                data=invalid,
+                HTTP_AUTHORIZATION=self._get_user_token(email=self.user2.email),
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for message_pk in ("5", None):
+            with self.assertRaises(ValidationError):
+                read_interlocutor_messages_until(
+                    user=self.user2, thread_pk=1, message_pk=message_pk
+                )
+        self.assertEqual(list(unread_messages), [self.message])
 
         # read messages in thread until the given message_id
         response = self.client.post(
@@ -362,10 +453,1991 @@ class ThreadTestCase(APITestCase):
 
         # ensure we have read all interlocutor's messages
         # which ids are lower or equal to provided message_id
-        read_messages = (
-            Message.objects.read()
-            .filter(thread__pk=1, pk__lte=data["message_id"])
-            .exclude(sender=self.user2)
+        read_messages = Message.objects.read_by(self.user2).filter(
+            thread__pk=1, pk__lte=data["message_id"]
+        )
+        self.assertEqual(list(read_messages), [self.message])
+        self.assertFalse(
+            Message.objects.unread_by(self.user2).filter(thread__pk=1).exists()
+        )
+
+    def test_thread_list_num_queries(self):
+        """
+        Ensure the number of queries on the thread list doesn't grow with the page size.
+        """
+        self.client.force_authenticate(user=self.user1)
+
+        def create_threads(count):
+            for i in range(count):
+                interlocutor = self.create_user(
+                    username=f"interlocutor{Thread.objects.count()}",
+                    email=f"interlocutor{Thread.objects.count()}@gmail.com",
+                    first_name="first_name",
+                    last_name="last_name",
+                )
+                thread = Thread.objects.create()
+                thread.participants.set([self.user1, interlocutor])
+                ensure_thread_summary(thread)
+                record_message_created(
+                    Message.objects.create(
+                        text="hi", thread=thread, sender=interlocutor
+                    )
+                )
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(self.thread_list_url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return len(context), response.json()
+
+        create_threads(1)
+        num_queries_small, data = count_queries()
+        self.assertEqual(data.get("count"), 2)
+
+        create_threads(10)
+        num_queries_large, data = count_queries()
+        self.assertEqual(data.get("count"), 12)
+        self.assertEqual(num_queries_small, num_queries_large)
+
+        # the annotated values are served per thread
+        results = {thread["id"]: thread for thread in data.get("results")}
+        self.assertEqual(results[self.thread.id]["last_message"], self.message.text)
+        self.assertEqual(results[self.thread.id]["last_message_id"], self.message.id)
+        self.assertEqual(results[self.thread.id]["num_unread_messages"], 0)
+        for thread in data.get("results"):
+            if thread["id"] != self.thread.id:
+                self.assertEqual(thread["num_unread_messages"], 1)
+                self.assertEqual(thread["last_message"], "hi")
+
+    def test_thread_summaries(self):
+        """
+        Ensure thread summaries follow message writes and read marks.
+        """
+        user1_token = self._get_user_token(email=self.user1.email)
+        user2_token = self._get_user_token(email=self.user2.email)
+
+        def assert_summary(last_message_id, message_count, unread1, unread2):
+            summary = ThreadSummary.objects.get(thread=self.thread)
+            self.assertEqual(summary.last_message_id, last_message_id)
+            self.assertEqual(summary.message_count, message_count)
+            unread = dict(
+                ParticipantSummary.objects.filter(thread=self.thread).values_list(
+                    "user", "unread_count"
+                )
+            )
+            self.assertEqual(unread, {self.user1.id: unread1, self.user2.id: unread2})
+            call_command("rebuild_thread_summaries", "--check", stdout=StringIO())
+
+        assert_summary(self.message.id, 1, 0, 1)
+
+        first_id = self.client.post(
+            self.message_list_url, {"text": "one"}, HTTP_AUTHORIZATION=user1_token
+        ).json()["id"]
+        second_id = self.client.post(
+            self.message_list_url, {"text": "two"}, HTTP_AUTHORIZATION=user1_token
+        ).json()["id"]
+        assert_summary(second_id, 3, 0, 3)
+
+        self.client.patch(
+            reverse("dialogs:message_detail", args=[second_id]),
+            {"text": "edited"},
+            HTTP_AUTHORIZATION=user1_token,
+        )
+        assert_summary(second_id, 3, 0, 3)
+
+        self.client.post(
+            self.messages_read_until_url,
+            {"message_id": first_id},
+            HTTP_AUTHORIZATION=user2_token,
+        )
+        assert_summary(second_id, 3, 0, 1)
+
+        self.client.delete(
+            reverse("dialogs:message_detail", args=[second_id]),
+            HTTP_AUTHORIZATION=user1_token,
+        )
+        assert_summary(first_id, 2, 0, 0)
+
+        self.client.post(
+            self.message_list_url, {"text": "three"}, HTTP_AUTHORIZATION=user2_token
+        )
+        assert_summary(Message.objects.last().id, 3, 1, 0)
+
+        # a broken summary is reported and fixed by the rebuild
+        ThreadSummary.objects.filter(thread=self.thread).update(message_count=10)
+        with self.assertRaises(CommandError):
+            call_command("rebuild_thread_summaries", "--check", stderr=StringIO())
+        call_command("rebuild_thread_summaries", stdout=StringIO())
+        assert_summary(Message.objects.last().id, 3, 1, 0)
+
+    def test_message_list_keyset(self):
+        """
+        Ensure messages can be paged by `before`/`after` cursors without COUNT queries.
+        """
+        self.client.force_authenticate(user=self.user1)
+        for i in range(5):
+            record_message_created(
+                Message.objects.create(
+                    text=f"message {i}", thread=self.thread, sender=self.user2
+                )
+            )
+        ids = list(
+            Message.objects.filter(thread=self.thread)
+            .order_by("pk")
+            .values_list("pk", flat=True)
+        )
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.message_list_url, {"limit": 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(
+            any("COUNT(" in query["sql"] for query in context.captured_queries)
+        )
+        data = response.json()
+        # the first page holds the latest messages
+        self.assertEqual([message["id"] for message in data["results"]], ids[-2:])
+        self.assertIsNone(data["next"])
+        self.assertNotIn("count", data)
+
+        response = self.client.get(data["previous"])
+        data = response.json()
+        self.assertEqual([message["id"] for message in data["results"]], ids[-4:-2])
+
+        response = self.client.get(data["previous"])
+        data = response.json()
+        self.assertEqual([message["id"] for message in data["results"]], ids[:2])
+        self.assertIsNone(data["previous"])
+
+        response = self.client.get(data["next"])
+        data = response.json()
+        self.assertEqual([message["id"] for message in data["results"]], ids[2:4])
+
+        response = self.client.get(self.message_list_url, {"after": ids[0]})
+        self.assertEqual(
+            [message["id"] for message in response.json()["results"]], ids[1:]
+        )
+
+        response = self.client.get(self.message_list_url, {"before": "invalid"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_thread_list_keyset(self):
+        """
+        Ensure threads can be paged by `(last_activity, id)` cursors, the most active first.
+        """
+        self.client.force_authenticate(user=self.user1)
+        threads = [self.thread]
+        for i in range(4):
+            interlocutor = self.create_user(
+                username=f"interlocutor{i}",
+                email=f"interlocutor{i}@gmail.com",
+                first_name="first_name",
+                last_name="last_name",
+            )
+            thread = Thread.objects.create()
+            thread.participants.set([self.user1, interlocutor])
+            ensure_thread_summary(thread)
+            threads.append(thread)
+        # the first thread becomes the most active one
+        record_message_created(
+            Message.objects.create(text="hi", thread=self.thread, sender=self.user2)
+        )
+        expected = [self.thread.id] + [thread.id for thread in threads[:0:-1]]
+
+        response = self.client.get(self.thread_list_url, {"limit": 2})
+        data = response.json()
+        self.assertEqual([thread["id"] for thread in data["results"]], expected[:2])
+        self.assertIsNone(data["previous"])
+
+        response = self.client.get(data["next"])
+        data = response.json()
+        self.assertEqual([thread["id"] for thread in data["results"]], expected[2:4])
+
+        response = self.client.get(data["next"])
+        data = response.json()
+        self.assertEqual([thread["id"] for thread in data["results"]], expected[4:])
+        self.assertIsNone(data["next"])
+
+        response = self.client.get(data["previous"])
+        data = response.json()
+        self.assertEqual([thread["id"] for thread in data["results"]], expected[2:4])
+
+    @skipUnless(connection.vendor == "sqlite", "EXPLAIN QUERY PLAN is SQLite specific")
+    def test_query_plans(self):
+        """
+        Ensure the hot dialogs queries are served by indexes and never scan a whole table.
+        """
+        hot_queries = {
+            "unread messages of a thread": Message.objects.unread_by(self.user1).filter(
+                thread__pk=self.thread.pk
+            ),
+            "unread messages of a thread until a message": Message.objects.unread_by(
+                self.user1
+            ).filter(thread__pk=self.thread.pk, pk__lte=self.message.pk),
+            "last message of a thread": Message.objects.filter(
+                thread=self.thread.pk
+            ).order_by("-pk")[:1],
+            "thread between two users": Thread.objects.filter(
+                participants=self.user1
+            ).filter(participants=self.user2),
+        }
+        for name, queryset in hot_queries.items():
+            with self.subTest(name):
+                plan = queryset.explain()
+                self.assertNotRegex(plan, r"\bSCAN\b", msg=plan)
+                self.assertRegex(plan, r"USING (COVERING )?INDEX", msg=plan)
+
+    def test_read_watermarks(self):
+        """
+        Ensure reading moves a per-participant watermark which `is_read` is derived from.
+        """
+        self.client.force_authenticate(user=self.user2)
+        messages = [self.message]
+        for i in range(3):
+            message = Message.objects.create(
+                text=f"message {i}", thread=self.thread, sender=self.user1
+            )
+            record_message_created(message)
+            messages.append(message)
+
+        def get_is_read():
+            response = self.client.get(self.message_list_url)
+            return [message["is_read"] for message in response.json()["results"]]
+
+        self.assertEqual(get_is_read(), [False, False, False, False])
+
+        with CaptureQueriesContext(connection) as context:
+            read_interlocutor_messages_until(
+                user=self.user2, thread_pk=self.thread.pk, message_pk=messages[1].pk
+            )
+        # the read messages themselves aren't touched
+        self.assertFalse(
+            any(
+                query["sql"].startswith('UPDATE "dialogs_message"')
+                for query in context.captured_queries
+            )
+        )
+        self.assertEqual(get_is_read(), [True, True, False, False])
+        self.assertEqual(
+            ParticipantSummary.objects.get(
+                thread=self.thread, user=self.user2
+            ).unread_count,
+            2,
+        )
+
+        # watermarks never move backward nor beyond the last message
+        read_interlocutor_messages_until(
+            user=self.user2, thread_pk=self.thread.pk, message_pk=messages[0].pk
+        )
+        self.assertEqual(get_is_read(), [True, True, False, False])
+        read_interlocutor_messages_until(
+            user=self.user2, thread_pk=self.thread.pk, message_pk=10 ** 6
+        )
+        self.assertEqual(get_is_read(), [True, True, True, True])
+        self.assertEqual(
+            ParticipantSummary.objects.get(
+                thread=self.thread, user=self.user2
+            ).last_read_message_id,
+            messages[-1].pk,
+        )
+
+        # a new message is unread until the interlocutor reads it
+        response = self.client.post(self.message_list_url, {"text": "reply"})
+        self.assertFalse(response.json()["is_read"])
+        read_all_interlocutor_messages(user=self.user1, thread_pk=self.thread.pk)
+        self.assertEqual(get_is_read(), [True, True, True, True, True])
+
+    def test_thread_permission_queries(self):
+        """
+        Ensure thread permissions cost no query on top of the thread lookup
+        and are checked at most once per thread within a request.
+        """
+        self.client.force_authenticate(user=self.user1)
+        for url, method, data in (
+            (self.message_list_url, "get", None),
+            (self.message_list_url, "post", {"text": "hi"}),
+            (self.messages_read_until_url, "post", {"message_id": 1}),
+        ):
+            with CaptureQueriesContext(connection) as context:
+                response = getattr(self.client, method)(url, data)
+            self.assertLess(response.status_code, 300)
+            participant_queries = [
+                query["sql"]
+                for query in context.captured_queries
+                if "dialogs_thread_participants" in query["sql"]
+            ]
+            self.assertEqual(len(participant_queries), 1, participant_queries)
+            self.assertIn("EXISTS", participant_queries[0])
+
+        # threads fetched without the annotation are checked by one query per request
+        request = APIRequestFactory().get("/")
+        request.user = self.user3
+        permission = IsThreadParticipant()
+        thread = Thread.objects.get(pk=self.thread.pk)
+        with self.assertNumQueries(1):
+            self.assertFalse(permission.has_object_permission(request, None, thread))
+            self.assertFalse(permission.has_object_permission(request, None, thread))
+
+    def test_messages_since(self):
+        """
+        Ensure user gets messages newer than the given id of threads user is in.
+        """
+        url = reverse("dialogs:messages_since")
+        # thread 2 with `participants = [1, 3]`
+        thread, _ = get_or_create_thread([self.user1, self.user3])
+        message = Message.objects.create(text="hi", thread=thread, sender=self.user3)
+
+        self.client.force_authenticate(user=self.user1)
+        response = self.client.get(url, {"since": 0, "timeout": 5})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [item["id"] for item in response.json()["results"]],
+            [self.message.pk, message.pk],
+        )
+        self.assertEqual(response.json()["last_id"], message.pk)
+
+        response = self.client.get(url, {"since": 0, "thread": thread.pk})
+        self.assertEqual(
+            [item["id"] for item in response.json()["results"]], [message.pk]
+        )
+
+        # nothing new, the request returns when the timeout expires
+        response = self.client.get(url, {"since": message.pk, "timeout": 0})
+        self.assertEqual(response.json(), {"results": [], "last_id": message.pk})
+
+        response = self.client.get(url, {"timeout": 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Fail due to user 2 has no permission to access thread 2
+        self.client.force_authenticate(user=self.user2)
+        response = self.client.get(url, {"since": 0, "thread": thread.pk})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        # user 2 only gets messages of thread 1
+        response = self.client.get(url, {"since": 0, "timeout": 0})
+        self.assertEqual(
+            [item["id"] for item in response.json()["results"]], [self.message.pk]
+        )
+
+    def test_messages_since_sse(self):
+        """
+        Ensure messages are streamed as Server-Sent Events.
+        """
+        self.client.force_authenticate(user=self.user2)
+        response = self.client.get(
+            reverse("dialogs:messages_since"),
+            {"since": 0, "timeout": 0},
+            HTTP_ACCEPT="text/event-stream",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = b"".join(response.streaming_content).decode().split("\n\n")
+        event_id, event_type, data = events[0].splitlines()
+        self.assertEqual(event_id, f"id: {self.message.pk}")
+        self.assertEqual(event_type, "event: message")
+        self.assertEqual(json.loads(data.split(": ", 1)[1])["text"], "test message")
+
+        # reconnecting clients resume after the last received event
+        response = self.client.get(
+            reverse("dialogs:messages_since"),
+            {"since": 0, "timeout": 0, "format": "sse"},
+            HTTP_LAST_EVENT_ID=str(self.message.pk),
+        )
+        self.assertEqual(b"".join(response.streaming_content), b"")
+
+    def test_message_bulk_create(self):
+        """
+        Ensure user can send many messages at once to threads user is in
+        and gets a result per message.
+        """
+        url = reverse("dialogs:message_bulk_create")
+        # thread 2 with `participants = [1, 3]`, thread 3 with `participants = [2, 3]`
+        thread2, _ = get_or_create_thread([self.user1, self.user3])
+        thread3, _ = get_or_create_thread([self.user2, self.user3])
+        data = {
+            "messages": [
+                {"thread": self.thread.pk, "text": "first"},
+                {"thread": thread2.pk, "text": "second"},
+                {"thread": thread3.pk, "text": "forbidden"},
+                {"thread": 100, "text": "missing"},
+                {"thread": self.thread.pk, "text": ""},
+                {"thread": self.thread.pk, "text": "third"},
+            ]
+        }
+        response = self.client.post(url, data=data)
+        # Fail due to Unauthorized
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.force_authenticate(user=self.user1)
+        response = self.client.post(url, data=data)
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.json()["created"], 3)
+        self.assertEqual(response.json()["failed"], 3)
+        results = response.json()["results"]
+        self.assertEqual(
+            [result["status"] for result in results], [201, 201, 403, 404, 400, 201]
+        )
+        self.assertIn("text", results[4]["errors"])
+
+        messages = Message.objects.filter(sender=self.user1).order_by("pk")
+        messages = messages.exclude(pk=self.message.pk)
+        self.assertEqual(
+            [(message.pk, message.thread_id, message.text) for message in messages],
+            [
+                (results[i]["message"]["id"], results[i]["message"]["thread"], text)
+                for i, text in [(0, "first"), (1, "second"), (5, "third")]
+            ],
+        )
+        self.assertEqual(check_thread_summaries(), [])
+        self.assertEqual(
+            ParticipantSummary.objects.get(
+                thread=thread2, user=self.user3
+            ).unread_count,
+            1,
+        )
+
+        # the number of queries depends on the number of threads, not of messages
+        def count_queries(count):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(
+                    url,
+                    data={
+                        "messages": [
+                            {"thread": self.thread.pk, "text": f"text {i}"}
+                            for i in range(count)
+                        ]
+                    },
+                )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            return len(queries)
+
+        self.assertEqual(count_queries(2), count_queries(50))
+
+    def test_threads_read_until(self):
+        """
+        Ensure user can read messages of many threads at once
+        only if user is in all of the thread participants.
+        """
+        url = reverse("dialogs:threads_read_until")
+        # thread 2 with `participants = [1, 3]`, thread 3 with `participants = [2, 3]`
+        thread2, _ = get_or_create_thread([self.user1, self.user3])
+        thread3, _ = get_or_create_thread([self.user2, self.user3])
+        messages = [
+            Message.objects.create(text=f"text {i}", thread=thread3, sender=self.user3)
+            for i in range(3)
+        ]
+        rebuild_thread_summaries()
+
+        data = {self.thread.pk: self.message.pk, thread3.pk: messages[1].pk}
+        response = self.client.post(url, data=data)
+        # Fail due to Unauthorized
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.force_authenticate(user=self.user2)
+        # Fail due to user 2 has no permission to access thread 2
+        response = self.client.post(url, data={**data, thread2.pk: 1})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.post(url, data={**data, 100: 1})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(
+            ParticipantSummary.objects.get(
+                thread=thread3, user=self.user2
+            ).unread_count,
+            3,
+        )
+        response = self.client.post(url, data={self.thread.pk: 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(url, data=data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            {"unread": {str(self.thread.pk): 0, str(thread3.pk): 1}, "total_unread": 1},
+        )
+        self.assertEqual(
+            list(Message.objects.unread_by(self.user2).order_by("pk")), messages[2:]
+        )
+        self.assertEqual(check_thread_summaries(), [])
+
+        # the number of queries doesn't depend on the number of threads
+        def count_queries(threads):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(
+                    url, data={thread.pk: messages[-1].pk for thread in threads}
+                )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return len(queries)
+
+        self.assertEqual(
+            count_queries([thread3]), count_queries([self.thread, thread3])
+        )
+
+    def test_unread_badge(self):
+        """
+        Ensure user gets unread counts of user's threads from one query
+        and an unchanged badge isn't sent again.
+        """
+        url = reverse("dialogs:unread_badge")
+        # thread 2 with `participants = [2, 3]`
+        thread, _ = get_or_create_thread([self.user2, self.user3])
+        for i in range(3):
+            record_message_created(
+                Message.objects.create(
+                    text=f"text {i}", thread=thread, sender=self.user3
+                )
+            )
+        # thread 1 message is sent by user 1
+        unread = {str(self.thread.pk): 1, str(thread.pk): 3}
+
+        response = self.client.get(url)
+        # Fail due to Unauthorized
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.force_authenticate(user=self.user2)
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {"total_unread": 4, "threads": unread})
+        etag = response["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+
+        # reading the thread changes the badge
+        read_all_interlocutor_messages(user=self.user2, thread_pk=thread.pk)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            {"total_unread": 1, "threads": {str(self.thread.pk): 1}},
+        )
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_cached_reads(self):
+        """
+        Ensure cached thread and message lists are invalidated by the changes
+        they depend on, with the local-memory and the file-based cache backends.
+        """
+        with tempfile.TemporaryDirectory() as location:
+            for backend, options in (
+                ("django.core.cache.backends.locmem.LocMemCache", {}),
+                (
+                    "django.core.cache.backends.filebased.FileBasedCache",
+                    {"LOCATION": location},
+                ),
+            ):
+                with self.subTest(backend=backend), self.settings(
+                    CACHES={
+                        **settings.CACHES,
+                        "dialogs": {"BACKEND": backend, **options},
+                    }
+                ):
+                    caching.clear()
+                    self.assert_cached_reads()
+
+    def assert_cached_reads(self):
+        self.client.force_authenticate(user=self.user2)
+        # thread 2 with `participants = [2, 3]`
+        thread, _ = get_or_create_thread([self.user2, self.user3])
+        message_list_url = reverse("dialogs:message_list", args=[thread.pk])
+
+        def get(url):
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return response.json(), len(context)
+
+        def unread():
+            data, _ = get(self.thread_list_url)
+            return {item["id"]: item["num_unread_messages"] for item in data["results"]}
+
+        caching.reset_stats()
+        cold, cold_queries = get(self.thread_list_url)
+        warm, warm_queries = get(self.thread_list_url)
+        self.assertEqual(warm, cold)
+        self.assertEqual(warm_queries, 0)
+        self.assertLess(warm_queries, cold_queries)
+        self.assertEqual(caching.get_stats()["thread_pages"], {"hits": 1, "misses": 1})
+
+        # a new message changes the inbox of both participants
+        response = self.client.post(message_list_url, {"text": "hi"})
+        self.client.force_authenticate(user=self.user3)
+        self.assertEqual(unread(), {thread.pk: 1})
+        get(message_list_url)
+        self.client.force_authenticate(user=self.user2)
+        self.assertEqual(unread(), {self.thread.pk: 1, thread.pk: 0})
+
+        # editing a message changes the cached message pages
+        message_detail_url = reverse(
+            "dialogs:message_detail", args=[response.json()["id"]]
+        )
+        self.client.patch(message_detail_url, {"text": "edited"})
+        data, _ = get(message_list_url)
+        self.assertEqual([item["text"] for item in data["results"]], ["edited"])
+        self.assertFalse(data["results"][0]["is_read"])
+
+        # reading changes `is_read` of the messages and the unread counts
+        self.client.force_authenticate(user=self.user3)
+        read_all_interlocutor_messages(user=self.user3, thread_pk=thread.pk)
+        self.assertEqual(unread(), {thread.pk: 0})
+        data, _ = get(message_list_url)
+        self.assertTrue(data["results"][0]["is_read"])
+
+        # leaving the thread
+        self.client.delete(reverse("dialogs:thread_detail", args=[thread.pk]))
+        self.assertEqual(unread(), {})
+        Thread.objects.filter(pk=thread.pk).delete()
+
+    def test_jwt_authentication_queries(self):
+        """
+        Ensure users authenticated by JWT are served from the cache
+        until their tokens are revoked or they are deactivated.
+        """
+        token = self._get_user_token(email=self.user1.email)
+
+        def get():
+            caching.clear()  # only the authentication is compared
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(
+                    self.message_list_url, HTTP_AUTHORIZATION=token
+                )
+            user_queries = [
+                query["sql"]
+                for query in context.captured_queries
+                if 'FROM "accounts_user"' in query["sql"]
+            ]
+            return response.status_code, len(context), len(user_queries)
+
+        status_code, cold_queries, user_queries = get()
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual(user_queries, 1)
+        status_code, warm_queries, user_queries = get()
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual(user_queries, 0)
+        self.assertEqual(warm_queries, cold_queries - 1)
+
+        # deactivated users are rejected
+        self.user1.is_active = False
+        self.user1.save()
+        self.assertEqual(get()[0], status.HTTP_401_UNAUTHORIZED)
+        self.user1.is_active = True
+        self.user1.save()
+        self.assertEqual(get()[0], status.HTTP_200_OK)
+
+        # changing the password revokes the issued tokens
+        self.user1.set_password("newpassword")
+        self.user1.save()
+        self.assertEqual(get()[0], status.HTTP_401_UNAUTHORIZED)
+        token = self._get_user_token(email=self.user1.email, password="newpassword")
+        self.assertEqual(get()[0], status.HTTP_200_OK)
+
+        revoke_tokens(self.user1)
+        self.assertEqual(get()[0], status.HTTP_401_UNAUTHORIZED)
+
+    def test_jwt_user_cache_isolation(self):
+        """
+        Ensure every lookup of a cached user returns its own instance.
+        """
+        user_cache = get_user_cache()
+        user_cache.set(self.user1)
+        user = user_cache.get(self.user1.pk, self.user1.token_version)
+        self.assertEqual(user, self.user1)
+        self.assertEqual(user.email, self.user1.email)
+        self.assertIsNot(user, self.user1)
+
+        user.first_name = "changed"
+        user.token_version += 1
+        user.is_authenticated_by = "jwt"
+        cached_user = user_cache.get(self.user1.pk, self.user1.token_version)
+        self.assertIsNot(cached_user, user)
+        self.assertEqual(cached_user.first_name, self.user1.first_name)
+        self.assertEqual(cached_user.token_version, self.user1.token_version)
+        self.assertFalse(hasattr(cached_user, "is_authenticated_by"))
+        self.assertFalse(cached_user._state.adding)
+
+    def test_login_single_hash(self):
+        """
+        Ensure users log in by email or username with one query and one password hash.
+        """
+        hasher = type(get_hasher())
+        for login, password, logged_in in (
+            (self.user1.email, "testpassword", True),
+            (self.user1.email.upper(), "testpassword", True),
+            (self.user1.username, "testpassword", True),
+            (self.user1.username, "wrongpassword", False),
+            ("unknown", "testpassword", False),
+        ):
+            with self.subTest(login=login, password=password):
+                with patch.object(
+                    hasher, "encode", autospec=True, side_effect=hasher.encode
+                ) as encode, CaptureQueriesContext(connection) as context:
+                    response = self.client.post(
+                        self.login_url, {"email": login, "password": password}
+                    )
+                self.assertEqual("token" in response.json(), logged_in)
+                self.assertEqual(encode.call_count, 1)
+                self.assertEqual(len(context), 1)
+
+        plan = (
+            User.objects.annotate(email_lower=Lower("email"))
+            .filter(Q(email_lower="test1@gmail.com") | Q(username="test1"))
+            .explain()
+        )
+        self.assertNotRegex(plan, r"\bSCAN\b", msg=plan)
+
+    def test_throttling(self):
+        """
+        Ensure sending messages and logging in are throttled per user and per IP
+        and rejected requests are told when to retry.
+        """
+        rates = {"send": "3/min", "send_ip": "6/min", "login": "2/min"}
+        with self.settings(
+            REST_FRAMEWORK={**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": rates}
+        ):
+            self.client.force_authenticate(user=self.user1)
+            for _ in range(3):
+                response = self.client.post(self.message_list_url, {"text": "hi"})
+                self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            response = self.client.post(self.message_list_url, {"text": "hi"})
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            # a token comes back every 20 seconds
+            self.assertEqual(response["Retry-After"], "20")
+            # listing messages isn't throttled
+            response = self.client.get(self.message_list_url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            # user 2 has a bucket of its own, but shares the IP bucket
+            # (which the request rejected by the user bucket took a token from)
+            self.client.force_authenticate(user=self.user2)
+            for expected in (201, 201, 429):
+                response = self.client.post(self.message_list_url, {"text": "hi"})
+                self.assertEqual(response.status_code, expected)
+            self.assertEqual(response["Retry-After"], "10")
+
+            # login attempts are throttled per account
+            self.client.force_authenticate(user=None)
+            for email, expected in (
+                (self.user1.email, 200),
+                (self.user1.email.upper(), 200),
+                (self.user1.email, 429),
+                (self.user2.email, 200),
+            ):
+                response = self.client.post(
+                    self.login_url,
+                    {"email": email, "password": "testpassword"},
+                )
+                self.assertEqual(response.status_code, expected, email)
+            # only throttled per IP, rejected by the serializer
+            response = self.client.post(
+                self.login_url, [self.user1.email], format="json"
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_create_throttling(self):
+        """
+        Ensure every message of a bulk send takes a token and a batch larger than
+        the bucket is rejected, as waiting wouldn't help.
+        """
+        url = reverse("dialogs:message_bulk_create")
+        rates = {"send": "5/min", "send_ip": "50/min"}
+
+        def send(count):
+            data = {"messages": [{"thread": self.thread.pk, "text": "hi"}] * count}
+            return self.client.post(url, data=data)
+
+        self.client.force_authenticate(user=self.user1)
+        with self.settings(
+            REST_FRAMEWORK={**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": rates}
+        ):
+            messages = Message.objects.count()
+            response = send(6)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(
+                response.json(),
+                ["[ERROR] You can not send more than 5 messages at once"],
+            )
+            self.assertEqual(Message.objects.count(), messages)
+
+            self.assertEqual(send(3).status_code, status.HTTP_201_CREATED)
+            self.assertEqual(send(2).status_code, status.HTTP_201_CREATED)
+            response = send(1)
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(response["Retry-After"], "12")
+
+    def test_throttling_fairness(self):
+        """
+        Ensure a flooding client can't take the throughput of the others
+        and concurrent requests never take more tokens than a bucket holds.
+        """
+        clock = [1000.0]
+        view = SimpleNamespace(throttle_scope="send")
+        factory = APIRequestFactory()
+
+        def allow(user, address="127.0.0.1"):
+            request = factory.post("/", REMOTE_ADDR=address)
+            request.user = user
+            throttle = UserTokenBucketThrottle()
+            with patch.object(throttle, "timer", lambda: clock[0]):
+                return throttle.allow_request(request, view)
+
+        rates = {"send": "10/s"}
+        with self.settings(
+            REST_FRAMEWORK={**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": rates}
+        ):
+            # user 1 sends 10 times as many requests as user 2 and 3 for 10 seconds
+            allowed = {user.pk: 0 for user in (self.user1, self.user2, self.user3)}
+            for _ in range(100):
+                for user in (self.user1, self.user2, self.user3):
+                    attempts = 10 if user == self.user1 else 1
+                    allowed[user.pk] += sum(allow(user) for _ in range(attempts))
+                clock[0] += 0.1
+            # the burst of 10 and then 10 per second
+            self.assertEqual(allowed[self.user1.pk], 10 + 99)
+            self.assertEqual(allowed[self.user2.pk], 100)
+            self.assertEqual(allowed[self.user3.pk], 100)
+
+            # concurrent requests of a client at the same moment
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(lambda _: allow(self.user3), range(100)))
+            self.assertEqual(sum(results), 10)
+
+    def test_archive_messages(self):
+        """
+        Ensure read old messages are moved to the archive in chunks
+        and the message history keeps listing them.
+        """
+        self.client.force_authenticate(user=self.user1)
+        for i in range(5):
+            record_message_created(
+                Message.objects.create(
+                    text=f"message {i}", thread=self.thread, sender=self.user2
+                )
+            )
+        ids = list(
+            Message.objects.filter(thread=self.thread)
+            .order_by("pk")
+            .values_list("pk", flat=True)
+        )
+        read_all_interlocutor_messages(user=self.user2, thread_pk=self.thread.pk)
+        read_interlocutor_messages_until(self.user1, self.thread.pk, ids[3])
+        response = self.client.get(self.message_list_url)
+        expected = response.json()["results"]
+
+        # nothing is old enough yet
+        self.assertEqual(archive_messages(timezone.now() - timedelta(days=1)), 0)
+        # messages unread by user 1 stay
+        out = StringIO()
+        call_command("archive_messages", days=0, chunk_size=3, stdout=out)
+        self.assertIn("Archived 4 messages", out.getvalue())
+        self.assertEqual(
+            list(ArchivedMessage.objects.order_by("pk").values_list("pk", flat=True)),
+            ids[:4],
+        )
+        self.assertEqual(
+            list(Message.objects.order_by("pk").values_list("pk", flat=True)), ids[4:]
+        )
+        self.assertEqual(check_thread_summaries(), [])
+
+        response = self.client.get(self.message_list_url)
+        self.assertEqual(response.json()["count"], 6)
+        self.assertEqual(response.json()["results"], expected)
+        caching.clear()  # the page size isn't a part of the cache key
+        with patch.object(MessagePagination, "page_size", 5):
+            first = self.client.get(self.message_list_url).json()
+            second = self.client.get(first["next"]).json()
+        self.assertEqual(first["results"], expected[:5])
+        self.assertEqual(second["results"], expected[5:])
+
+        # paging backward falls through to the archive
+        response = self.client.get(self.message_list_url, {"limit": 3})
+        data = response.json()
+        self.assertEqual(data["results"], expected[-3:])
+        data = self.client.get(data["previous"]).json()
+        self.assertEqual(data["results"], expected[:3])
+        self.assertIsNone(data["previous"])
+        data = self.client.get(data["next"]).json()
+        self.assertEqual(data["results"], expected[3:])
+
+        response = self.client.get(self.message_list_url, {"after": ids[1]})
+        self.assertEqual(response.json()["results"], expected[2:])
+
+    def test_message_search(self):
+        """
+        Ensure user finds only messages of user's threads, best matches first,
+        and the index follows message edits and deletions.
+        """
+        url = reverse("dialogs:message_search")
+        thread3, _ = get_or_create_thread([self.user2, self.user3])
+        Message.objects.create(
+            text="hello from thread 3", thread=thread3, sender=self.user3
+        )
+        self.client.force_authenticate(user=self.user1)
+        ids = []
+        for text in ("Hello world", "héllo hello there", "nothing here", "world"):
+            response = self.client.post(self.message_list_url, {"text": text})
+            ids.append(response.json()["id"])
+
+        def search(query, **params):
+            response = self.client.get(url, {"q": query, **params})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return response.json()
+
+        data = search("hello")
+        self.assertEqual([result["id"] for result in data["results"]], ids[1::-1])
+        self.assertEqual(
+            data["results"][0]["highlighted"],
+            "<mark>héllo</mark> <mark>hello</mark> there",
+        )
+        # the text is HTML escaped, only the highlights are tags
+        self.client.post(
+            self.message_list_url, {"text": "<script>alert(1)</script> & xss"}
+        )
+        data = search("xss")
+        self.assertEqual(
+            data["results"][0]["highlighted"],
+            "&lt;script&gt;alert(1)&lt;/script&gt; &amp; <mark>xss</mark>",
+        )
+        data = search("script")
+        self.assertEqual(
+            data["results"][0]["highlighted"],
+            "&lt;<mark>script</mark>&gt;alert(1)&lt;/<mark>script</mark>&gt; &amp; xss",
+        )
+        self.assertEqual(data["results"][0]["thread"], self.thread.pk)
+        data = search("hello", limit=1)
+        self.assertEqual([result["id"] for result in data["results"]], [ids[1]])
+        data = self.client.get(data["next"]).json()
+        self.assertEqual([result["id"] for result in data["results"]], [ids[0]])
+        self.assertIsNone(data["next"])
+        # all of the words, FTS5 syntax is ignored
+        data = search('WORLD "hello*')
+        self.assertEqual([result["id"] for result in data["results"]], [ids[0]])
+        response = self.client.get(url, {"q": "* -"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with self.settings(
+            DIALOGS_SEARCH_BACKEND="dialogs.search.DatabaseSearchBackend"
+        ):
+            data = search("world")
+        self.assertEqual({result["id"] for result in data["results"]}, {ids[0], ids[3]})
+
+        message_url = reverse("dialogs:message_detail", args=[ids[0]])
+        self.client.patch(message_url, {"text": "goodbye world"})
+        self.assertEqual(
+            [result["id"] for result in search("hello")["results"]], ids[1:2]
+        )
+        self.assertEqual(
+            [result["id"] for result in search("goodbye")["results"]], ids[:1]
+        )
+        self.client.delete(message_url)
+        self.assertEqual(search("goodbye")["results"], [])
+
+        out = StringIO()
+        call_command("rebuild_search_index", stdout=out)
+        self.assertIn(f"Indexed {Message.objects.count()} messages", out.getvalue())
+        self.assertEqual(
+            [result["id"] for result in search("world")["results"]], ids[3:]
+        )
+
+    def test_search_thread_delete(self):
+        """
+        Ensure deleting a thread drops the search entries of its hot and archived
+        messages only.
+        """
+        thread2, _ = get_or_create_thread([self.user1, self.user3])
+        self.client.force_authenticate(user=self.user1)
+        self.client.post(self.message_list_url, {"text": "kept"})
+        url = reverse("dialogs:message_list", args=[thread2.pk])
+        for text in ("archived", "dropped", "dropped too"):
+            self.client.post(url, {"text": text})
+        archived = ArchivedMessage.objects.create(
+            id=Message.objects.get(text="archived").pk,
+            text="archived",
+            thread=thread2,
+            sender=self.user1,
+            created_at=timezone.now(),
+            updated_at=timezone.now(),
+        )
+        # as archived, the index entry is kept
+        Message.objects.filter(pk=archived.pk)._raw_delete("default")
+        kept = MessageSearchEntry.objects.filter(thread_id=self.thread.pk).count()
+        self.assertEqual(
+            MessageSearchEntry.objects.filter(thread_id=thread2.pk).count(), 3
+        )
+
+        self.client.force_authenticate(user=self.user3)
+        self.client.delete(reverse("dialogs:thread_detail", args=[thread2.pk]))
+        self.client.force_authenticate(user=self.user1)
+        response = self.client.delete(
+            reverse("dialogs:thread_detail", args=[thread2.pk])
+        )
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Thread.objects.filter(pk=thread2.pk).exists())
+        self.assertFalse(
+            MessageSearchEntry.objects.filter(thread_id=thread2.pk).exists()
+        )
+        self.assertEqual(
+            MessageSearchEntry.objects.filter(thread_id=self.thread.pk).count(), kept
+        )
+
+    def test_message_export(self):
+        """
+        Ensure participants can stream the whole history of a thread
+        with memory not growing with the thread.
+        """
+        url = reverse("dialogs:message_export", args=[self.thread.pk])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.client.force_authenticate(user=self.user3)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=self.user1)
+        Message.objects.create(
+            text='with "quotes",\nand lines', thread=self.thread, sender=self.user2
+        )
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response["Content-Type"], "application/x-ndjson; charset=utf-8"
+        )
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        messages = [json.loads(line) for line in lines]
+        self.assertEqual(
+            [(data["id"], data["sender"], data["text"]) for data in messages],
+            list(Message.objects.order_by("pk").values_list("pk", "sender", "text")),
+        )
+
+        response = self.client.get(url, {"format": "csv"})
+        self.assertEqual(response["Content-Type"], "text/csv; charset=utf-8")
+        content = b"".join(response.streaming_content).decode()
+        rows = list(csv.reader(StringIO(content)))
+        self.assertEqual(rows[0], ["id", "sender", "text", "created_at", "updated_at"])
+        self.assertEqual(
+            [row[2] for row in rows[1:]], [data["text"] for data in messages]
+        )
+        self.assertEqual(rows[1][3], messages[0]["created_at"])
+
+        def peak_memory(message_count):
+            Message.objects.bulk_create(
+                [
+                    Message(text="x" * 100, thread=self.thread, sender=self.user2)
+                    for _ in range(message_count - Message.objects.count())
+                ]
+            )
+            tracemalloc.start()
+            try:
+                response = self.client.get(url)
+                lines = sum(1 for _ in response.streaming_content)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(lines, message_count)
+            return peak
+
+        with patch.object(MessageExport, "chunk_size", 100):
+            small, large = peak_memory(1000), peak_memory(10000)
+        # rather than 10 times the memory
+        self.assertLess(large, small * 1.5)
+
+    def test_generate_dataset(self):
+        """
+        Ensure the generated dataset is consistent and the same for the same seed.
+        """
+        out = StringIO()
+        options = {"users": 10, "threads": 20, "messages": 5, "seed": 1}
+        options["stdout"] = out
+        call_command("generate_dataset", prefix="first", **options)
+        self.assertIn("Generated 10 users, 20 threads and 100 messages", out.getvalue())
+        self.assertEqual(check_thread_summaries(), [])
+        self.assertTrue(User.objects.get(username="first0").check_password("password"))
+
+        def texts_by_thread(prefix):
+            threads = Thread.objects.filter(participants__username__startswith=prefix)
+            messages = Message.objects.filter(thread__in=threads).order_by("pk")
+            thread_ids = list(dict.fromkeys(message.thread_id for message in messages))
+            return [
+                (thread_ids.index(message.thread_id), message.text)
+                for message in messages
+            ]
+
+        call_command("generate_dataset", prefix="second", **options)
+        self.assertEqual(check_thread_summaries(), [])
+        self.assertEqual(texts_by_thread("first"), texts_by_thread("second"))
+        self.assertEqual(len(texts_by_thread("first")), 100)
+
+        with self.assertRaises(CommandError):
+            call_command("generate_dataset", users=3, threads=4, stdout=out)
+
+    def test_metrics(self):
+        """
+        Ensure requests are measured, their timings sent in the `Server-Timing`
+        header and the metrics served in the Prometheus format.
+        """
+        metrics_url = reverse("metrics")
+        export_url = reverse("dialogs:message_export", args=[self.thread.pk])
+        self.client.force_authenticate(user=self.user1)
+        response = self.client.get(self.thread_list_url)
+        self.assertNotIn("Server-Timing", response)
+        response = self.client.get(metrics_url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        reset_metrics()
+        caching.clear()
+        with override_settings(DIALOGS_METRICS_ENABLED=True):
+            client = APIClient()
+            client.force_authenticate(user=self.user1)
+            response = client.get(self.thread_list_url)
+            self.assertRegex(
+                response["Server-Timing"],
+                r'^total;dur=[\d.]+, db;dur=[\d.]+;desc="\d+ queries", '
+                r"serializer;dur=[\d.]+$",
+            )
+            list_size = len(response.content)
+            export_size = len(b"".join(client.get(export_url).streaming_content))
+            # neither public nor open to any user
+            response = APIClient().get(metrics_url)
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+            response = client.get(metrics_url)
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            with override_settings(DIALOGS_METRICS_TOKEN="secret"):
+                response = APIClient().get(
+                    metrics_url, HTTP_AUTHORIZATION="Bearer wrong"
+                )
+                self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+                response = APIClient().get(
+                    metrics_url, HTTP_AUTHORIZATION="Bearer secret"
+                )
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+            User.objects.filter(pk=self.user1.pk).update(is_staff=True)
+            self.user1.refresh_from_db()
+            client.force_authenticate(user=self.user1)
+            response = client.get(
+                metrics_url, HTTP_ACCEPT="text/plain;version=0.0.4;q=0.5,*/*;q=0.1"
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/plain; charset=utf-8")
+
+        lines = dict(
+            line.rsplit(" ", 1)
+            for line in response.content.decode().splitlines()
+            if not line.startswith("#")
+        )
+        labels = 'view="dialogs:thread_list",method="GET"'
+        self.assertEqual(lines[f"http_request_duration_seconds_count{{{labels}}}"], "1")
+        self.assertEqual(
+            lines[f'http_request_db_queries_bucket{{{labels},le="+Inf"}}'], "1"
+        )
+        self.assertGreater(float(lines[f"http_request_db_queries_sum{{{labels}}}"]), 0)
+        self.assertGreater(
+            float(lines[f"http_request_serializer_duration_seconds_sum{{{labels}}}"]),
+            0,
+        )
+        self.assertEqual(
+            float(lines[f"http_response_size_bytes_sum{{{labels}}}"]), list_size
+        )
+        labels = 'view="dialogs:message_export",method="GET"'
+        self.assertEqual(
+            float(lines[f"http_response_size_bytes_sum{{{labels}}}"]), export_size
+        )
+
+
+class QueryBudgetTestCase(APITestCase):
+    """
+    Requests to every URL of `dialogs.urls` must keep within the query budgets of
+    their views at both data sizes, whatever the page sizes.
+    """
+
+    sizes = {
+        "small": {"users": 3, "threads": 2, "messages_per_thread": 3},
+        "large": {"users": 40, "threads": 300, "messages_per_thread": 10},
+    }
+
+    def setUp(self) -> None:
+        cache.clear()  # throttle buckets
+
+    def get_requests(self, prefix, **size):
+        """
+        Generates a dataset and returns the most active user of it along with
+        `(url name, method, path, data)` of requests to every URL, the destructive
+        ones last. Bulk sends grow with the size too.
+        """
+        generate_dataset(prefix=prefix, seed=1, **size)
+        user = User.objects.get(username=f"{prefix}0")
+        message = Message.objects.filter(sender=user).latest("pk")
+        thread_pk = message.thread_id
+        last_pk = ThreadSummary.objects.get(thread_id=thread_pk).last_message_id
+        stranger = User.objects.create(
+            username=f"{prefix}-stranger", email=f"{prefix}-stranger@gmail.com"
+        )
+        # another thread of the user, left by the interlocutor: deleting it deletes
+        # the thread along with its messages
+        left_thread = (
+            Thread.objects.filter(participants=user, thread_messages__isnull=False)
+            .exclude(pk=thread_pk)
+            .latest("pk")
+        )
+        for interlocutor in left_thread.participants.exclude(pk=user.pk):
+            leave_thread(thread=left_thread, user=interlocutor)
+
+        def url(name, *args):
+            return reverse(f"dialogs:{name}", args=args)
+
+        text = {"text": "within budget"}
+        return user, [
+            ("thread_list", "get", url("thread_list"), None),
+            (
+                "thread_list",
+                "post",
+                url("thread_list"),
+                {"participants": [user.pk, stranger.pk]},
+            ),
+            (
+                "threads_read_until",
+                "post",
+                url("threads_read_until"),
+                {str(thread_pk): last_pk},
+            ),
+            ("thread_detail", "get", url("thread_detail", thread_pk), None),
+            ("message_list", "get", url("message_list", thread_pk), None),
+            ("message_list", "post", url("message_list", thread_pk), text),
+            ("message_export", "get", url("message_export", thread_pk), None),
+            (
+                "message_bulk_create",
+                "post",
+                url("message_bulk_create"),
+                {
+                    "messages": [{"thread": thread_pk, **text}]
+                    * size["messages_per_thread"]
+                },
+            ),
+            ("message_detail", "get", url("message_detail", message.pk), None),
+            ("message_detail", "patch", url("message_detail", message.pk), text),
+            (
+                "messages_read_until",
+                "post",
+                url("messages_read_until", thread_pk),
+                {"message_id": last_pk},
+            ),
+            ("unread_badge", "get", url("unread_badge"), None),
+            (
+                "messages_since",
+                "get",
+                url("messages_since"),
+                {"since": 0, "timeout": 0},
+            ),
+            ("message_search", "get", url("message_search"), {"q": "hello"}),
+            ("message_detail", "delete", url("message_detail", message.pk), None),
+            ("thread_detail", "delete", url("thread_detail", thread_pk), None),
+            ("thread_detail", "delete", url("thread_detail", left_thread.pk), None),
+        ]
+
+    def test_query_budgets(self):
+        url_names = {pattern.name for pattern in urlpatterns}
+        # the most queries of every budget, which must have no slack
+        most = {}
+        for prefix, size in self.sizes.items():
+            user, requests = self.get_requests(prefix, **size)
+            self.assertEqual({request[0] for request in requests}, url_names)
+            token = f"JWT {jwt_encode_handler(jwt_payload_handler(user))}"
+            self.client.credentials(HTTP_AUTHORIZATION=token)
+
+            for name, method, path, data in requests:
+                with self.subTest(size=prefix, url=name, method=method):
+                    budget = get_query_budget(resolve(path).func, method)
+                    self.assertIsNotNone(budget, f"{method} {name} has no budget")
+                    # the worst case, nothing cached
+                    caching.clear()
+                    get_user_cache().clear()
+                    with capture_queries() as queries:
+                        response = getattr(self.client, method)(path, data)
+                        if response.streaming:
+                            b"".join(response.streaming_content)
+                    self.assertLess(response.status_code, 400, name)
+                    self.assertLessEqual(
+                        len(queries),
+                        budget,
+                        format_report(f"{method} {name}", budget, queries),
+                    )
+                    key = (f"{method} {name}", budget)
+                    most[key] = max(most.get(key, 0), len(queries))
+
+        for (request, budget), count in most.items():
+            with self.subTest(request=request):
+                self.assertEqual(count, budget, f"{request} makes at most {count}")
+
+    def test_query_budget_middleware(self):
+        """
+        Ensure requests over the budget are logged or fail, with their queries
+        grouped by fingerprint.
+        """
+        sql = "SELECT *  FROM t WHERE id IN (1, 2) AND name = 'a''b' LIMIT 21"
+        self.assertEqual(
+            fingerprint(sql), "SELECT * FROM t WHERE id IN (...) AND name = ? LIMIT ?"
+        )
+        user, _ = self.get_requests("budget", users=3, threads=2, messages_per_thread=3)
+        url = reverse("dialogs:thread_list")
+        with patch.object(ThreadListCreate, "query_budget", {"get": 1}):
+            with override_settings(DIALOGS_QUERY_BUDGET_MODE="log"):
+                client = APIClient()
+                client.force_authenticate(user=user)
+                with self.assertLogs("dialogs.querybudget", "WARNING") as logs:
+                    response = client.get(url)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertIn("GET dialogs:thread_list ran", logs.output[0])
+                self.assertIn("the budget is 1:\n  1x", logs.output[0])
+
+            caching.clear()
+            with override_settings(DIALOGS_QUERY_BUDGET_MODE="raise"):
+                client = APIClient()
+                client.force_authenticate(user=user)
+                with self.assertRaises(QueryBudgetExceeded):
+                    client.get(url)
+
+        with override_settings(DIALOGS_QUERY_BUDGET_MODE="raise"):
+            client = APIClient()
+            client.force_authenticate(user=user)
+            self.assertEqual(client.get(url).status_code, status.HTTP_200_OK)
+
+
+class MessagesSinceTestCase(TransactionTestCase):
+    def test_long_poll_wakeup(self):
+        """
+        Ensure a waiting long-poll request returns as soon as a message is sent.
+        """
+        user1, user2 = [
+            User.objects.create_user(
+                email=f"test{i}@gmail.com", username=f"test{i}", password="testpassword"
+            )
+            for i in range(1, 3)
+        ]
+        thread, _ = get_or_create_thread([user1, user2])
+
+        def poll():
+            client = APIClient()
+            client.force_authenticate(user=user1)
+            try:
+                return client.get(
+                    reverse("dialogs:messages_since"), {"since": 0, "timeout": 30}
+                )
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            started_at = time.monotonic()
+            future = executor.submit(poll)
+            time.sleep(0.2)  # lets the request start waiting
+            client = APIClient()
+            client.force_authenticate(user=user2)
+            message = client.post(
+                reverse("dialogs:message_list", args=[thread.pk]), {"text": "hello"}
+            ).json()
+            response = future.result(timeout=10)
+
+        self.assertLess(time.monotonic() - started_at, 10)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [item["id"] for item in response.json()["results"]], [message["id"]]
+        )
+
+
+class ThreadConcurrencyTestCase(TransactionTestCase):
+    def test_concurrent_thread_create(self):
+        """
+        Ensure parallel requests creating the same thread end up with exactly one thread.
+        """
+        users = [
+            User.objects.create_user(
+                email=f"test{i}@gmail.com", username=f"test{i}", password="testpassword"
+            )
+            for i in range(1, 3)
+        ]
+        url = reverse("dialogs:thread_list")
+        barrier = threading.Barrier(8)
+
+        def create_thread(user):
+            client = APIClient()
+            client.force_authenticate(user=user)
+            try:
+                barrier.wait()
+                return client.post(url, data={"participants": [u.pk for u in users]})
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(create_thread, users * 4))
+
+        self.assertEqual(
+            [response.status_code for response in responses],
+            [status.HTTP_201_CREATED] * 8,
+        )
+        self.assertEqual(Thread.objects.count(), 1)
+        self.assertEqual(
+            {response.json()["id"] for response in responses},
+            {Thread.objects.get().pk},
+        )
+
+    def test_concurrent_message_create(self):
+        """
+        Ensure parallel sends to the same threads are all created.
+        """
+        users = [
+            User.objects.create_user(
+                email=f"test{i}@gmail.com", username=f"test{i}", password="testpassword"
+            )
+            for i in range(1, 6)
+        ]
+        threads = [get_or_create_thread([users[0], user])[0] for user in users[1:]]
+        barrier = threading.Barrier(12)
+
+        def create_message(i):
+            thread = threads[i % len(threads)]
+            client = APIClient()
+            client.force_authenticate(user=users[0] if i % 2 else users[1 + i % 4])
+            try:
+                barrier.wait()
+                return client.post(
+                    reverse("dialogs:message_list", args=[thread.pk]),
+                    data={"text": f"message {i}"},
+                )
+            finally:
+                connection.close()
+
+        cache.clear()  # throttle buckets
+        with ThreadPoolExecutor(max_workers=12) as executor:
+            responses = list(executor.map(create_message, range(12)))
+
+        self.assertEqual(
+            [response.status_code for response in responses],
+            [status.HTTP_201_CREATED] * 12,
+        )
+        self.assertEqual(Message.objects.count(), 12)
+        self.assertEqual(check_thread_summaries(), [])
+
+
+class WebSocketTestCase(TransactionTestCase):
+    def setUp(self) -> None:
+        self.user1, self.user2 = [
+            User.objects.create_user(
+                email=f"test{i}@gmail.com", username=f"test{i}", password="testpassword"
+            )
+            for i in range(1, 3)
+        ]
+        self.thread, _ = get_or_create_thread([self.user1, self.user2])
+
+    def get_scope(self, token):
+        return {
+            "type": "websocket",
+            "path": "/api/v1/dialogs/ws/",
+            "query_string": f"token={token}".encode(),
+            "headers": [],
+        }
+
+    def post_message(self, user, text):
+        client = APIClient()
+        client.force_authenticate(user=user)
+        return client.post(
+            reverse("dialogs:message_list", args=[self.thread.pk]), {"text": text}
+        ).json()
+
+    async def test_websocket_events(self):
+        """
+        Ensure connected participants receive events of their threads.
+        """
+        token = jwt_encode_handler(jwt_payload_handler(self.user1))
+        communicator = ApplicationCommunicator(application, self.get_scope(token))
+        await communicator.send_input({"type": "websocket.connect"})
+        self.assertEqual(
+            (await communicator.receive_output(5))["type"], "websocket.accept"
+        )
+
+        message = await sync_to_async(self.post_message)(self.user2, "hello")
+        # the sender reads the thread before sending
+        event = json.loads((await communicator.receive_output(5))["text"])
+        self.assertEqual(event["type"], "messages.read")
+        self.assertEqual(event["user"], self.user2.pk)
+        event = json.loads((await communicator.receive_output(5))["text"])
+        self.assertEqual(event["type"], "message.created")
+        self.assertEqual(event["thread"], self.thread.pk)
+        self.assertEqual(event["message"]["id"], message["id"])
+        self.assertEqual(event["message"]["text"], "hello")
+
+        await communicator.send_input({"type": "websocket.disconnect", "code": 1000})
+        await communicator.wait(5)
+
+    async def test_websocket_unauthorized(self):
+        """
+        Ensure connections without a valid token are closed.
+        """
+        communicator = ApplicationCommunicator(application, self.get_scope("invalid"))
+        await communicator.send_input({"type": "websocket.connect"})
+        self.assertEqual(
+            await communicator.receive_output(5),
+            {"type": "websocket.close", "code": 4401},
+        )
+
+
+def get_middleware(asgi):
+    """
+    Returns the middleware of the settings as `asgi.py` or `wsgi.py` loads them.
+    """
+    environ = {
+        name: value for name, value in os.environ.items() if name != "DJANGO_ASGI"
+    }
+    if asgi:
+        environ["DJANGO_ASGI"] = "1"
+    with patch.dict(os.environ, environ, clear=True):
+        return runpy.run_path(
+            import_module(os.environ["DJANGO_SETTINGS_MODULE"]).__file__
+        )["MIDDLEWARE"]
+
+
+@override_settings(MIDDLEWARE=get_middleware(asgi=True))
+class AsyncViewsTestCase(TransactionTestCase):
+    def setUp(self) -> None:
+        self.user1, self.user2 = [
+            User.objects.create_user(
+                email=f"test{i}@gmail.com", username=f"test{i}", password="testpassword"
+            )
+            for i in range(1, 3)
+        ]
+        self.thread, _ = get_or_create_thread([self.user1, self.user2])
+        self.message = Message.objects.create(
+            text="hello", thread=self.thread, sender=self.user2
+        )
+        record_message_created(self.message)
+        self.url = f"/api/v1/dialogs/threads/{self.thread.pk}/messages/"
+
+    async def send_request(self, handler, method, path, user, query="", data=None):
+        """
+        Returns the start message of the response and its whole body.
+        """
+        token = jwt_encode_handler(jwt_payload_handler(user))
+        body = json.dumps(data).encode() if data is not None else b""
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "query_string": query.encode(),
+            "headers": [
+                (b"host", b"testserver"),
+                (b"authorization", f"JWT {token}".encode()),
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+        communicator = ApplicationCommunicator(handler, scope)
+        await communicator.send_input({"type": "http.request", "body": body})
+        start = await communicator.receive_output(10)
+        body = b""
+        while True:
+            message = await communicator.receive_output(10)
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                return start, body
+
+    async def request(self, handler, method, path, user, query="", data=None):
+        start, body = await self.send_request(handler, method, path, user, query, data)
+        return start["status"], json.loads(body)
+
+    def test_async_urlconf(self):
+        """
+        Ensure ASGI serves the message endpoints by the async views, which keep the
+        query budgets of their DRF views.
+        """
+        match = resolve(self.url, urlconf="yalantis_django.urls_asgi")
+        self.assertIs(match.func, asyncviews.message_list)
+        self.assertEqual(match.view_name, "dialogs:message_list")
+        self.assertEqual(
+            get_query_budget(match.func, "POST"), MessageViewSet.query_budget["create"]
+        )
+        match = resolve(self.url + "read_until/", urlconf="yalantis_django.urls_asgi")
+        self.assertIs(match.func, asyncviews.messages_read_until)
+        match = resolve(
+            "/api/v1/dialogs/messages/since/", urlconf="yalantis_django.urls_asgi"
+        )
+        self.assertIs(match.func, asyncviews.messages_since)
+        self.assertEqual(
+            get_query_budget(match.func, "GET"), MessagesSince.query_budget
+        )
+        match = resolve(self.url + "export/", urlconf="yalantis_django.urls_asgi")
+        self.assertIs(match.func, asyncviews.message_export)
+        self.assertEqual(match.view_name, "dialogs:message_export")
+        self.assertEqual(
+            get_query_budget(match.func, "GET"), MessageExport.query_budget
+        )
+
+    def test_async_middleware(self):
+        """
+        Ensure no middleware takes the ASGI requests out of the event loop, unlike the
+        sync only debug toolbar of the WSGI settings.
+        """
+        for asgi in (False, True):
+            with override_settings(MIDDLEWARE=get_middleware(asgi), DEBUG=True), patch(
+                "django.core.handlers.base.logger"
+            ) as logger:
+                AsyncURLConfHandler()
+            calls = logger.debug.call_args_list
+            unused = [
+                f"middleware {call.args[1]}"
+                for call in calls
+                if call.args[0].startswith("MiddlewareNotUsed")
+            ]
+            adapted = [
+                call.args[1]
+                for call in calls
+                if call.args[0].endswith(" adapted.") and call.args[1] not in unused
+            ]
+            if asgi:
+                self.assertEqual(adapted, [])
+            else:
+                self.assertEqual(
+                    adapted,
+                    ["middleware debug_toolbar.middleware.DebugToolbarMiddleware"],
+                )
+
+    async def test_async_message_endpoints(self):
+        """
+        Ensure a waiting message listing doesn't hold up other requests and is woken
+        up by a new message.
+        """
+        handler = AsyncURLConfHandler()
+        started_at = time.monotonic()
+        poll = asyncio.ensure_future(
+            self.request(
+                handler,
+                "GET",
+                self.url,
+                self.user1,
+                query=f"after={self.message.pk}&timeout=10",
+            )
+        )
+        await asyncio.sleep(0.3)  # lets the request start waiting
+        self.assertFalse(poll.done())
+
+        status_code, message = await self.request(
+            handler, "POST", self.url, self.user2, data={"text": "how are you?"}
+        )
+        self.assertEqual(status_code, status.HTTP_201_CREATED)
+        status_code, page = await asyncio.wait_for(poll, 5)
+        self.assertLess(time.monotonic() - started_at, 5)
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual([item["id"] for item in page["results"]], [message["id"]])
+
+        status_code, _ = await self.request(
+            handler,
+            "POST",
+            self.url + "read_until/",
+            self.user1,
+            data={"message_id": message["id"]},
+        )
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        summary = await sync_to_async(ParticipantSummary.objects.get)(
+            thread=self.thread, user=self.user1
+        )
+        self.assertEqual(summary.last_read_message_id, message["id"])
+
+        # nothing new, the listing waits until the timeout
+        started_at = time.monotonic()
+        status_code, page = await self.request(
+            handler,
+            "GET",
+            self.url,
+            self.user1,
+            query=f"after={message['id']}&timeout=0.3",
+        )
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.3)
+        self.assertEqual((status_code, page["results"]), (status.HTTP_200_OK, []))
+
+        status_code, _ = await self.request(
+            handler, "GET", self.url, self.user1, query="after=1&timeout=soon"
+        )
+        self.assertEqual(status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_async_messages_since(self):
+        """
+        Ensure ASGI waits for the messages since a given one on the event loop, both
+        in the long-poll and in the SSE mode.
+        """
+        handler = AsyncURLConfHandler()
+        url = "/api/v1/dialogs/messages/since/"
+        query = f"since={self.message.pk}"
+        poll = asyncio.ensure_future(
+            self.request(handler, "GET", url, self.user1, query=f"{query}&timeout=10")
+        )
+        stream = asyncio.ensure_future(
+            self.send_request(
+                handler, "GET", url, self.user1, query=f"{query}&timeout=1&format=sse"
+            )
+        )
+        await asyncio.sleep(0.3)  # lets the requests start waiting
+        self.assertFalse(poll.done())
+
+        status_code, message = await self.request(
+            handler, "POST", self.url, self.user2, data={"text": "how are you?"}
+        )
+        self.assertEqual(status_code, status.HTTP_201_CREATED)
+        status_code, data = await asyncio.wait_for(poll, 5)
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual([item["id"] for item in data["results"]], [message["id"]])
+        self.assertEqual(data["last_id"], message["id"])
+
+        # streamed until the timeout
+        start, body = await asyncio.wait_for(stream, 5)
+        self.assertEqual(start["status"], status.HTTP_200_OK)
+        self.assertEqual(dict(start["headers"])[b"Content-Type"], b"text/event-stream")
+        self.assertIn(f"id: {message['id']}\nevent: message\n", body.decode())
+
+        # nothing new in the thread, the long-poll waits until the timeout
+        started_at = time.monotonic()
+        status_code, data = await self.request(
+            handler,
+            "GET",
+            url,
+            self.user1,
+            query=f"since={message['id']}&thread={self.thread.pk}&timeout=0.3",
+        )
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.3)
+        self.assertEqual(
+            (status_code, data),
+            (status.HTTP_200_OK, {"results": [], "last_id": message["id"]}),
+        )
+
+        status_code, _ = await self.request(
+            handler, "GET", url, self.user1, query="since=1&timeout=soon"
+        )
+        self.assertEqual(status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_async_concurrent_requests(self):
+        """
+        Ensure waiting long-polls and listings served at the same time under ASGI
+        don't hold up each other.
+        """
+        handler = AsyncURLConfHandler()
+        polls = [
+            asyncio.ensure_future(
+                self.request(
+                    handler, "GET", path, self.user1, query=f"{query}&timeout=10"
+                )
+            )
+            for path, query in (
+                ("/api/v1/dialogs/messages/since/", f"since={self.message.pk}"),
+                (self.url, f"after={self.message.pk}"),
+            )
+        ]
+        await asyncio.sleep(0.3)  # lets the requests start waiting
+
+        # an async listing and a sync one, run in the shared thread of Django
+        started_at = time.monotonic()
+        listings = await asyncio.gather(
+            self.request(handler, "GET", self.url, self.user1),
+            self.request(handler, "GET", "/api/v1/dialogs/threads/", self.user1),
+        )
+        self.assertLess(time.monotonic() - started_at, 2)
+        self.assertEqual(
+            [status_code for status_code, _ in listings], [status.HTTP_200_OK] * 2
+        )
+        self.assertFalse(any(poll.done() for poll in polls))
+
+        status_code, message = await self.request(
+            handler, "POST", self.url, self.user2, data={"text": "how are you?"}
+        )
+        self.assertEqual(status_code, status.HTTP_201_CREATED)
+        for status_code, data in await asyncio.wait_for(asyncio.gather(*polls), 5):
+            self.assertEqual(status_code, status.HTTP_200_OK)
+            self.assertEqual([item["id"] for item in data["results"]], [message["id"]])
+
+    async def test_async_message_export(self):
+        """
+        Ensure ASGI streams the history of a thread chunk by chunk, archived messages
+        first.
+        """
+
+        def create_messages():
+            messages = [
+                Message.objects.create(
+                    text=f"message {i}", thread=self.thread, sender=self.user1
+                )
+                for i in range(4)
+            ]
+            for message in messages:
+                record_message_created(message)
+            # the first message archived as by `archive_messages`
+            ArchivedMessage.objects.create(
+                id=self.message.pk,
+                text=self.message.text,
+                thread=self.thread,
+                sender=self.user2,
+                created_at=self.message.created_at,
+                updated_at=self.message.updated_at,
+            )
+            Message.objects.filter(pk=self.message.pk)._raw_delete("default")
+            return [self.message.pk] + [message.pk for message in messages]
+
+        message_pks = await sync_to_async(create_messages)()
+        handler = AsyncURLConfHandler()
+        with patch.object(asyncviews.AsyncMessageExport, "chunk_size", 2):
+            start, body = await self.send_request(
+                handler, "GET", self.url + "export/", self.user1
+            )
+            self.assertEqual(start["status"], status.HTTP_200_OK)
+            self.assertEqual(
+                [json.loads(line)["id"] for line in body.decode().splitlines()],
+                message_pks,
+            )
+
+            start, body = await self.send_request(
+                handler, "GET", self.url + "export/", self.user1, query="format=csv"
+            )
+        rows = list(csv.reader(StringIO(body.decode())))
+        self.assertEqual(rows[0], list(MessageExport.fields))
+        self.assertEqual([int(row[0]) for row in rows[1:]], message_pks)
+
+    async def test_async_metrics(self):
+        """
+        Ensure the queries of requests are measured under ASGI, whichever thread
+        runs them.
+        """
+        with override_settings(DIALOGS_METRICS_ENABLED=True):
+            handler = AsyncURLConfHandler()
+        for path in (self.url, "/api/v1/dialogs/threads/"):
+            await sync_to_async(caching.clear)()
+            start, _ = await self.send_request(handler, "GET", path, self.user1)
+            self.assertEqual(start["status"], status.HTTP_200_OK)
+            self.assertRegex(
+                dict(start["headers"])[b"Server-Timing"].decode(),
+                r'db;dur=[\d.]+;desc="[1-9]\d* queries"',
+            )
+
+
+# the dialogs cache would serve the reads whatever the database
+@override_settings(DIALOGS_READ_REPLICAS=["replica"], DIALOGS_CACHE_ALIAS=None)
+class ReplicaRoutingTestCase(TransactionTestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self) -> None:
+        self.user1, self.user2 = [
+            User.objects.create_user(
+                email=f"test{i}@gmail.com", username=f"test{i}", password="testpassword"
+            )
+            for i in range(1, 3)
+        ]
+        self.thread, _ = get_or_create_thread([self.user1, self.user2])
+        self.message = Message.objects.create(
+            text="hello", thread=self.thread, sender=self.user2
+        )
+        record_message_created(self.message)
+        self.url = reverse("dialogs:message_list", args=[self.thread.pk])
+        self.replicate()
+        cache.clear()  # marks of the users who wrote
+
+    @staticmethod
+    def replicate():
+        """
+        Copies the primary into the replica, as the replication would.
+        """
+        for alias in ("default", "replica"):
+            connections[alias].ensure_connection()
+        connections["default"].connection.backup(connections["replica"].connection)
+
+    def request(self, user, method, url, data=None):
+        client = APIClient()
+        client.force_authenticate(user=user)
+        with CaptureQueriesContext(connections["replica"]) as replica_queries:
+            response = getattr(client, method)(url, data)
+        return response, len(replica_queries)
+
+    def list_message_ids(self, user):
+        response, replica_queries = self.request(user, "get", self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item["id"] for item in response.json()["results"]], replica_queries
+
+    def test_replica_reads(self):
+        """
+        Ensure safe requests read the dialogs from the replica, lag included.
+        """
+        self.assertEqual(self.list_message_ids(self.user1)[0], [self.message.pk])
+        self.assertGreater(self.list_message_ids(self.user1)[1], 0)
+
+        message = Message.objects.create(
+            text="lagging", thread=self.thread, sender=self.user2
+        )
+        record_message_created(message)
+        self.assertEqual(self.list_message_ids(self.user1)[0], [self.message.pk])
+        self.replicate()
+        self.assertEqual(
+            sorted(self.list_message_ids(self.user1)[0]), [self.message.pk, message.pk]
+        )
+
+    @override_settings(DIALOGS_REPLICA_LAG=1)
+    def test_read_your_writes(self):
+        """
+        Ensure writes and the reads of their writer within the lag go to the primary.
+        """
+        response, replica_queries = self.request(
+            self.user1, "post", self.url, {"text": "hi"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(replica_queries, 0)
+        message_pk = response.json()["id"]
+
+        ids, replica_queries = self.list_message_ids(self.user1)
+        self.assertIn(message_pk, ids)
+        self.assertEqual(replica_queries, 0)
+        # the other participant reads from the lagging replica
+        self.assertNotIn(message_pk, self.list_message_ids(self.user2)[0])
+
+        time.sleep(1.1)  # the lag is over
+        ids, replica_queries = self.list_message_ids(self.user1)
+        self.assertNotIn(message_pk, ids)
+        self.assertGreater(replica_queries, 0)
+
+    def test_read_until_lag(self):
+        """
+        Ensure messages can be read until one the replica doesn't have yet, and the
+        unread counts of the reader are up to date right after.
+        """
+        response, _ = self.request(self.user2, "post", self.url, {"text": "new"})
+        message_pk = response.json()["id"]
+
+        response, replica_queries = self.request(
+            self.user1,
+            "post",
+            reverse("dialogs:messages_read_until", args=[self.thread.pk]),
+            {"message_id": message_pk},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(replica_queries, 0)
+        summary = ParticipantSummary.objects.get(thread=self.thread, user=self.user1)
+        self.assertEqual(summary.last_read_message_id, message_pk)
+        self.assertEqual(summary.unread_count, 0)
+        # the replica still counts the messages as unread
+        self.assertEqual(
+            ParticipantSummary.objects.using("replica")
+            .get(thread=self.thread, user=self.user1)
+            .unread_count,
+            1,
+        )
+
+        response, replica_queries = self.request(
+            self.user1, "get", reverse("dialogs:unread_badge")
+        )
+        self.assertEqual(response.json()["total_unread"], 0)
+        self.assertEqual(replica_queries, 0)
+
+    def test_cache_timeout(self):
+        """
+        Ensure entries cached from the replica don't outlive the replica lag.
+        """
+        with override_settings(DIALOGS_CACHE_ALIAS="dialogs"), patch.object(
+            caching.get_cache(), "set", wraps=caching.get_cache().set
+        ) as cache_set:
+            self.request(self.user1, "get", self.url)
+        self.assertEqual(
+            {
+                call.kwargs["timeout"]
+                for call in cache_set.call_args_list
+                # versions are bumped by a set of some backends
+                if not call.args[0].endswith(":version")
+            },
+            {settings.DIALOGS_REPLICA_LAG},
         )
-        for message in read_messages:
-            self.assertEqual(message.is_read, True)
@@ -0,0 +1,125 @@
+"""
+Token bucket throttles of the API.
+
+For the rate "N/period" of a scope (`DEFAULT_THROTTLE_RATES`), a bucket holds up to N
+tokens and is refilled with N tokens per period. Every request takes a token, or
+`get_throttle_cost(request)` tokens when the view defines it. A request costing more
+tokens than the bucket holds is always rejected.
+
+The state of a bucket is a single integer in the cache: the time (in milliseconds) at
+which the bucket is full again. Requests move it by atomic `incr`/`decr`, so concurrent
+requests never overwrite each other's updates. This works with any cache backend, but
+only a backend shared by all processes gives one bucket per client.
+"""
+import hashlib
+import math
+from typing import Optional
+
+from rest_framework.settings import api_settings
+from rest_framework.throttling import SimpleRateThrottle
+
+
+class TokenBucketThrottle(SimpleRateThrottle):
+    """
+    Throttles the views with a `throttle_scope` by the rate of that scope
+    (followed by `rate_suffix`).
+    """
+
+    cache_format = "throttle_bucket_%(scope)s_%(ident)s"
+    rate_suffix = ""
+
+    def __init__(self):
+        # the rate is determined by the view in `allow_request`
+        pass
+
+    def get_ident_key(self, request, view) -> Optional[str]:
+        """
+        Returns the identity of the bucket the request takes tokens from,
+        `None` for requests not throttled by this class.
+        """
+        raise NotImplementedError(".get_ident_key() must be overridden")
+
+    def allow_request(self, request, view):
+        scope = getattr(view, "throttle_scope", None)
+        if not scope:
+            return True
+        self.scope = scope + self.rate_suffix
+        # looked up on every request, so the rates can be overridden at runtime
+        self.rate = api_settings.DEFAULT_THROTTLE_RATES.get(self.scope)
+        if self.rate is None:
+            return True
+        ident = self.get_ident_key(request, view)
+        if ident is None:
+            return True
+        self.key = self.cache_format % {"scope": self.scope, "ident": ident}
+
+        num_requests, duration = self.parse_rate(self.rate)
+        interval = duration * 1000 / num_requests
+        cost = 1
+        if hasattr(view, "get_throttle_cost"):
+            cost = max(1, view.get_throttle_cost(request))
+        if cost > num_requests:
+            # it would never fit, retrying doesn't help
+            self.wait_seconds = None
+            return False
+        taken = math.ceil(interval * cost)
+        capacity = duration * 1000
+        now = int(self.timer() * 1000)
+
+        # a missing bucket is a full one
+        self.cache.add(self.key, now, timeout=duration)
+        try:
+            full_at = self.cache.incr(self.key, taken)
+        except ValueError:  # expired in between
+            self.cache.add(self.key, now + taken, timeout=duration)
+            full_at = now + taken
+        if full_at - taken < now:
+            # the bucket has been full for a while, it refills from now on. A request
+            # updating the bucket concurrently may get its token back here.
+            full_at = now + taken
+            self.cache.set(self.key, full_at, timeout=duration)
+
+        if full_at - now > capacity:
+            # rejected requests take no tokens
+            try:
+                self.cache.decr(self.key, taken)
+            except ValueError:
+                pass
+            self.wait_seconds = (full_at - now - capacity) / 1000
+            return False
+
+        # the bucket is only needed until it is full again
+        self.cache.touch(self.key, timeout=math.ceil((full_at - now) / 1000) + 1)
+        return True
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class UserTokenBucketThrottle(TokenBucketThrottle):
+    """
+    A bucket per user, or per the identity returned by `get_throttle_ident(request)`
+    of the view (e.g. the account a login attempt is for).
+    """
+
+    def get_ident_key(self, request, view):
+        if hasattr(view, "get_throttle_ident"):
+            ident = view.get_throttle_ident(request)
+            if ident is None:
+                return None
+            # the identity may be any client supplied string
+            return f"ident:{hashlib.md5(ident.encode()).hexdigest()}"
+        if request.user and request.user.is_authenticated:
+            return f"user:{request.user.pk}"
+        return None
+
+
+class IPTokenBucketThrottle(TokenBucketThrottle):
+    """
+    A bucket per client IP address, by the rate of the `<scope>_ip` scope.
+    """
+
+    rate_suffix = "_ip"
+
+    def get_ident_key(self, request, view):
+        return f"ip:{self.get_ident(request)}"
@@ -4,6 +4,11 @@ from . import views
 app_name = "dialogs"
 urlpatterns = [
     path("threads/", views.ThreadListCreate.as_view(), name="thread_list"),
+    path(
+        "threads/read_until/",
+        views.ThreadsReadUntil.as_view(),
+        name="threads_read_until",
+    ),
     path(
         "threads/<int:pk>/",
         views.ThreadRetrieveDestroy.as_view(),
@@ -14,6 +19,16 @@ urlpatterns = [
         views.MessageViewSet.as_view({"get": "list", "post": "create"}),
         name="message_list",
     ),
+    path(
+        "threads/<int:thread_pk>/messages/export/",
+        views.MessageExport.as_view(),
+        name="message_export",
+    ),
+    path(
+        "messages/bulk/",
+        views.MessageBulkCreate.as_view(),
+        name="message_bulk_create",
+    ),
     path(
         "messages/<int:pk>/",
         views.MessageViewSet.as_view(
@@ -26,4 +41,7 @@ urlpatterns = [
         views.MessagesReadUntil.as_view(),
         name="messages_read_until",
     ),
+    path("unread/", views.UnreadBadge.as_view(), name="unread_badge"),
+    path("messages/since/", views.MessagesSince.as_view(), name="messages_since"),
+    path("messages/search/", views.MessageSearch.as_view(), name="message_search"),
 ]
@@ -1,31 +1,143 @@
+import hashlib
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.http import parse_etags, quote_etag
 from rest_framework import generics, permissions, status, viewsets
-from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
+from rest_framework.settings import api_settings
+from . import caching, events, metrics, routers
 from .serializers import (
+    BulkMessageSerializer,
     ThreadSerializer,
     MessageSerializer,
+    MessageSearchResultSerializer,
 )
-from .models import Thread, Message
+from .models import ArchivedMessage, Thread, Message
 from .services import (
+    create_messages,
+    delete_thread,
+    get_read_watermarks,
+    get_unread_counts,
+    get_unread_total,
+    leave_thread,
     read_interlocutor_messages_until,
+    read_interlocutor_messages_until_many,
     read_all_interlocutor_messages,
+    record_message_created,
+    record_message_deleted,
+    record_message_updated,
+)
+from .pagination import MessagePagination, SearchPagination, ThreadPagination
+from .permissions import IsMetricsScraper, IsThreadParticipant, MessagePermission
+from .pubsub import SyncSubscription, get_pubsub, user_channel
+from .renderers import (
+    CSVRenderer,
+    EventStreamRenderer,
+    NDJSONRenderer,
+    PrometheusRenderer,
+    format_csv,
+    format_event,
+    format_ndjson,
 )
-from .permissions import IsThreadParticipant, MessagePermission
+from .search import get_search_backend, parse_terms
+
+
+class ThreadLookupMixin:
+    def get_thread(self, thread_pk=None):
+        """
+        Returns the thread of `thread_pk` (the `thread_pk` URL kwarg by default) and
+        checks thread permissions.
+        The membership of the requesting user is fetched along with the thread.
+        """
+        thread = get_object_or_404(
+            Thread.objects.with_membership(self.request.user),
+            pk=thread_pk if thread_pk is not None else self.kwargs.get("thread_pk"),
+        )
+        self.check_object_permissions(request=self.request, obj=thread)
+        return thread
 
 
 class ThreadListCreate(generics.ListCreateAPIView):
     serializer_class = ThreadSerializer
     permission_classes = [permissions.IsAuthenticated]
-    pagination_class = PageNumberPagination
+    # most queries per request, nothing cached (see `dialogs.querybudget`), the user
+    # of the token is always one of them:
+    # - get: the page count and ids, the threads, their participants, unread counts
+    # - post: both participants, the thread of the pair, creating the thread with its
+    #   participants and summaries (6), participants for the invalidation (2), the
+    #   created thread with its participants (3)
+    query_budget = {"get": 6, "post": 15}
+    pagination_class = ThreadPagination
 
     def get_queryset(self):
         # GET list of Threads that belongs only to user who is making request
-        return Thread.objects.filter(participants=self.request.user).order_by(
-            "-created_at"
+        return (
+            Thread.objects.filter(participants=self.request.user)
+            .with_inbox_data(self.request.user)
+            .order_by("-created_at")
+        )
+
+    def get_throttles(self):
+        # only creating threads is throttled
+        self.throttle_scope = "thread_create" if self.request.method == "POST" else None
+        return super().get_throttles()
+
+    def list(self, request, *args, **kwargs):
+        """
+        Lists the threads of the user. The thread ids of the page, the threads and the
+        unread counts of the user are cached separately, so a change of a thread only
+        reloads what depends on it.
+        """
+        page = caching.get_or_load(
+            "thread_pages",
+            caching.USER,
+            request.user.pk,
+            self.load_page,
+            suffix=request.get_full_path(),
+        )
+        threads = caching.get_or_load_many(
+            "threads", caching.THREAD, page["results"], self.load_threads
+        )
+        unread = caching.get_or_load(
+            "unread_counts",
+            caching.USER,
+            request.user.pk,
+            lambda: get_unread_counts(request.user),
         )
 
+        results = []
+        for thread_pk in page["results"]:
+            thread = dict(threads[thread_pk])
+            thread["num_unread_messages"] = unread.get(thread_pk, 0)
+            results.append(thread)
+        return Response({**page, "results": results})
+
+    def load_page(self):
+        """
+        Returns the paginated response data with thread ids as results.
+        """
+        queryset = (
+            Thread.objects.filter(participants=self.request.user)
+            .annotate(last_activity=F("summary__last_activity"))
+            .order_by("-created_at")
+        )
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response([thread.pk for thread in page]).data
+
+    def load_threads(self, thread_pks):
+        threads = self.get_queryset().filter(pk__in=thread_pks)
+        return {
+            thread["id"]: thread
+            for thread in self.get_serializer(threads, many=True).data
+        }
+
     def post(self, request, *args, **kwargs):
         serializer = ThreadSerializer(data=request.data, context={"request": request})
 
@@ -38,67 +150,135 @@ class ThreadListCreate(generics.ListCreateAPIView):
 class ThreadRetrieveDestroy(generics.RetrieveDestroyAPIView):
     serializer_class = ThreadSerializer
     permission_classes = [permissions.IsAuthenticated, IsThreadParticipant]
+    # - delete: the thread with its participants, then either leaving it (3) or
+    #   deleting it (10, see `delete_thread`)
+    query_budget = {"get": 3, "delete": 13}
 
     def get_queryset(self):
-        return Thread.objects.all()
+        return Thread.objects.with_inbox_data(self.request.user).with_membership(
+            self.request.user
+        )
 
     def delete(self, request, *args, **kwargs):
         thread = self.get_object()  # checking thread permissions here
 
         # delete thread if there are no participants
         if thread.participants.count() <= 1:
-            return self.destroy(request, *args, **kwargs)
+            delete_thread(thread)
+            return Response(status=status.HTTP_204_NO_CONTENT)
 
         # delete participant from thread
-        thread.participants.remove(self.request.user)
+        leave_thread(thread=thread, user=self.request.user)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class MessageViewSet(viewsets.ModelViewSet):
+class MessageViewSet(ThreadLookupMixin, viewsets.ModelViewSet):
     serializer_class = MessageSerializer
+    pagination_class = MessagePagination
     permission_classes = [permissions.IsAuthenticated, IsThreadParticipant]
+    # - list: the thread, read watermarks, both counts and the page of messages
+    # - create: the thread, reading it, validating the sender and thread (2), saving
+    #   the message with its summaries and search entry (4), participants and read
+    #   watermarks for the invalidation and the events (4)
+    # - retrieve: the message, its sender and the read watermarks
+    # - partial_update: the message and its sender, saving it with its summary and
+    #   search entry (4), participants and read watermarks for the events (2)
+    # - destroy: the message and its sender, deleting it and rebuilding the summaries
+    #   of the thread (8), its search entry, participants for the invalidation and
+    #   the events (2)
+    query_budget = {
+        "list": 6,
+        "create": 13,
+        "retrieve": 4,
+        "partial_update": 9,
+        "destroy": 14,
+    }
 
     def get_queryset(self):
         return Message.objects.all()
 
+    def get_archive_queryset(self):
+        """
+        Archived history of the thread, listed by `MessagePagination` before the
+        messages of `get_queryset()`.
+        """
+        return ArchivedMessage.objects.filter(thread_id=self.kwargs["thread_pk"])
+
     def list(self, request, *args, **kwargs):
         """
         Lists a queryset.
         """
-        thread = get_object_or_404(Thread, pk=self.kwargs.get("thread_pk"))
-        # checking thread permissions
-        self.check_object_permissions(request=self.request, obj=thread)
+        thread = self.get_thread()  # checking thread permissions here
+
+        # pages are the same for all of the participants
+        data = caching.get_or_load(
+            "message_pages",
+            caching.THREAD,
+            thread.pk,
+            lambda: self.load_page(thread),
+            suffix=request.get_full_path(),
+        )
+        return Response(data)
 
-        queryset = self.get_queryset().filter(thread=thread)
+    def load_page(self, thread):
+        queryset = self.get_queryset().filter(thread=thread).order_by("pk")
+        # `is_read` of the listed messages is derived from these
+        self.read_watermarks = get_read_watermarks([thread.pk])
 
         page = self.paginate_queryset(queryset)
         if page is not None:
             serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+            return self.get_paginated_response(serializer.data).data
 
-        serializer = self.get_serializer(self.queryset, many=True)
-        return Response(serializer.data)
+        serializer = self.get_serializer(queryset, many=True)
+        return serializer.data
 
     def create(self, request, *args, **kwargs):
         """
         Creates a Message instance.
         """
-        thread = get_object_or_404(Thread, pk=self.kwargs.get("thread_pk"))
-        # checking thread permissions
-        self.check_object_permissions(request=self.request, obj=thread)
+        thread = self.get_thread()  # checking thread permissions here
 
-        # read all previous interlocutor's messages before sending a new one
-        read_all_interlocutor_messages(user=request.user, thread_pk=thread.pk)
+        # the transaction starts by a write: on SQLite a transaction which read first
+        # can't take the write lock while another one holds it, and fails at once
+        with transaction.atomic():
+            # read all previous interlocutor's messages before sending a new one
+            read_all_interlocutor_messages(user=request.user, thread_pk=thread.pk)
 
-        # defining request.user as a sender of created message and specifying a thread the message belongs to
-        request.data.update(sender=request.user.id, thread=self.kwargs.get("thread_pk"))
-        serializer = self.get_serializer(data=request.data)
-        if not serializer.is_valid():
-            raise ValidationError(serializer.errors)
+            # defining request.user as a sender of created message and specifying a thread the message belongs to
+            request.data.update(
+                sender=request.user.id, thread=self.kwargs.get("thread_pk")
+            )
+            serializer = self.get_serializer(data=request.data)
+            if not serializer.is_valid():
+                raise ValidationError(serializer.errors)
 
-        msg = serializer.save()
+            msg = serializer.save()
+            record_message_created(msg)
         return Response(self.get_serializer(msg).data, status=status.HTTP_201_CREATED)
 
+    @transaction.atomic
+    def perform_update(self, serializer):
+        msg = serializer.save()
+        record_message_updated(msg)
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        message_pk = instance.pk
+        instance.delete()
+        record_message_deleted(thread_pk=instance.thread_id, message_pk=message_pk)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if getattr(self, "read_watermarks", None) is not None:
+            context["read_watermarks"] = self.read_watermarks
+        return context
+
+    def get_throttles(self):
+        # only sending messages is throttled
+        self.throttle_scope = "send" if self.action == "create" else None
+        return super().get_throttles()
+
     def get_permissions(self):
         """
         Instantiates and returns the list of permissions that this view requires.
@@ -110,20 +290,487 @@ class MessageViewSet(viewsets.ModelViewSet):
         return super().get_permissions()
 
 
-class MessagesReadUntil(generics.CreateAPIView):
+class MessageBulkCreate(generics.GenericAPIView):
+    """
+    Sends many messages, to one or several threads, in a single request.
+
+    Accepts `{"messages": [{"thread": <id>, "text": <text>}, ...]}` and returns a result
+    per item in the same order: `201` with the created message, or `400`/`403`/`404`
+    with the errors of the item. Valid items are created even when others fail
+    (the response is `207 Multi-Status` then). Every message takes a token of the
+    "send" throttle buckets, so a batch holds no more messages than the buckets hold
+    tokens.
+    """
+
+    serializer_class = MessageSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    # the user of the token, the threads, reading them, saving the messages with their
+    # summaries and search entries (5), participants and read watermarks for the
+    # invalidation and the events (4), whatever the number of messages
+    query_budget = 12
+    max_batch_size = 500
+    throttle_scope = "send"
+
+    def get_max_batch_size(self):
+        """
+        Returns `max_batch_size`, or the tokens of the smallest "send" bucket when it
+        holds fewer: a larger batch would never be let through.
+        """
+        sizes = [self.max_batch_size]
+        for throttle in self.get_throttles():
+            scope = self.throttle_scope + getattr(throttle, "rate_suffix", "")
+            rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope)
+            if rate is not None:
+                sizes.append(throttle.parse_rate(rate)[0])
+        return min(sizes)
+
+    def get_items(self, request):
+        items = request.data.get("messages") if isinstance(request.data, dict) else None
+        if not isinstance(items, list) or not items:
+            raise ValidationError("[ERROR] You must provide messages")
+        max_batch_size = self.get_max_batch_size()
+        if len(items) > max_batch_size:
+            raise ValidationError(
+                f"[ERROR] You can not send more than {max_batch_size} messages at once"
+            )
+        return items
+
+    def check_throttles(self, request):
+        # invalid batches are rejected before they take any tokens
+        self.get_items(request)
+        super().check_throttles(request)
+
+    def get_throttle_cost(self, request):
+        # every message takes a token
+        return len(self.get_items(request))
+
+    def post(self, request, *args, **kwargs):
+        items = self.get_items(request)
+
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            serializer = BulkMessageSerializer(data=item)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                results[index] = self.error(
+                    status.HTTP_400_BAD_REQUEST, serializer.errors
+                )
+
+        # membership of the requesting user, once per thread
+        memberships = dict(
+            Thread.objects.filter(pk__in={data["thread"] for _, data in valid})
+            .with_membership(request.user)
+            .values_list("pk", "is_participant")
+        )
+        allowed = []
+        for index, data in valid:
+            if data["thread"] not in memberships:
+                results[index] = self.error(status.HTTP_404_NOT_FOUND, "Not found.")
+            elif not memberships[data["thread"]]:
+                results[index] = self.error(
+                    status.HTTP_403_FORBIDDEN,
+                    "You do not have permission to perform this action.",
+                )
+            else:
+                allowed.append((index, data))
+
+        messages = create_messages(
+            sender=request.user,
+            items=[(data["thread"], data["text"]) for _, data in allowed],
+        )
+        context = self.get_serializer_context()
+        context["read_watermarks"] = get_read_watermarks(
+            {data["thread"] for _, data in allowed}
+        )
+        for (index, _), message in zip(allowed, messages):
+            results[index] = {
+                "status": status.HTTP_201_CREATED,
+                "message": MessageSerializer(message, context=context).data,
+            }
+
+        if len(messages) == len(items):
+            response_status = status.HTTP_201_CREATED
+        elif messages:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response(
+            {
+                "created": len(messages),
+                "failed": len(items) - len(messages),
+                "results": results,
+            },
+            status=response_status,
+        )
+
+    @staticmethod
+    def error(status_code, errors):
+        return {"status": status_code, "errors": errors}
+
+
+class MessagesReadUntil(ThreadLookupMixin, generics.CreateAPIView):
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated, IsThreadParticipant]
+    # the user of the token, the thread, moving the watermark and recounting (2), read
+    # watermarks for the event and the unread counts of the response
+    query_budget = 6
+    throttle_scope = "read_until"
 
     def post(self, request, *args, **kwargs):
-        thread = get_object_or_404(Thread, pk=self.kwargs.get("thread_pk"))
-        # checking thread permissions
-        self.check_object_permissions(request=self.request, obj=thread)
+        thread = self.get_thread()  # checking thread permissions here
 
-        message_pk = request.data.get("message_id")
+        try:
+            message_pk = int(request.data["message_id"])
+        except (KeyError, TypeError, ValueError):
+            raise ValidationError("[ERROR] You must provide message_id")
 
         read_interlocutor_messages_until(
             user=request.user, thread_pk=thread.pk, message_pk=message_pk
         )
 
         return Response({"action": "Done"}, status=status.HTTP_200_OK)
+
+
+class MessagesSince(ThreadLookupMixin, generics.GenericAPIView):
+    """
+    Returns messages newer than the `since` message id, of the `thread` thread or of
+    all the threads of the user, for clients which can't hold a WebSocket.
+
+    The long-poll mode (default) responds as soon as there are new messages or when
+    `timeout` seconds have passed. The SSE mode (`Accept: text/event-stream` or
+    `?format=sse`) keeps streaming new messages until the timeout.
+    Waiting requests don't poll the database, they are woken up by the
+    `message.created` events published by `MessageViewSet.create`. Under ASGI they
+    wait on the event loop instead of a thread (see `dialogs.asyncviews`).
+    """
+
+    serializer_class = MessageSerializer
+    permission_classes = [permissions.IsAuthenticated, IsThreadParticipant]
+    query_budget = 3
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, EventStreamRenderer]
+    max_limit = 100
+
+    def get(self, request, *args, **kwargs):
+        # the events announce messages the replicas may not have yet
+        routers.use_primary()
+        since = self.get_number_param("since", int)
+        if since is None:
+            raise ValidationError("[ERROR] You must provide since")
+        limit = min(
+            self.get_number_param("limit", int) or self.max_limit, self.max_limit
+        )
+        thread_pk = self.get_number_param("thread", int)
+        # checking thread permissions here
+        thread = self.get_thread(thread_pk) if thread_pk is not None else None
+
+        if request.accepted_renderer.format == EventStreamRenderer.format:
+            # reconnecting EventSource clients resume after the last received message
+            last_event_id = request.META.get("HTTP_LAST_EVENT_ID", "")
+            if last_event_id.isdigit():
+                since = max(since, int(last_event_id))
+            timeout = self.get_timeout(settings.DIALOGS_SSE_TIMEOUT)
+            response = self.get_streaming_response(
+                self.stream_messages(thread, since, limit, timeout),
+                content_type=EventStreamRenderer.media_type,
+            )
+            response["Cache-Control"] = "no-cache"
+            # disables response buffering of nginx
+            response["X-Accel-Buffering"] = "no"
+            return response
+
+        timeout = self.get_timeout(settings.DIALOGS_LONG_POLL_TIMEOUT)
+        messages = self.poll_messages(thread, since, limit, timeout)
+        return Response(
+            {
+                "results": self.serialize(messages),
+                "last_id": messages[-1].pk if messages else since,
+            }
+        )
+
+    def get_streaming_response(self, content, **kwargs):
+        return StreamingHttpResponse(content, **kwargs)
+
+    def poll_messages(self, thread, since, limit, timeout):
+        """
+        Returns the messages after `since`, waiting up to `timeout` seconds for new
+        ones when there are none yet.
+        """
+        deadline = time.monotonic() + timeout
+        with self.subscribe() as subscription:
+            messages = self.get_messages(thread, since, limit)
+            while not messages and self.wait_for_message(
+                subscription, thread, deadline
+            ):
+                messages = self.get_messages(thread, since, limit)
+        return messages
+
+    def stream_messages(self, thread, since, limit, timeout):
+        deadline = time.monotonic() + timeout
+        with self.subscribe() as subscription:
+            while True:
+                messages = self.get_messages(thread, since, limit)
+                for data in self.serialize(messages):
+                    yield format_event(data, event="message", id=data["id"])
+                if messages:
+                    since = messages[-1].pk
+                if len(messages) == limit:
+                    continue  # more messages are waiting
+
+                while not self.wait_for_message(
+                    subscription,
+                    thread,
+                    min(deadline, time.monotonic() + settings.DIALOGS_SSE_HEARTBEAT),
+                ):
+                    if time.monotonic() >= deadline:
+                        return
+                    # keeps proxies from dropping an idle connection
+                    yield ": keep-alive\n\n"
+
+    def get_messages(self, thread, since, limit):
+        queryset = Message.objects.filter(pk__gt=since)
+        if thread is not None:
+            queryset = queryset.filter(thread=thread)
+        else:
+            queryset = queryset.filter(thread__participants=self.request.user)
+        return list(queryset.order_by("pk")[:limit])
+
+    def serialize(self, messages):
+        context = self.get_serializer_context()
+        # `is_read` of the messages of all the listed threads in one query
+        context["read_watermarks"] = get_read_watermarks(
+            {message.thread_id for message in messages}
+        )
+        return MessageSerializer(messages, many=True, context=context).data
+
+    @staticmethod
+    def wait_for_message(subscription, thread, deadline):
+        """
+        Waits for a new message of the thread (or of any thread when `None`) until the
+        `time.monotonic()` deadline. Returns whether a message was created.
+        """
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            event = subscription.get(timeout=remaining)
+            if event is None:
+                return False
+            if event["type"] == events.MESSAGE_CREATED and (
+                thread is None or event["thread"] == thread.pk
+            ):
+                return True
+
+    @contextmanager
+    def subscribe(self):
+        # subscribing before querying, so no message is missed in between
+        pubsub = get_pubsub()
+        subscription = SyncSubscription([user_channel(self.request.user.pk)])
+        pubsub.subscribe(subscription)
+        try:
+            yield subscription
+        finally:
+            pubsub.unsubscribe(subscription)
+
+    def get_timeout(self, max_timeout):
+        timeout = self.get_number_param("timeout", float)
+        return max_timeout if timeout is None else min(timeout, max_timeout)
+
+    def get_number_param(self, name, parser):
+        value = self.request.query_params.get(name)
+        if value is None:
+            return None
+        try:
+            value = parser(value)
+        except ValueError:
+            raise ValidationError(f"[ERROR] Invalid {name}")
+        if value < 0:
+            raise ValidationError(f"[ERROR] Invalid {name}")
+        return value
+
+
+class ThreadsReadUntil(generics.GenericAPIView):
+    """
+    Reads interlocutor's messages in many threads at once.
+
+    Accepts `{<thread_id>: <message_id>, ...}`, marks messages until `message_id` read
+    in every thread and returns the new unread counts by thread and in total.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+    # the user of the token, the threads, moving the watermarks and recounting (2),
+    # read watermarks for the events, the unread counts and total of the response
+    query_budget = 7
+    max_threads = 500
+    throttle_scope = "read_until"
+
+    def post(self, request, *args, **kwargs):
+        try:
+            message_pks = {
+                int(thread_pk): int(message_pk)
+                for thread_pk, message_pk in request.data.items()
+            }
+        except (AttributeError, TypeError, ValueError):
+            raise ValidationError("[ERROR] You must provide {thread_id: message_id}")
+        if len(message_pks) > self.max_threads:
+            raise ValidationError(
+                f"[ERROR] You can not read more than {self.max_threads} threads at once"
+            )
+
+        # checking thread permissions of all threads in one query
+        memberships = dict(
+            Thread.objects.filter(pk__in=list(message_pks))
+            .with_membership(request.user)
+            .values_list("pk", "is_participant")
+        )
+        if len(memberships) < len(message_pks):
+            raise NotFound()
+        if not all(memberships.values()):
+            raise PermissionDenied()
+
+        unread = read_interlocutor_messages_until_many(
+            user=request.user, message_pks=message_pks
+        )
+        return Response(
+            {"unread": unread, "total_unread": get_unread_total(request.user)},
+            status=status.HTTP_200_OK,
+        )
+
+
+class UnreadBadge(generics.GenericAPIView):
+    """
+    Returns the total number of unread messages of the user and the unread counts of
+    the threads with unread messages, `{thread_id: unread}`, from one query of the
+    precomputed counters. Requests with the `If-None-Match` of an unchanged badge get
+    `304 Not Modified` without the badge being rendered.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
+
+    def get(self, request, *args, **kwargs):
+        unread = get_unread_counts(request.user)
+        etag = quote_etag(
+            hashlib.md5(repr(sorted(unread.items())).encode()).hexdigest()
+        )
+
+        if etag in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", "")):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(
+                {"total_unread": sum(unread.values()), "threads": unread},
+                status=status.HTTP_200_OK,
+            )
+        response["ETag"] = etag
+        # the badge is personal, shared caches must not store it
+        response["Cache-Control"] = "private, no-cache"
+        return response
+
+
+class MessageSearch(generics.ListAPIView):
+    """
+    Full-text search of the messages of the user's threads. Finds the messages
+    containing all of the words of the `q` query parameter, the best matches first.
+    """
+
+    serializer_class = MessageSearchResultSerializer
+    pagination_class = SearchPagination
+    permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
+    query_param = "q"
+
+    def get_queryset(self):
+        terms = parse_terms(self.request.query_params.get(self.query_param, ""))
+        if not terms:
+            raise ValidationError("[ERROR] You must provide words to search for")
+        return get_search_backend().search(self.request.user, terms)
+
+
+class MessageExport(ThreadLookupMixin, generics.GenericAPIView):
+    """
+    Streams the whole history of a thread, archived messages included, as NDJSON
+    (one message per line, the default) or CSV (`?format=csv`).
+    Messages are read as plain values in chunks, so the memory taken doesn't grow
+    with the thread.
+    """
+
+    permission_classes = [permissions.IsAuthenticated, IsThreadParticipant]
+    # the user of the token, the thread, then the archived and hot messages, one
+    # query each however many chunks they are streamed in (streamed after the view,
+    # under ASGI by a query per chunk)
+    query_budget = 4
+    renderer_classes = [NDJSONRenderer, CSVRenderer]
+    fields = ("id", "sender", "text", "created_at", "updated_at")
+    chunk_size = 2000
+
+    def get(self, request, *args, **kwargs):
+        thread = self.get_thread()  # checking thread permissions here
+
+        renderer = request.accepted_renderer
+        response = self.get_streaming_response(
+            self.get_content(thread),
+            content_type=f"{renderer.media_type}; charset={renderer.charset}",
+        )
+        response[
+            "Content-Disposition"
+        ] = f'attachment; filename="thread-{thread.pk}.{renderer.format}"'
+        return response
+
+    def get_streaming_response(self, content, **kwargs):
+        return StreamingHttpResponse(content, **kwargs)
+
+    def get_content(self, thread):
+        return self.format(self.get_rows(thread))
+
+    def format(self, rows, header=True):
+        if self.request.accepted_renderer.format == CSVRenderer.format:
+            return format_csv(self.fields if header else None, rows)
+        return format_ndjson(dict(zip(self.fields, row)) for row in rows)
+
+    @property
+    def columns(self):
+        return ["sender_id" if field == "sender" else field for field in self.fields]
+
+    def get_rows(self, thread):
+        # the archived messages of a thread precede the hot ones
+        for model in (ArchivedMessage, Message):
+            yield from (
+                model.objects.filter(thread=thread)
+                .order_by("pk")
+                .values_list(*self.columns)
+                .iterator(chunk_size=self.chunk_size)
+            )
+
+    def get_chunk(self, model, thread, after):
+        """
+        Returns the rows of up to `chunk_size` messages of `model` following the
+        `after` one, each chunk by a query of its own for callers which can't hold
+        a cursor open between the chunks (see `dialogs.asyncviews`).
+        """
+        return list(
+            model.objects.filter(thread=thread, pk__gt=after)
+            .order_by("pk")
+            .values_list(*self.columns)[: self.chunk_size]
+        )
+
+
+class Metrics(generics.GenericAPIView):
+    """
+    Serves the request metrics of this process in the Prometheus text format to
+    staff users and scrapers with the metrics token, not found when the metrics are
+    disabled.
+    """
+
+    permission_classes = [IsMetricsScraper]
+    renderer_classes = [PrometheusRenderer]
+
+    def initial(self, request, *args, **kwargs):
+        # not found by anyone while disabled, before authentication and permissions
+        if not settings.DIALOGS_METRICS_ENABLED:
+            raise NotFound()
+        super().initial(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        return Response(metrics.render_metrics())
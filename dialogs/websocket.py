@@ -0,0 +1,83 @@
+"""
+ASGI application pushing thread events to WebSocket clients.
+
+Clients authenticate with the same JWT as the REST API, passed either in the
+`Authorization: JWT <token>` header or in the `token` query parameter (browsers
+can't set headers on WebSocket handshakes). Once connected, a client receives every
+event (see `dialogs.events`) of the threads it participates in as a JSON text frame.
+"""
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.http import HttpRequest
+from rest_framework.exceptions import AuthenticationFailed
+
+from accounts.authentication import CachedJSONWebTokenAuthentication
+
+from .pubsub import AsyncSubscription, get_pubsub, user_channel
+
+# close code sent to clients which couldn't be authenticated
+CLOSE_UNAUTHORIZED = 4401
+
+
+def _authenticate(scope):
+    """
+    Returns the user of the JWT the connection was opened with or `None`.
+    """
+    request = HttpRequest()
+    headers = dict(scope.get("headers", ()))
+    token = parse_qs(scope.get("query_string", b"").decode()).get("token")
+    if token:
+        request.META["HTTP_AUTHORIZATION"] = f"JWT {token[0]}"
+    elif b"authorization" in headers:
+        request.META["HTTP_AUTHORIZATION"] = headers[b"authorization"].decode()
+
+    close_old_connections()
+    try:
+        result = CachedJSONWebTokenAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    finally:
+        close_old_connections()
+    return result[0] if result else None
+
+
+async def websocket_application(scope, receive, send):
+    message = await receive()
+    if message["type"] != "websocket.connect":
+        return
+
+    user = await sync_to_async(_authenticate)(scope)
+    if user is None:
+        await send({"type": "websocket.close", "code": CLOSE_UNAUTHORIZED})
+        return
+
+    pubsub = get_pubsub()
+    subscription = AsyncSubscription([user_channel(user.pk)])
+    pubsub.subscribe(subscription)
+    await send({"type": "websocket.accept"})
+
+    receiving = asyncio.ensure_future(receive())
+    delivering = asyncio.ensure_future(subscription.get())
+    try:
+        while True:
+            done, _ = await asyncio.wait(
+                {receiving, delivering}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if delivering in done:
+                await send(
+                    {"type": "websocket.send", "text": json.dumps(delivering.result())}
+                )
+                delivering = asyncio.ensure_future(subscription.get())
+            if receiving in done:
+                if receiving.result()["type"] == "websocket.disconnect":
+                    break
+                # clients have nothing to say, incoming frames are ignored
+                receiving = asyncio.ensure_future(receive())
+    finally:
+        pubsub.unsubscribe(subscription)
+        receiving.cancel()
+        delivering.cancel()
@@ -2,6 +2,10 @@
 ASGI config for yalantis_django project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests are served by Django with the ``urls_asgi`` URLconf (async message
+endpoints), streaming the async iterators of ``AsyncStreamingHttpResponse`` too.
+WebSocket connections are routed by path to the applications of
+``websocket_routes``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
@@ -9,8 +13,70 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.core.handlers.asgi import ASGIHandler, ASGIRequest
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "yalantis_django.settings")
+# the settings leave the sync only middleware out
+os.environ.setdefault("DJANGO_ASGI", "1")
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+
+class AsyncURLConfRequest(ASGIRequest):
+    urlconf = "yalantis_django.urls_asgi"
+
+
+class AsyncURLConfHandler(ASGIHandler):
+    request_class = AsyncURLConfRequest
+
+    async def send_response(self, response, send):
+        """
+        Sends responses as Django does, the async iterators of
+        ``AsyncStreamingHttpResponse`` included.
+        """
+        if not isinstance(response, AsyncStreamingHttpResponse):
+            return await super().send_response(response, send)
+
+        async def send_content(message):
+            # Django closes the (empty) sync content with a final body message, the
+            # async content goes before it
+            if message["type"] == "http.response.body" and not message.get("more_body"):
+                try:
+                    async for part in response.async_content:
+                        for chunk, _ in self.chunk_bytes(response.make_bytes(part)):
+                            await send(
+                                {
+                                    "type": "http.response.body",
+                                    "body": chunk,
+                                    "more_body": True,
+                                }
+                            )
+                finally:
+                    await response.async_content.aclose()
+            await send(message)
+
+        await super().send_response(response, send_content)
+
+
+django_application = AsyncURLConfHandler()
+
+# imported once Django is set up
+from dialogs.asyncviews import AsyncStreamingHttpResponse  # noqa: E402
+from dialogs.websocket import websocket_application  # noqa: E402
+
+websocket_routes = {
+    "/api/v1/dialogs/ws/": websocket_application,
+}
+
+
+async def application(scope, receive, send):
+    if scope["type"] != "websocket":
+        return await django_application(scope, receive, send)
+
+    route = websocket_routes.get(scope["path"])
+    if route is None:
+        await receive()  # websocket.connect
+        await send({"type": "websocket.close"})
+        return
+    return await route(scope, receive, send)
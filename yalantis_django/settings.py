@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 from django.contrib.messages import constants as messages
 
@@ -37,7 +38,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
-    "debug_toolbar.middleware.DebugToolbarMiddleware",
+    "dialogs.metrics.MetricsMiddleware",
+    "dialogs.routers.ReplicaRoutingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -45,7 +47,12 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "dialogs.querybudget.QueryBudgetMiddleware",
 ]
+# the debug toolbar is sync only, under ASGI (`DJANGO_ASGI`, set by `asgi.py`) it would
+# take every request out of the event loop
+if DEBUG and not os.environ.get("DJANGO_ASGI"):
+    MIDDLEWARE.insert(2, "debug_toolbar.middleware.DebugToolbarMiddleware")
 
 ROOT_URLCONF = "yalantis_django.urls"
 
@@ -77,7 +84,40 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
-    }
+        # a file (unlike the default in-memory database) lets tests run concurrent
+        # requests from several threads
+        "TEST": {"NAME": BASE_DIR / "test_db.sqlite3"},
+    },
+    # a read replica for `DIALOGS_READ_REPLICAS`, SQLite has no replication: the
+    # tests copy "default" into it
+    "replica": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / "db_replica.sqlite3",
+        # the tables are copied from "default" with the data
+        "TEST": {"NAME": BASE_DIR / "test_db_replica.sqlite3", "MIGRATE": False},
+    },
+}
+
+# dialogs reads go to the replicas, writes to "default" (see `dialogs.routers`)
+DATABASE_ROUTERS = ["dialogs.routers.ReplicaRouter"]
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # reads of the dialogs app (see `dialogs.caching`). Invalidations must reach
+    # every process, so the backend has to be shared by all of them: the files are
+    # shared by the processes of a host, deployments of several hosts need a
+    # network backend (e.g. memcached). Never a per-process `LocMemCache`.
+    "dialogs": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": BASE_DIR / "cache" / "dialogs",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
 }
 
 
@@ -130,7 +170,7 @@ INTERNAL_IPS = [
 ]
 
 AUTHENTICATION_BACKENDS = [
-    "django.contrib.auth.backends.ModelBackend",
+    # resolves emails and usernames, a `ModelBackend` before it would hash twice
     "accounts.backends.EmailOrUsernameModelBackend",
 ]
 
@@ -151,11 +191,73 @@ REST_FRAMEWORK = {
         "rest_framework.renderers.JSONRenderer",
     ],
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_jwt.authentication.JSONWebTokenAuthentication",
+        "accounts.authentication.CachedJSONWebTokenAuthentication",
         "rest_framework.authentication.SessionAuthentication",
         "rest_framework.authentication.BasicAuthentication",
     ),
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
     "PAGE_SIZE": 30,
+    # token buckets of the views with a `throttle_scope` (see `dialogs.throttling`)
+    "DEFAULT_THROTTLE_CLASSES": [
+        "dialogs.throttling.UserTokenBucketThrottle",
+        "dialogs.throttling.IPTokenBucketThrottle",
+    ],
+    "DEFAULT_THROTTLE_RATES": {
+        "send": "60/min",
+        "send_ip": "300/min",
+        "read_until": "120/min",
+        "read_until_ip": "600/min",
+        "thread_create": "20/min",
+        "thread_create_ip": "60/min",
+        # per account the login is attempted for
+        "login": "10/min",
+        "login_ip": "30/min",
+    },
     "TEST_REQUEST_DEFAULT_FORMAT": "json",
 }
+
+JWT_AUTH = {
+    "JWT_PAYLOAD_HANDLER": "accounts.authentication.jwt_payload_handler",
+}
+# Users authenticated by JWT are cached per process (see `accounts.authentication`),
+# revocations and deactivations reach the other processes within the TTL, seconds
+JWT_USER_CACHE_SIZE = 10000
+JWT_USER_CACHE_TTL = 60
+
+# Dialogs
+# Backend fanning thread events out to WebSocket clients (see `dialogs.pubsub`)
+DIALOGS_PUBSUB_BACKEND = "dialogs.pubsub.InProcessPubSub"
+# Longest wait of a long-poll request for new messages, seconds
+DIALOGS_LONG_POLL_TIMEOUT = 25
+# Threads running the database work of the async views under ASGI (see
+# `dialogs.asyncviews`)
+DIALOGS_ASYNC_DB_WORKERS = 8
+# Longest life of a Server-Sent Events stream, clients reconnect after it, seconds
+DIALOGS_SSE_TIMEOUT = 300
+# Idle time after which a keep-alive comment is sent to SSE clients, seconds
+DIALOGS_SSE_HEARTBEAT = 15
+# Cache the dialogs reads are served from, shared by all of the processes (see
+# `CACHES`), `None` disables caching
+DIALOGS_CACHE_ALIAS = "dialogs"
+# Lifetime of the cached dialogs reads, seconds
+DIALOGS_CACHE_TIMEOUT = 300
+# Age after which read messages are moved to the archive by `archive_messages`, days
+DIALOGS_ARCHIVE_AFTER_DAYS = 365
+# Full-text search of the messages (see `dialogs.search`), other databases than SQLite
+# need `dialogs.search.DatabaseSearchBackend` or a backend of their own
+DIALOGS_SEARCH_BACKEND = "dialogs.search.SQLiteFTS5SearchBackend"
+# Requests over the query budget of their view are logged ("log"), fail ("raise") or
+# aren't checked at all (None), see `dialogs.querybudget`
+DIALOGS_QUERY_BUDGET_MODE = None
+# Request metrics: `Server-Timing` headers and the Prometheus `/metrics/` endpoint
+# (see `dialogs.metrics`)
+DIALOGS_METRICS_ENABLED = False
+# Bearer token of the scrapers of `/metrics/` (`Authorization: Bearer <token>`), `None`
+# leaves the endpoint to staff users
+DIALOGS_METRICS_TOKEN = os.environ.get("DIALOGS_METRICS_TOKEN")
+# Aliases of `DATABASES` serving the dialogs reads of safe requests (see
+# `dialogs.routers`), none sends everything to "default"
+DIALOGS_READ_REPLICAS = []
+# Longest lag of the replicas, seconds: users read from "default" for as long after
+# they wrote, and entries cached from the replicas live no longer
+DIALOGS_REPLICA_LAG = 5
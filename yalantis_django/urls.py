@@ -1,7 +1,8 @@
 import debug_toolbar
 from django.contrib import admin
 from django.urls import path, include
-from rest_framework_jwt.views import obtain_jwt_token
+from accounts.views import ObtainJSONWebTokenView
+from dialogs.views import Metrics
 from . import views
 from .settings import DEBUG
 
@@ -13,7 +14,12 @@ urlpatterns = [
     path("authors/", views.authors, name="authors"),
     path("accounts/", include("accounts.urls")),
     path("api/v1/dialogs/", include("dialogs.urls")),
-    path("api/v1/get-auth-token/", obtain_jwt_token, name="get_auth_token"),
+    path(
+        "api/v1/get-auth-token/",
+        ObtainJSONWebTokenView.as_view(),
+        name="get_auth_token",
+    ),
+    path("metrics/", Metrics.as_view(), name="metrics"),
 ]
 
 if DEBUG:
@@ -0,0 +1,41 @@
+"""
+URLconf of the ASGI application (see ``asgi``): the message list, create, read_until,
+export and since endpoints are served by their async views, everything else as by
+``urls``.
+"""
+from django.urls import include, path
+
+from dialogs import asyncviews, urls as dialogs_urls
+from . import urls
+
+dialogs_urlpatterns = [
+    path(
+        "threads/<int:thread_pk>/messages/",
+        asyncviews.message_list,
+        name="message_list",
+    ),
+    path(
+        "threads/<int:thread_pk>/messages/read_until/",
+        asyncviews.messages_read_until,
+        name="messages_read_until",
+    ),
+    path(
+        "threads/<int:thread_pk>/messages/export/",
+        asyncviews.message_export,
+        name="message_export",
+    ),
+    path(
+        "messages/since/",
+        asyncviews.messages_since,
+        name="messages_since",
+    ),
+    # the sync views of the paths above are shadowed
+    *dialogs_urls.urlpatterns,
+]
+
+urlpatterns = [
+    path("api/v1/dialogs/", include((dialogs_urlpatterns, dialogs_urls.app_name)))
+    if getattr(pattern, "app_name", None) == dialogs_urls.app_name
+    else pattern
+    for pattern in urls.urlpatterns
+]